@@ -0,0 +1,246 @@
+"""Reproducible end-to-end PPO throughput benchmark for the ppo_yapperv1 stack, on CPU.
+
+The benchmark needs no downloads. The tokenizer is a small byte-level BPE
+trained in memory on the fixed `YAP_PROMPTS`, and policy / value / ref are
+randomly initialised GPT-2s of a tiny config. Everything else is the real
+training path:
+- `RewardFromFunction(yap_score)` with batched spaCy features and the
+  KL-weird probe against the ref model
+- `GPT2WithValueHead`
+- TRL's PPOTrainer
+
+Seeds and thread count are fixed, so runs on the same machine are comparable.
+
+Reported: samples/sec, time per phase and peak RSS. The phases are generate
+(`batch_generation`), reward (RewardFromFunction), backward, optimizer step
+and other (ref/value forwards, logprobs, advantages). Each run is appended to
+a JSON history file (`--history`), tagged with the git commit, and compared
+with the previous run of the same config.
+
+Usage:
+  python bench_ppo.py --steps 8 --batch-size 4
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import torch
+import transformers
+import trl
+import trl.trainer.ppo_trainer as ppo_mod
+from datasets import Dataset
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import DataCollatorWithPadding, GenerationConfig, GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+from trl import PPOConfig, PPOTrainer
+
+import ppo_yapperv1
+from ppo_yapperv1 import YAP_PROMPTS, GPT2WithValueHead, RewardFromFunction, yap_features_batch, yap_score
+from reward_telemetry import RewardTelemetry
+
+PHASES = ("generate", "reward", "backward", "optimizer", "other")
+
+
+def build_tokenizer(vocab_size=512):
+    """Byte-level BPE trained in memory on the fixed prompts (deterministic, no download)."""
+    tk = Tokenizer(models.BPE())
+    tk.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tk.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=["<|endoftext|>", "[PAD]"],
+                                  initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tk.train_from_iterator(YAP_PROMPTS, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tk, bos_token="<|endoftext|>", eos_token="<|endoftext|>",
+                                   pad_token="[PAD]", padding_side="left")
+
+
+def build_models(tok, args):
+    config = GPT2Config(vocab_size=len(tok), n_positions=256, n_embd=args.n_embd, n_layer=args.n_layer,
+                        n_head=args.n_head, bos_token_id=tok.bos_token_id, eos_token_id=tok.eos_token_id)
+    transformers.set_seed(args.seed)
+    policy = GPT2LMHeadModel(config)
+    ref = GPT2LMHeadModel(config)
+    value = GPT2WithValueHead.from_pretrained(GPT2LMHeadModel(config))
+    gen_cfg = GenerationConfig(max_new_tokens=args.max_new_tokens, do_sample=True, temperature=1.0, top_p=0.9, top_k=50,
+                               bos_token_id=tok.bos_token_id, eos_token_id=tok.eos_token_id, pad_token_id=tok.pad_token_id)
+    for m in (policy, value, ref):
+        m.generation_config = gen_cfg
+    return policy, value, ref
+
+
+class PhaseTimer:
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+
+    def wrap(self, phase, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[phase] += time.perf_counter() - start
+        return timed
+
+
+def git_commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def run_benchmark(args):
+    torch.set_num_threads(args.threads)
+    transformers.set_seed(args.seed)
+    tok = build_tokenizer()
+    policy, value, ref = build_models(tok, args)
+    # same KL-weird reward term as a real v1 run
+    ppo_yapperv1._lm, ppo_yapperv1._lm_tok = ref, tok
+
+    ds = Dataset.from_dict({"prompt": YAP_PROMPTS * 20})
+    ds = ds.map(lambda x: tok(x["prompt"], truncation=True), batched=True, remove_columns=["prompt"])
+
+    telemetry = RewardTelemetry()
+    reward_model = RewardFromFunction(yap_score, tok,
+                                      features_fn=lambda texts: yap_features_batch(texts, kl_weird=True),
+                                      telemetry=telemetry)
+    for model in (reward_model, ref):
+        for p in model.parameters():
+            p.requires_grad = False
+
+    output_dir = tempfile.mkdtemp(prefix="bench_ppo_")
+    ppo_config = PPOConfig(
+        output_dir=output_dir,
+        per_device_train_batch_size=args.batch_size,
+        gradient_accumulation_steps=1,
+        num_mini_batches=1,
+        num_ppo_epochs=args.ppo_epochs,
+        total_episodes=args.steps * args.batch_size,
+        response_length=args.max_new_tokens,
+        num_sample_generations=0,
+        save_strategy="no",
+        report_to="none",
+        seed=args.seed,
+        use_cpu=True,
+    )
+    trainer = PPOTrainer(
+        args=ppo_config,
+        processing_class=tok,
+        model=policy,
+        ref_model=ref,
+        value_model=value,
+        reward_model=reward_model,
+        train_dataset=ds,
+        eval_dataset=ds.select(range(10)),
+        data_collator=DataCollatorWithPadding(tok),
+    )
+
+    timer = PhaseTimer()
+    original_generation = ppo_mod.batch_generation
+    ppo_mod.batch_generation = timer.wrap("generate", original_generation)
+    trainer.accelerator.backward = timer.wrap("backward", trainer.accelerator.backward)
+    trainer.optimizer.step = timer.wrap("optimizer", trainer.optimizer.step)
+    try:
+        start = time.perf_counter()
+        trainer.train()
+        train_s = time.perf_counter() - start
+    finally:
+        ppo_mod.batch_generation = original_generation
+
+    timer.seconds["reward"] = telemetry.latency_s
+    timer.seconds["other"] = max(0.0, train_s - sum(timer.seconds[p] for p in PHASES if p != "other"))
+    samples = args.steps * args.batch_size
+    return {
+        "samples": samples,
+        "train_s": round(train_s, 3),
+        "samples_per_s": round(samples / train_s, 3),
+        "phase_s": {p: round(s, 3) for p, s in timer.seconds.items()},
+        "phase_pct": {p: round(100 * s / train_s, 1) for p, s in timer.seconds.items()},
+        "reward_batches": telemetry.batches,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def append_history(path, entry):
+    history = []
+    if os.path.exists(path):
+        with open(path) as f:
+            history = json.load(f)
+    previous = next((h for h in reversed(history) if h["config"] == entry["config"]), None)
+    history.append(entry)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(history, f, indent=2)
+    os.replace(tmp, path)
+    return previous
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CPU PPO throughput benchmark (tiny random GPT-2, no downloads)")
+    parser.add_argument("--steps", type=int, default=8, help="PPO updates to run")
+    parser.add_argument("--batch-size", type=int, default=4, help="Rollouts per PPO update")
+    parser.add_argument("--ppo-epochs", type=int, default=2, help="Optimization epochs per update")
+    parser.add_argument("--max-new-tokens", type=int, default=24, help="Response length")
+    parser.add_argument("--n-layer", type=int, default=2, help="Tiny GPT-2 layers")
+    parser.add_argument("--n-head", type=int, default=2, help="Tiny GPT-2 attention heads")
+    parser.add_argument("--n-embd", type=int, default=64, help="Tiny GPT-2 hidden size")
+    parser.add_argument("--threads", type=int, default=4, help="torch intra-op threads")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--history", type=str, default="bench_history.json", help="JSON history file to append to")
+    parser.add_argument("--note", type=str, default=None, help="Free-form note stored with the result")
+    return parser.parse_args()
+
+
+def main(args):
+    config = {k: getattr(args, k) for k in ("steps", "batch_size", "ppo_epochs", "max_new_tokens",
+                                            "n_layer", "n_head", "n_embd", "threads", "seed")}
+    print(f"[Bench PPO] {config}")
+    results = run_benchmark(args)
+    entry = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "note": args.note,
+        "config": config,
+        "results": results,
+        "env": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "trl": trl.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+    }
+    previous = append_history(args.history, entry)
+
+    print(f"[Bench PPO] {results['samples']} samples in {results['train_s']}s = {results['samples_per_s']} samples/s, "
+          f"peak RSS {results['peak_rss_mb']} MB")
+    for phase in PHASES:
+        print(f"[Bench PPO]   {phase:<10} {results['phase_s'][phase]:>8.2f}s {results['phase_pct'][phase]:>5.1f}%")
+    if previous is not None:
+        before = previous["results"]["samples_per_s"]
+        change = 100 * (results["samples_per_s"] - before) / before
+        print(f"[Bench PPO] vs {previous['commit']} ({previous['time']}): {before} -> {results['samples_per_s']} "
+              f"samples/s ({change:+.1f}%)")
+    print(f"[Bench PPO] Appended to {args.history}")
+    return entry
+
+
+if __name__ == "__main__":
+    main(parse_args())
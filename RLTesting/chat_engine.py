@@ -0,0 +1,240 @@
+"""Asyncio chat loop for the Phi-3 chat scripts.
+
+Replaces the input thread + `input_available.wait(timeout=0.1)` busy loop with
+three cooperating tasks:
+
+  * stdin reader   - lines arrive through the event loop (no polling); typing
+                     while the model is generating cancels that generation
+  * conversation   - appends turns to the `ChatHistory` and runs `generate` on a
+                     worker thread, streaming text back through the loop
+  * proactive timer - sleeps until the chat has been idle for `proactive_delay`
+                     seconds after an AI turn, then sends a proactive message
+
+The process sits in `select`/`epoll` when idle, so it uses no CPU between turns.
+With a `transcript` sink (record_sink.TranscriptSink) every AI turn is logged
+as a structured record without blocking the loop.
+"""
+import asyncio
+import random
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextStreamer
+
+
+class _CancelCriteria(StoppingCriteria):
+    """Stops `generate` at the next step once `event` is set."""
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+class _LoopStreamer(TextStreamer):
+    """TextStreamer that hands finished text chunks to an asyncio queue instead of stdout."""
+
+    def __init__(self, tokenizer, loop, queue):
+        super().__init__(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        self.loop = loop
+        self.queue = queue
+
+    def on_finalized_text(self, text, stream_end=False):
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+class AsyncChatEngine:
+    def __init__(self, model, tokenizer, history, token_budget, generation_kwargs,
+                 proactive_messages=(), proactive_delay=15, kv_cache=None,
+                 clean_reply=None, empty_reply="...", debug=False, transcript=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.history = history
+        self.token_budget = token_budget
+        self.generation_kwargs = generation_kwargs
+        self.proactive_messages = list(proactive_messages)
+        self.proactive_delay = proactive_delay
+        self.kv_cache = kv_cache
+        self.clean_reply = clean_reply or (lambda text: text.strip())
+        self.empty_reply = empty_reply
+        self.debug = debug
+        self.transcript = transcript
+        self.turn = 0
+        self.last_user_input = ""
+        # generation runs on one worker thread so the event loop stays responsive
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-gen")
+        self.inputs = asyncio.Queue()
+        self.activity = asyncio.Event()
+        self.cancel_event = threading.Event()
+        self.generating = False
+        self.last_activity = time.monotonic()
+        try:
+            self.device = next(model.parameters()).device
+        except StopIteration:
+            self.device = torch.device("cpu")
+
+    # -- tasks --------------------------------------------------------------------
+
+    def _on_line(self, line):
+        """Loop-side handler for one raw stdin line (b"" = end of input)."""
+        if not line:
+            print("Input stream closed.")
+            self.inputs.put_nowait(None)
+            return
+        if self.generating:
+            self.cancel_event.set()
+        self.inputs.put_nowait(line.decode(errors="replace").rstrip("\r\n"))
+
+    def _stdin_thread(self, loop):
+        # daemon thread: a readline still blocked when the user quits must not delay exit
+        # (an executor worker would be joined by asyncio.run's shutdown_default_executor)
+        while True:
+            line = sys.stdin.buffer.readline()
+            try:
+                loop.call_soon_threadsafe(self._on_line, line)
+            except RuntimeError:  # loop already closed
+                return
+            if not line:
+                return
+
+    async def _read_stdin(self):
+        loop = asyncio.get_running_loop()
+        # connect_read_pipe sets O_NONBLOCK on stdin. On a terminal, stdin and stdout share
+        # one open file description, so streamed prints could then raise BlockingIOError.
+        # Only real pipes / files take the non-blocking path; Windows consoles fail it anyway.
+        if not sys.stdin.isatty():
+            reader = asyncio.StreamReader()
+            try:
+                await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+            except (ValueError, NotImplementedError, OSError):
+                pass
+            else:
+                while True:
+                    line = await reader.readline()
+                    self._on_line(line)
+                    if not line:
+                        return
+        threading.Thread(target=self._stdin_thread, args=(loop,), name="chat-stdin", daemon=True).start()
+
+    async def _proactive_timer(self):
+        while True:
+            self.activity.clear()
+            idle_for = time.monotonic() - self.last_activity
+            try:
+                await asyncio.wait_for(self.activity.wait(), timeout=max(0.0, self.proactive_delay - idle_for))
+                continue
+            except asyncio.TimeoutError:
+                pass
+            if self.generating or not self.proactive_messages or self.history.messages[-1]["role"] != "assistant":
+                # nothing to follow up on; sleep until the next turn
+                await self.activity.wait()
+                continue
+            message = random.choice(self.proactive_messages)
+            print(f"AI (proactive): {message}")
+            self.history.append("assistant", message)
+            self._log("assistant (proactive)", "", message)
+            self._touch()
+
+    def _log(self, speaker, prompt, reply):
+        if self.transcript is not None:
+            self.transcript.log_turn(self.turn, speaker, prompt, reply)
+
+    def _touch(self):
+        self.last_activity = time.monotonic()
+        self.activity.set()
+
+    # -- generation ---------------------------------------------------------------
+
+    def _generate(self, prompt_ids, streamer):
+        input_ids = torch.tensor([prompt_ids], device=self.device)
+        kwargs = dict(self.generation_kwargs)
+        if self.kv_cache is not None:
+            kwargs["past_key_values"] = self.kv_cache.prepare(prompt_ids, kwargs.get("max_new_tokens", 0))
+            kwargs["return_dict_in_generate"] = True
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([_CancelCriteria(self.cancel_event)]),
+                **kwargs,
+            )
+        if self.kv_cache is not None:
+            self.kv_cache.update(output.past_key_values, output.sequences[0].tolist())
+            output = output.sequences
+        return self.tokenizer.decode(output[0][input_ids.shape[-1]:], skip_special_tokens=True)
+
+    async def _respond(self):
+        loop = asyncio.get_running_loop()
+        window = self.history.window_by_tokens(self.token_budget)
+        prompt_ids = self.history.prompt_ids(window)
+        if self.debug:
+            print(f"[History] prompt {len(prompt_ids)}/{self.token_budget} tokens, "
+                  f"{len(window) - 1}/{len(self.history.messages) - 1} messages kept")
+        chunks = asyncio.Queue()
+        streamer = _LoopStreamer(self.tokenizer, loop, chunks)
+        self.cancel_event.clear()
+        self.generating = True
+        print("AI: ", end="", flush=True)
+        future = loop.run_in_executor(self.executor, self._generate, prompt_ids, streamer)
+        # a failed generate never reaches streamer.end(); unblock the reader below
+        future.add_done_callback(lambda f: f.cancelled() or f.exception() is None or chunks.put_nowait(None))
+        try:
+            while (chunk := await chunks.get()) is not None:
+                print(chunk, end="", flush=True)
+            text = await future
+            interrupted = self.cancel_event.is_set()
+            reply = self.clean_reply(text)
+            if interrupted:
+                print(" [interrupted]")
+                if reply:
+                    self.history.append("assistant", reply)
+                    self._log("assistant (interrupted)", self.last_user_input, reply)
+            else:
+                print()
+                self.history.append("assistant", reply or self.empty_reply)
+                self._log("assistant", self.last_user_input, reply or self.empty_reply)
+            if self.debug and self.kv_cache is not None:
+                print(f"[KV cache] reused {self.kv_cache.reused_tokens}/{len(prompt_ids)} prompt tokens")
+        except Exception as e:
+            print(f"\nError during generation: {e}")
+            traceback.print_exc()
+            if self.kv_cache is not None:
+                self.kv_cache.reset() # The cache may hold a half-finished turn
+            self.history.append("assistant", "[Error generating response]")
+        finally:
+            self.generating = False
+            self._touch()
+
+    async def _converse(self):
+        while True:
+            user_input = await self.inputs.get()
+            if user_input is None:
+                return
+            if user_input.lower() == "quit":
+                print("Goodbye!")
+                return
+            self._touch()
+            print(f"\nYou: {user_input}")
+            self.history.append("user", user_input)
+            self.turn += 1
+            self.last_user_input = user_input
+            await self._respond()
+
+    async def run(self):
+        tasks = [asyncio.create_task(self._read_stdin()), asyncio.create_task(self._proactive_timer())]
+        try:
+            await self._converse()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.cancel_event.set()
+            self.executor.shutdown(wait=False)
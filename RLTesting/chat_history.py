@@ -0,0 +1,163 @@
+"""Token-cached conversation history for the Phi-3 chat scripts.
+
+`apply_chat_template` over the whole history re-renders and re-tokenizes every
+earlier message on every turn. `ChatHistory` instead stores the template token
+ids of each message once, when it is appended, and builds a prompt by
+concatenating cached fragments, so each turn only renders the newest message.
+
+A message's fragment is found by rendering it after the system prompt alone.
+At startup two probe conversations (system+user, system+assistant) show where
+the system block ends: their longest common token prefix. Whatever the
+system-only render has after that point is the template's trailing text (for
+Phi-3, the EOS it appends when no generation prompt is requested). It is cut
+from every fragment. With `verify=True` each prompt is also re-rendered in
+full and compared token by token; on any mismatch the full render is used and
+a warning is printed.
+
+Because every message's token count is cached, the history can also be trimmed
+to a token budget (`window_by_tokens`) instead of a message count, and the
+resulting prompt lengths are tracked for logging.
+"""
+
+
+def _common_prefix_len(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class ChatHistory:
+    def __init__(self, tokenizer, system_prompt, verify=False):
+        self.tokenizer = tokenizer
+        self.verify = verify
+        self.system = {"role": "system", "content": system_prompt}
+        system_ids = self._render([self.system])
+        probe_user = self._render([self.system, {"role": "user", "content": "ping"}])
+        probe_assistant = self._render([self.system, {"role": "assistant", "content": "pong"}])
+        self._system_len = min(_common_prefix_len(probe_user, probe_assistant), len(system_ids))
+        self._tail = system_ids[self._system_len:]
+        self._generation_suffix = self._render([self.system], add_generation_prompt=True)[self._system_len:]
+        # messages[i] is a plain {"role", "content"} dict; message_ids[i] its cached template tokens
+        self.messages = [self.system]
+        self.message_ids = [system_ids[:self._system_len]]
+        # running total of cached message tokens, and the length of every prompt built so far
+        self.total_tokens = len(self.message_ids[0])
+        self.prompt_lengths = []
+
+    def _render(self, messages, add_generation_prompt=False):
+        return list(self.tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=add_generation_prompt))
+
+    def append(self, role, content):
+        """Add a message, rendering and tokenizing only that message."""
+        message = {"role": role, "content": content}
+        ids = self._render([self.system, message])
+        end = len(ids) - len(self._tail)
+        if self.verify and ids[end:] != self._tail:
+            print(f"[ChatHistory] Warning: template tail changed after a {role} message; prompts may differ from a full render.")
+        self.messages.append(message)
+        self.message_ids.append(ids[self._system_len:end])
+        self.total_tokens += len(self.message_ids[-1])
+        return message
+
+    def window(self, max_messages=None):
+        """Indices of the system prompt plus the newest `max_messages` other messages."""
+        start = 1 if max_messages is None else max(1, len(self.messages) - max_messages)
+        return [0] + list(range(start, len(self.messages)))
+
+    def window_by_tokens(self, budget):
+        """Indices of the system prompt plus the newest whole turns that fit in `budget` prompt tokens.
+
+        The system prompt and the newest message are always kept, even if they alone
+        exceed the budget. Older messages are dropped oldest-first, and a window never
+        starts on an assistant reply, so no turn is left without its question.
+        """
+        used = len(self.message_ids[0]) + len(self._generation_suffix)
+        start = len(self.messages)
+        for i in range(len(self.messages) - 1, 0, -1):
+            size = len(self.message_ids[i])
+            if used + size > budget and start < len(self.messages):
+                break
+            used += size
+            start = i
+        while start < len(self.messages) - 1 and self.messages[start]["role"] == "assistant":
+            start += 1
+        return [0] + list(range(start, len(self.messages)))
+
+    def prompt_stats(self):
+        """Summary of prompt lengths (tokens) built so far."""
+        if not self.prompt_lengths:
+            return {"prompts": 0}
+        ordered = sorted(self.prompt_lengths)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {
+            "prompts": len(ordered),
+            "mean": round(sum(ordered) / len(ordered), 1),
+            "p50": pick(0.5),
+            "p90": pick(0.9),
+            "max": ordered[-1],
+            "history_tokens": self.total_tokens,
+        }
+
+    def prompt_ids(self, indices=None, add_generation_prompt=True):
+        """Prompt token ids for the messages at `indices` (default: all) from the per-message cache."""
+        indices = self.window() if indices is None else indices
+        ids = [tok for i in indices for tok in self.message_ids[i]]
+        ids += self._generation_suffix if add_generation_prompt else self._tail
+        if self.verify:
+            full = self._render([self.messages[i] for i in indices], add_generation_prompt=add_generation_prompt)
+            if full != ids:
+                at = _common_prefix_len(full, ids)
+                print(f"[ChatHistory] Warning: cached prompt differs from full render at token {at} "
+                      f"({len(ids)} cached vs {len(full)} rendered); using the full render.")
+                ids = full
+        self.prompt_lengths.append(len(ids))
+        return ids
+
+
+class PrefixKVCache:
+    """Carry `past_key_values` from one `generate` call to the next.
+
+    Each turn's prompt starts with the previous turn's prompt + reply, so only
+    the tokens after the longest common prefix need a forward pass. `prepare`
+    crops the cached keys/values to that prefix (which also handles history
+    windows sliding: the shared prefix shrinks to the system prompt) and
+    `update` stores what `generate` returned together with the token ids the
+    cache now covers.
+    """
+
+    def __init__(self, max_length=None):
+        # RoPE-scaled models (e.g. Phi-3 128k LongRoPE) change rotary factors past
+        # `max_length`, which invalidates keys cached under the short factors
+        self.max_length = max_length
+        self.cache = None
+        self.ids = []
+        self.reused_tokens = 0
+
+    def reset(self):
+        self.cache = None
+        self.ids = []
+
+    def prepare(self, prompt_ids, max_new_tokens=0):
+        """Cache to pass to `generate` for `prompt_ids`, or None to start fresh."""
+        self.reused_tokens = 0
+        if self.max_length is not None and len(prompt_ids) + max_new_tokens > self.max_length:
+            self.reset()
+        if self.cache is None:
+            return None
+        # generate needs at least one uncached prompt token to produce the next logits
+        keep = min(_common_prefix_len(self.ids, prompt_ids), len(prompt_ids) - 1)
+        if keep <= 0:
+            self.reset()
+            return None
+        self.cache.crop(keep)
+        self.ids = self.ids[:keep]
+        self.reused_tokens = keep
+        return self.cache
+
+    def update(self, cache, sequence_ids):
+        """Remember the cache `generate` returned and the ids (prompt + reply) it covers."""
+        self.cache = cache
+        self.ids = list(sequence_ids)[:cache.get_seq_length()]
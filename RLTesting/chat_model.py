@@ -0,0 +1,168 @@
+"""Backend selection and on-disk weight cache for the Phi-3 chat scripts.
+
+`load_chat_model` picks a backend automatically (override with `CHAT_BACKEND`):
+
+  cuda-4bit  bitsandbytes nf4 with device_map="auto" (CUDA + bitsandbytes present)
+  cuda-fp16  plain fp16 on the GPU (CUDA without bitsandbytes)
+  cpu-int8   fp32 weights with every nn.Linear dynamically quantized to int8
+
+Quantizing the full checkpoint is the slow part of startup, so the quantized
+model is written to a cache directory (`CHAT_MODEL_CACHE`, default
+~/.cache/rltesting-chat) the first time. Later starts load that instead:
+bnb 4-bit checkpoints through `from_pretrained` (safetensors, memory-mapped),
+cpu-int8 as a pickled module through `torch.load(mmap=True)`. The cold load
+time is stored next to the cache so warm starts can report both.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import transformers
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+BACKENDS = ("cuda-4bit", "cuda-fp16", "cpu-int8")
+CACHE_ROOT = os.environ.get("CHAT_MODEL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "rltesting-chat"))
+CACHE_META = "chat_model_cache.json"
+CPU_INT8_FILE = "model_int8.pt"
+
+
+def pick_backend():
+    backend = os.environ.get("CHAT_BACKEND")
+    if backend:
+        if backend not in BACKENDS:
+            raise ValueError(f"CHAT_BACKEND must be one of {BACKENDS}, got {backend!r}")
+        return backend
+    if not torch.cuda.is_available():
+        return "cpu-int8"
+    try:
+        import bitsandbytes # noqa: F401
+        return "cuda-4bit"
+    except ImportError:
+        print("[Chat Model] bitsandbytes not installed; using fp16 on the GPU instead of 4-bit.")
+        return "cuda-fp16"
+
+
+def cache_dir_for(model_name, backend):
+    """Cache location; versions are part of the key because pickled modules and bnb formats change between releases."""
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "--", model_name.strip("/"))
+    return os.path.join(CACHE_ROOT, f"{slug}-{backend}-torch{torch.__version__}-tf{transformers.__version__}")
+
+
+def _bnb_config():
+    from transformers import BitsAndBytesConfig
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=torch.float16,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_use_double_quant=True,
+    )
+
+
+def _load_cold(model_name, backend, trust_remote_code):
+    if backend == "cuda-4bit":
+        return AutoModelForCausalLM.from_pretrained(
+            model_name,
+            quantization_config=_bnb_config(),
+            torch_dtype=torch.float16,
+            device_map="auto",
+            trust_remote_code=trust_remote_code,
+        )
+    if backend == "cuda-fp16":
+        return AutoModelForCausalLM.from_pretrained(
+            model_name, torch_dtype=torch.float16, device_map="auto", trust_remote_code=trust_remote_code
+        )
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name, torch_dtype=torch.float32, low_cpu_mem_usage=True, trust_remote_code=trust_remote_code
+    )
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def _save_cache(model, cache_dir, backend, meta):
+    # write into a sibling temp dir and rename, so an interrupted save never looks like a valid cache
+    tmp_dir = cache_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    if backend == "cpu-int8":
+        torch.save(model, os.path.join(tmp_dir, CPU_INT8_FILE))
+    else:
+        model.save_pretrained(tmp_dir)
+    with open(os.path.join(tmp_dir, CACHE_META), "w") as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def _load_warm(model_name, cache_dir, backend, trust_remote_code):
+    if backend == "cpu-int8":
+        # makes remote-code model classes importable before unpickling them
+        AutoConfig.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+        # our own artifact, so a full unpickle is fine; plain tensors stay memory-mapped
+        return torch.load(os.path.join(cache_dir, CPU_INT8_FILE), mmap=True, weights_only=False)
+    return AutoModelForCausalLM.from_pretrained(
+        cache_dir, torch_dtype=torch.float16, device_map="auto", trust_remote_code=trust_remote_code
+    )
+
+
+def load_chat_model(model_name, trust_remote_code=False, backend=None, use_cache=True):
+    """Load (model, tokenizer, info) on the best available backend, using the quantized-weight cache.
+
+    `info` has backend, cache ("warm", "cold" or "off"), load_s, cache_dir,
+    and cold_load_s (from the run that built the cache).
+    """
+    backend = backend or pick_backend()
+    cache_dir = cache_dir_for(model_name, backend)
+    meta_path = os.path.join(cache_dir, CACHE_META)
+    # fp16 gains nothing from a second copy of the hub weights
+    use_cache = use_cache and backend != "cuda-fp16"
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=trust_remote_code)
+    start = time.perf_counter()
+    model = None
+    if use_cache and os.path.isfile(meta_path):
+        try:
+            model = _load_warm(model_name, cache_dir, backend, trust_remote_code)
+            state = "warm"
+        except Exception as e:
+            print(f"[Chat Model] Warning: could not load cached weights from {cache_dir} ({e}); rebuilding.")
+    if model is None:
+        model = _load_cold(model_name, backend, trust_remote_code)
+        state = "cold" if use_cache else "off"
+    load_s = time.perf_counter() - start
+    model.eval()
+
+    info = {"backend": backend, "cache": state, "load_s": round(load_s, 2), "cache_dir": cache_dir if use_cache else None}
+    if state == "cold":
+        meta = {"model": model_name, "backend": backend, "cold_load_s": info["load_s"], "created": time.time()}
+        try:
+            start = time.perf_counter()
+            _save_cache(model, cache_dir, backend, meta)
+            info["cache_write_s"] = round(time.perf_counter() - start, 2)
+        except Exception as e:
+            print(f"[Chat Model] Warning: could not write weight cache to {cache_dir}: {e}")
+        info["cold_load_s"] = info["load_s"]
+    elif state == "warm":
+        with open(meta_path) as f:
+            info["cold_load_s"] = json.load(f).get("cold_load_s")
+    return model, tokenizer, info
+
+
+def describe_load(info):
+    """One-line startup report: backend plus cold vs warm timing."""
+    line = f"[Chat Model] backend={info['backend']} cache={info['cache']} load={info['load_s']:.1f}s"
+    if info["cache"] == "warm" and info.get("cold_load_s"):
+        line += f" (cold load was {info['cold_load_s']:.1f}s, {info['cold_load_s'] / max(info['load_s'], 1e-6):.1f}x faster)"
+    elif info["cache"] == "cold" and "cache_write_s" in info:
+        line += f" (cached to {info['cache_dir']} in {info['cache_write_s']:.1f}s)"
+    return line
+
+
+if __name__ == "__main__":
+    # warm the cache ahead of time: python chat_model.py [model_name]
+    name = sys.argv[1] if len(sys.argv) > 1 else "microsoft/phi-3-mini-128k-instruct"
+    _, _, load_info = load_chat_model(name)
+    print(describe_load(load_info))
@@ -0,0 +1,576 @@
+"""Local multi-session Phi-3 chat service with continuous batching.
+
+One loaded model serves many conversations. Each session owns a `ChatHistory`
+(token-cached, trimmed to `--token-budget`) and its own KV cache, which is kept
+between turns so a new message only prefills the tokens after the longest
+common prefix (see `PrefixKVCache` in chat_history.py).
+
+A single engine thread runs the decode loop. Every step feeds the last sampled
+token of every active turn through the model as one batch. Turns join and leave
+between steps:
+
+  * join   the new turn's prompt is prefilled on its own cache, then its cache is
+           left-padded and stacked onto the batch cache (the attention mask hides
+           the padding, per-row position_ids keep RoPE positions right)
+  * leave  the finished row is copied back into its session cache, dropped from
+           the batch, and padding columns that no remaining row needs are trimmed
+
+so the batch cache is only rebuilt when membership changes, not every step.
+Sampling (temperature / top_p / repetition penalty) is applied per row, so
+sessions with different settings still share decode steps.
+
+Protocol: JSON lines over a localhost TCP socket, several sessions per
+connection allowed.
+  -> {"session": "alice", "message": "Hi!", "max_new_tokens": 200, "temperature": 0.6}
+  <- {"session": "alice", "delta": "Hello"} ...
+  <- {"session": "alice", "done": true, "text": "...", "latency_ms": ..., "ttft_ms": ..., "tokens": ..., "tokens_per_s": ...}
+  -> {"cmd": "stats"}                      per-session latency and aggregate tokens/sec
+  -> {"cmd": "reset", "session": "alice"}  forget a session's history and cache
+
+Usage:
+  python chat_server.py --port 8009
+  python chat_server.py --client alice --port 8009   # interactive client
+"""
+import argparse
+import asyncio
+import json
+import queue
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+import torch
+import torch.nn.functional as F
+from transformers import (
+    DynamicCache,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from chat_history import ChatHistory, _common_prefix_len
+from chat_model import describe_load, load_chat_model
+
+MODEL_NAME = "microsoft/phi-3-mini-128k-instruct"
+SYSTEM_PROMPT = "You are Phi, a helpful and friendly AI assistant. Answer the user concisely and directly. Avoid rambling."
+# per-turn settings a client may override
+TURN_DEFAULTS = {"max_new_tokens": 200, "temperature": 0.6, "top_p": 0.85, "repetition_penalty": 1.2}
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def _clean_reply(text):
+    return re.sub(r'<\|.*?\|>', '', text).strip()
+
+
+def _left_pad_cat(blocks):
+    """Stack (legacy_cache, attention_mask) blocks along the batch dim, left-padding to the longest."""
+    width = max(mask.shape[1] for _, mask in blocks)
+    layers = []
+    for layer in range(len(blocks[0][0])):
+        keys = [F.pad(cache[layer][0], (0, 0, width - mask.shape[1], 0)) for cache, mask in blocks]
+        values = [F.pad(cache[layer][1], (0, 0, width - mask.shape[1], 0)) for cache, mask in blocks]
+        layers.append((torch.cat(keys), torch.cat(values)))
+    mask = torch.cat([F.pad(mask, (width - mask.shape[1], 0)) for _, mask in blocks])
+    return tuple(layers), mask
+
+
+# ---------------------------------------------------------------------------
+# Sessions and turns
+# ---------------------------------------------------------------------------
+
+class Session:
+    def __init__(self, session_id, tokenizer, system_prompt):
+        self.id = session_id
+        self.history = ChatHistory(tokenizer, system_prompt)
+        # batch-size-1 DynamicCache kept between turns, and the token ids it covers
+        self.cache = None
+        self.cache_ids = []
+        self.turns = 0
+        self.tokens = 0
+        self.latencies = deque(maxlen=100)
+        self.ttfts = deque(maxlen=100)
+        self.reused_tokens = 0
+
+    def stats(self):
+        def ms(v):
+            return None if v is None else round(v * 1000, 1)
+        return {
+            "turns": self.turns,
+            "tokens": self.tokens,
+            "history_tokens": self.history.total_tokens,
+            "cached_tokens": len(self.cache_ids) if self.cache is not None else 0,
+            "latency_ms": {f"p{q}": ms(_percentile(list(self.latencies), q)) for q in (50, 90)},
+            "ttft_ms": {f"p{q}": ms(_percentile(list(self.ttfts), q)) for q in (50, 90)},
+        }
+
+
+class Turn:
+    """One user message being answered; lives in the engine's batch until it finishes."""
+
+    def __init__(self, session_id, message, params, loop):
+        self.session_id = session_id
+        self.message = message
+        self.params = {**TURN_DEFAULTS, **params}
+        self.loop = loop
+        # streamed events for the connection: delta/done dicts
+        self.events = asyncio.Queue()
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+        self.session = None
+        self.cache_ids = []
+        self.tokens = []
+        self.next_token = None
+        self.max_new_tokens = self.params["max_new_tokens"]
+        self.processors = LogitsProcessorList()
+        self.sent = 0
+
+    def emit(self, item):
+        self.loop.call_soon_threadsafe(self.events.put_nowait, item)
+
+
+# ---------------------------------------------------------------------------
+# Continuous batching engine (runs on its own thread)
+# ---------------------------------------------------------------------------
+
+class ContinuousBatcher:
+    def __init__(self, model, tokenizer, system_prompt=SYSTEM_PROMPT, token_budget=4096,
+                 max_batch_size=8, max_idle_caches=16):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        self.max_batch_size = max_batch_size
+        self.max_idle_caches = max_idle_caches
+        self.device = next(model.parameters()).device
+        # LongRoPE models switch rotary factors past this length, which would change every row in the batch
+        self.max_positions = getattr(model.config, "original_max_position_embeddings", None)
+        self.token_budget = token_budget
+        if self.max_positions is not None:
+            self.token_budget = min(token_budget, self.max_positions - TURN_DEFAULTS["max_new_tokens"])
+        stop = model.generation_config.eos_token_id
+        self.stop_ids = set(stop if isinstance(stop, list) else [stop]) | {tokenizer.eos_token_id}
+        self.pending = queue.Queue()
+        self.sessions = {}
+        # sessions holding an idle KV cache, least recently used first
+        self.idle_caches = OrderedDict()
+        self.active = []
+        self.batch_cache = None
+        self.attention_mask = None
+        self.started_at = time.time()
+        self.busy_s = 0.0
+        self.steps = 0
+        self.step_rows = 0
+        self.generated_tokens = 0
+        self.prefill_tokens = 0
+        self.reused_tokens = 0
+        self.joins = 0
+        self.leaves = 0
+
+    # -- batch cache bookkeeping -------------------------------------------------
+
+    def _row_cache(self, legacy, row, n):
+        """Row `row` of a left-padded legacy cache, without its padding, as a batch-1 DynamicCache."""
+        width = self.attention_mask.shape[1]
+        return DynamicCache.from_legacy_cache(tuple(
+            (k[row:row + 1, :, width - n:].contiguous(), v[row:row + 1, :, width - n:].contiguous()) for k, v in legacy
+        ))
+
+    def _join(self, turns):
+        blocks = []
+        if self.active:
+            blocks.append((self.batch_cache.to_legacy_cache(), self.attention_mask))
+        for turn in turns:
+            mask = torch.ones((1, len(turn.cache_ids)), dtype=torch.long, device=self.device)
+            blocks.append((turn.session.cache.to_legacy_cache(), mask))
+            turn.session.cache = None
+        legacy, self.attention_mask = _left_pad_cat(blocks)
+        self.batch_cache = DynamicCache.from_legacy_cache(legacy)
+        self.active.extend(turns)
+        self.joins += len(turns)
+
+    def _leave(self, finished):
+        legacy = self.batch_cache.to_legacy_cache()
+        keep = []
+        for row, turn in enumerate(self.active):
+            if turn in finished:
+                # hand the row back to its session so the next turn can reuse it
+                turn.session.cache = self._row_cache(legacy, row, len(turn.cache_ids))
+                turn.session.cache_ids = list(turn.cache_ids)
+            else:
+                keep.append(row)
+        self.active = [self.active[row] for row in keep]
+        self.leaves += len(finished)
+        if not self.active:
+            self.batch_cache = None
+            self.attention_mask = None
+            return
+        index = torch.tensor(keep, device=self.device)
+        mask = self.attention_mask.index_select(0, index)
+        # drop leading columns that are padding in every remaining row
+        start = int((mask.sum(0) > 0).nonzero()[0])
+        self.attention_mask = mask[:, start:]
+        self.batch_cache = DynamicCache.from_legacy_cache(tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:]) for k, v in legacy
+        ))
+
+    def _park_cache(self, session):
+        self.idle_caches[session.id] = session
+        self.idle_caches.move_to_end(session.id)
+        while len(self.idle_caches) > self.max_idle_caches:
+            _, evicted = self.idle_caches.popitem(last=False)
+            evicted.cache = None
+            evicted.cache_ids = []
+
+    # -- per-turn work -----------------------------------------------------------
+
+    def _admit(self, turn):
+        """Prefill a new turn on its session's own cache and sample its first token."""
+        turn.admitted_at = time.perf_counter()
+        session = self.sessions.get(turn.session_id)
+        if session is None:
+            session = self.sessions[turn.session_id] = Session(turn.session_id, self.tokenizer, self.system_prompt)
+        turn.session = session
+        self.idle_caches.pop(session.id, None)
+        session.history.append("user", turn.message)
+        prompt_ids = session.history.prompt_ids(session.history.window_by_tokens(self.token_budget))
+        if self.max_positions is not None:
+            turn.max_new_tokens = max(1, min(turn.max_new_tokens, self.max_positions - len(prompt_ids)))
+
+        keep = 0
+        if session.cache is not None:
+            keep = min(_common_prefix_len(session.cache_ids, prompt_ids), len(prompt_ids) - 1)
+        if keep > 0:
+            session.cache.crop(keep)
+        else:
+            session.cache = DynamicCache()
+        session.reused_tokens = keep
+        self.reused_tokens += keep
+        self.prefill_tokens += len(prompt_ids) - keep
+
+        new_ids = torch.tensor([prompt_ids[keep:]], device=self.device)
+        with torch.no_grad():
+            out = self.model(
+                input_ids=new_ids,
+                attention_mask=torch.ones((1, len(prompt_ids)), dtype=torch.long, device=self.device),
+                position_ids=torch.arange(keep, len(prompt_ids), device=self.device).unsqueeze(0),
+                past_key_values=session.cache,
+                use_cache=True,
+            )
+        session.cache = out.past_key_values
+        turn.cache_ids = list(prompt_ids)
+
+        params = turn.params
+        if params["repetition_penalty"] and params["repetition_penalty"] != 1.0:
+            turn.processors.append(RepetitionPenaltyLogitsProcessor(params["repetition_penalty"]))
+        if params["temperature"] and params["temperature"] > 0:
+            turn.processors.append(TemperatureLogitsWarper(params["temperature"]))
+            turn.processors.append(TopPLogitsWarper(params["top_p"]))
+        return self._accept(turn, self._sample(turn, out.logits[:, -1, :]))
+
+    def _sample(self, turn, logits):
+        # cache_ids is prompt + every generated token fed so far, i.e. what generate would pass as input_ids
+        seen = torch.tensor([turn.cache_ids], device=logits.device)
+        scores = turn.processors(seen, logits.float())
+        if turn.params["temperature"] and turn.params["temperature"] > 0:
+            return int(torch.multinomial(torch.softmax(scores, dim=-1), 1))
+        return int(scores.argmax(dim=-1))
+
+    def _accept(self, turn, token):
+        """Record a sampled token; returns True when the turn is finished."""
+        if token in self.stop_ids:
+            return True
+        if turn.first_token_at is None:
+            turn.first_token_at = time.perf_counter()
+        turn.tokens.append(token)
+        turn.next_token = token
+        text = self.tokenizer.decode(turn.tokens, skip_special_tokens=True)
+        # hold back incomplete multi-byte characters until the next token
+        if not text.endswith("�") and len(text) > turn.sent:
+            turn.emit({"session": turn.session_id, "delta": text[turn.sent:]})
+            turn.sent = len(text)
+        return len(turn.tokens) >= turn.max_new_tokens
+
+    def _finish(self, turn):
+        session = turn.session
+        now = time.perf_counter()
+        text = _clean_reply(self.tokenizer.decode(turn.tokens, skip_special_tokens=True)) or "..."
+        session.history.append("assistant", text)
+        latency = now - turn.submitted_at
+        ttft = (turn.first_token_at or now) - turn.submitted_at
+        session.turns += 1
+        session.tokens += len(turn.tokens)
+        session.latencies.append(latency)
+        session.ttfts.append(ttft)
+        self.generated_tokens += len(turn.tokens)
+        decode_s = now - (turn.first_token_at or now)
+        turn.emit({
+            "session": turn.session_id,
+            "done": True,
+            "text": text,
+            "tokens": len(turn.tokens),
+            "latency_ms": round(latency * 1000, 1),
+            "ttft_ms": round(ttft * 1000, 1),
+            "queue_wait_ms": round((turn.admitted_at - turn.submitted_at) * 1000, 1),
+            "reused_tokens": session.reused_tokens,
+            "tokens_per_s": round((len(turn.tokens) - 1) / decode_s, 1) if decode_s > 0 else None,
+        })
+        if session.cache is not None:
+            self._park_cache(session)
+
+    def _fail(self, turns, error):
+        for turn in turns:
+            if turn.session is not None:
+                turn.session.cache = None
+                turn.session.cache_ids = []
+            turn.emit({"session": turn.session_id, "done": True, "error": str(error)})
+
+    # -- decode loop -------------------------------------------------------------
+
+    def _step(self):
+        rows = len(self.active)
+        input_ids = torch.tensor([[turn.next_token] for turn in self.active], device=self.device)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, torch.ones((rows, 1), dtype=self.attention_mask.dtype, device=self.device)], dim=1
+        )
+        position_ids = torch.tensor([[len(turn.cache_ids)] for turn in self.active], device=self.device)
+        with torch.no_grad():
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=self.attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.batch_cache,
+                use_cache=True,
+            )
+        self.batch_cache = out.past_key_values
+        self.steps += 1
+        self.step_rows += rows
+        logits = out.logits[:, -1, :]
+        finished = []
+        for row, turn in enumerate(self.active):
+            turn.cache_ids.append(turn.next_token)
+            if self._accept(turn, self._sample(turn, logits[row:row + 1])):
+                finished.append(turn)
+        if finished:
+            self._leave(finished)
+            for turn in finished:
+                self._finish(turn)
+
+    def run(self):
+        while True:
+            joining = []
+            if not self.active:
+                turn = self.pending.get() # blocks while idle
+                if turn is None:
+                    return
+                joining.append(turn)
+            while len(self.active) + len(joining) < self.max_batch_size:
+                try:
+                    turn = self.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if turn is None:
+                    return
+                joining.append(turn)
+
+            start = time.perf_counter()
+            try:
+                ready = []
+                for turn in joining:
+                    try:
+                        done = self._admit(turn)
+                    except Exception as e:
+                        print(f"[Chat Server] Prefill failed for session {turn.session_id}: {e}")
+                        self._fail([turn], e)
+                        continue
+                    if done:
+                        turn.session.cache_ids = list(turn.cache_ids)
+                        self._finish(turn)
+                    else:
+                        ready.append(turn)
+                if ready:
+                    self._join(ready)
+                if self.active:
+                    self._step()
+            except Exception as e:
+                print(f"[Chat Server] Decode step failed, dropping {len(self.active)} turns: {e}")
+                self._fail(self.active, e)
+                self.active = []
+                self.batch_cache = None
+                self.attention_mask = None
+            self.busy_s += time.perf_counter() - start
+
+    def stats(self):
+        uptime = time.time() - self.started_at
+        return {
+            "uptime_s": round(uptime, 1),
+            "sessions": {sid: session.stats() for sid, session in list(self.sessions.items())},
+            "aggregate": {
+                "active_turns": len(self.active),
+                "queued_turns": self.pending.qsize(),
+                "generated_tokens": self.generated_tokens,
+                "tokens_per_s_busy": round(self.generated_tokens / self.busy_s, 1) if self.busy_s else None,
+                "tokens_per_s_uptime": round(self.generated_tokens / uptime, 1) if uptime else None,
+                "decode_steps": self.steps,
+                "mean_batch_rows": round(self.step_rows / self.steps, 2) if self.steps else None,
+                "prefill_tokens": self.prefill_tokens,
+                "reused_prompt_tokens": self.reused_tokens,
+                "joins": self.joins,
+                "leaves": self.leaves,
+                "token_budget": self.token_budget,
+            },
+        }
+
+
+# ---------------------------------------------------------------------------
+# Socket front end
+# ---------------------------------------------------------------------------
+
+class ChatServer:
+    def __init__(self, engine):
+        self.engine = engine
+        # sessions with a turn in flight; a session answers one message at a time
+        self.busy = set()
+
+    async def _chat(self, data, send):
+        session_id = str(data.get("session", "default"))
+        message = data.get("message")
+        if not isinstance(message, str) or not message:
+            await send({"session": session_id, "done": True, "error": "expected a non-empty 'message'"})
+            return
+        if session_id in self.busy:
+            await send({"session": session_id, "done": True, "error": "session is still answering the previous message"})
+            return
+        params = {k: data[k] for k in TURN_DEFAULTS if data.get(k) is not None}
+        turn = Turn(session_id, message, params, asyncio.get_running_loop())
+        self.busy.add(session_id)
+        self.engine.pending.put(turn)
+        try:
+            while True:
+                event = await turn.events.get()
+                await send(event)
+                if event.get("done"):
+                    if "error" not in event:
+                        print(f"[session {session_id}] {event['tokens']} tokens in {event['latency_ms']:.0f}ms "
+                              f"(ttft {event['ttft_ms']:.0f}ms, reused {event['reused_tokens']} prompt tokens)")
+                    break
+        finally:
+            self.busy.discard(session_id)
+
+    async def handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def send(payload):
+            async with lock:
+                writer.write((json.dumps(payload) + "\n").encode())
+                await writer.drain()
+
+        try:
+            while line := await reader.readline():
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    await send({"error": "expected one JSON object per line"})
+                    continue
+                cmd = data.get("cmd", "chat")
+                if cmd == "chat":
+                    task = asyncio.create_task(self._chat(data, send))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                elif cmd == "stats":
+                    await send(self.engine.stats())
+                elif cmd == "reset":
+                    session_id = str(data.get("session", "default"))
+                    if session_id in self.busy:
+                        await send({"session": session_id, "error": "session is busy"})
+                    else:
+                        # the engine thread only touches sessions while admitting, so popping here is safe
+                        self.engine.idle_caches.pop(session_id, None)
+                        self.engine.sessions.pop(session_id, None)
+                        await send({"session": session_id, "reset": True})
+                else:
+                    await send({"error": f"unknown cmd {cmd!r}"})
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    print(f"Loading model ({args.model_name}) ...", flush=True)
+    model, tokenizer, load_info = load_chat_model(args.model_name)
+    print(describe_load(load_info), flush=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    engine = ContinuousBatcher(
+        model, tokenizer, token_budget=args.token_budget,
+        max_batch_size=args.max_batch_size, max_idle_caches=args.max_idle_caches,
+    )
+    worker = threading.Thread(target=engine.run, name="chat-engine", daemon=True)
+    worker.start()
+    server = ChatServer(engine)
+    srv = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+    print(f"Chat server listening on {args.host}:{args.port} (max_batch_size={args.max_batch_size}, "
+          f"history budget {engine.token_budget} tokens)", flush=True)
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        engine.pending.put(None)
+        print(json.dumps(engine.stats()["aggregate"]))
+
+
+async def client(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    loop = asyncio.get_running_loop()
+    print(f"Connected as session '{args.client}'. Type a message ('/stats' for server stats, 'quit' to exit).")
+    while True:
+        line = (await loop.run_in_executor(None, sys.stdin.readline)).strip()
+        if not line or line.lower() == "quit":
+            break
+        request = {"cmd": "stats"} if line == "/stats" else {"session": args.client, "message": line}
+        writer.write((json.dumps(request) + "\n").encode())
+        await writer.drain()
+        if request.get("cmd") == "stats":
+            print(json.dumps(json.loads(await reader.readline()), indent=2))
+            continue
+        print("AI: ", end="", flush=True)
+        while True:
+            event = json.loads(await reader.readline())
+            if event.get("done"):
+                summary = event.get("error") or f"{event['tokens']} tokens, {event['latency_ms']:.0f}ms"
+                print(f"\n[{summary}]")
+                break
+            print(event["delta"], end="", flush=True)
+    writer.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Multi-session Phi-3 chat server with continuous batching")
+    parser.add_argument("--model-name", type=str, default=MODEL_NAME, help="Chat model to serve")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Interface to bind / connect to")
+    parser.add_argument("--port", type=int, default=8009, help="TCP port")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Most turns decoded together per step")
+    parser.add_argument("--token-budget", type=int, default=4096, help="Prompt tokens kept from each session's history")
+    parser.add_argument("--max-idle-caches", type=int, default=16, help="Idle sessions whose KV cache is kept for reuse")
+    parser.add_argument("--client", type=str, default=None, help="Run an interactive client for this session id instead")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    try:
+        asyncio.run(client(args) if args.client else serve(args))
+    except KeyboardInterrupt:
+        print("Server stopped.")
@@ -0,0 +1,197 @@
+"""Compare many PPO runs: parallel, cached metrics parsing plus aligned panels and a summary table.
+
+Each run directory's metrics.jsonl, together with its rotated segments, is
+parsed in a process pool. The parse is cached as Parquet under `--cache-dir`,
+keyed by the size and mtime of every file, so unchanged runs load straight
+from the cache next time. Curves are EMA-smoothed (`--smoothing`, as in
+TensorBoard) and drawn against episode on shared axes. The raw values are drawn
+faintly underneath.
+
+Usage:
+  python compare_runs.py logs_500_v1 logs_500_v2 "sweeps/lr-*" --output-dir comparisons
+"""
+import argparse
+import glob
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from plot_metrics import lttb, load_metrics, prepare
+from record_sink import rotated_paths
+
+# (display name, column, True if higher is better)
+PANELS = [
+    ('RLHF Reward', 'rlhf_reward', True),
+    ('Yap Score', 'yap_score', True),
+    ('KL Divergence', 'kl', False),
+    ('Entropy', 'entropy', True),
+    ('Policy Loss', 'policy_loss', False),
+    ('Value Loss', 'value_loss', False),
+]
+X = 'episode'
+
+
+def cache_path(run_dir, metrics_name, cache_dir):
+    """Cache file for the current state of a run's metrics, or None if the run has no metrics yet."""
+    paths = rotated_paths(os.path.join(run_dir, metrics_name))
+    if not paths:
+        return None
+    key = [os.path.abspath(run_dir)]
+    for path in paths:
+        st = os.stat(path)
+        key.append(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns}")
+    run_key = hashlib.sha1(key[0].encode()).hexdigest()[:12]
+    state_key = hashlib.sha1("|".join(key).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{run_key}-{state_key}.parquet")
+
+
+def parse_run(run_dir, metrics_name, cache_dir):
+    """Worker: the run's metrics as a numeric DataFrame, read from or written to the Parquet cache."""
+    cached = cache_path(run_dir, metrics_name, cache_dir)
+    if cached is None:
+        return run_dir, None, False
+    if os.path.exists(cached):
+        return run_dir, pd.read_parquet(cached), True
+    df = prepare(load_metrics(os.path.join(run_dir, metrics_name)))
+    df = df.apply(pd.to_numeric, errors='coerce').dropna(axis=1, how='all').reset_index(drop=True)
+    # drop stale caches of this run before writing the current one
+    for old in glob.glob(cached.rsplit("-", 1)[0] + "-*.parquet"):
+        os.remove(old)
+    tmp = cached + ".tmp"
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, cached)
+    return run_dir, df, False
+
+
+def load_runs(run_dirs, metrics_name, cache_dir, workers):
+    os.makedirs(cache_dir, exist_ok=True)
+    start = time.perf_counter()
+    runs, hits = {}, 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(parse_run, d, metrics_name, cache_dir) for d in run_dirs]
+        for future in futures:
+            run_dir, df, hit = future.result()
+            if df is None or df.empty:
+                print(f"Warning: no metrics in {run_dir}; skipping")
+                continue
+            runs[run_dir] = df
+            hits += hit
+    print(f"Loaded {len(runs)} runs ({hits} from cache) in {time.perf_counter() - start:.1f}s")
+    return runs
+
+
+def smooth(values, weight):
+    """Debiased exponential moving average, like TensorBoard's smoothing slider."""
+    if weight <= 0:
+        return values
+    return values.ewm(alpha=1 - weight, adjust=True).mean()
+
+
+def run_labels(run_dirs):
+    """Label each run by its path relative to the runs' common parent, so `a/run1` and `b/run1` stay distinct."""
+    paths = [os.path.abspath(d) for d in run_dirs]
+    try:
+        root = os.path.commonpath([os.path.dirname(p) for p in paths])
+    except ValueError:  # different drives on Windows
+        return dict(zip(run_dirs, paths))
+    return {d: os.path.relpath(p, root) for d, p in zip(run_dirs, paths)}
+
+
+def plot_runs(runs, smoothing, max_points, out_path):
+    fig, axes = plt.subplots(len(PANELS), 1, figsize=(10, 3 * len(PANELS)), sharex=True)
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+    for ax, (label, col, _) in zip(axes, PANELS):
+        for i, (name, df) in enumerate(runs.items()):
+            if col not in df.columns or X not in df.columns:
+                continue
+            series = df[[X, col]].dropna().sort_values(X)
+            xs = series[X].to_numpy(dtype=float)
+            raw = series[col].to_numpy(dtype=float)
+            smoothed = smooth(series[col], smoothing).to_numpy(dtype=float)
+            idx = lttb(xs, smoothed, max_points) if max_points else np.arange(len(xs))
+            color = colors[i % len(colors)]
+            ax.plot(xs[idx], raw[idx], color=color, alpha=0.2, linewidth=0.8)
+            ax.plot(xs[idx], smoothed[idx], color=color, label=name)
+        ax.set_ylabel(label)
+        ax.grid(True)
+    axes[-1].set_xlabel(X)
+    axes[0].legend(loc='best', fontsize='small', ncol=max(1, len(runs) // 8))
+    fig.tight_layout()
+    fig.savefig(out_path)
+    plt.close(fig)
+    print(f"Saved comparison plot to {out_path}")
+
+
+def summarize(runs, smoothing):
+    """One row per run: final and best (smoothed) value of each panel metric, with the episode of the best."""
+    rows = []
+    for name, df in runs.items():
+        row = {'run': name, 'episodes': df[X].max() if X in df.columns else None}
+        for _, col, higher in PANELS:
+            if col not in df.columns or X not in df.columns:
+                continue
+            series = df[[X, col]].dropna().sort_values(X)
+            if series.empty:
+                continue
+            values = smooth(series[col], smoothing).reset_index(drop=True)
+            best = values.idxmax() if higher else values.idxmin()
+            row[f'{col}_final'] = values.iloc[-1]
+            row[f'{col}_best'] = values.iloc[best]
+            row[f'{col}_best_at'] = series[X].iloc[best]
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare PPO runs from their metrics.jsonl logs")
+    parser.add_argument("run_dirs", nargs="+", help="Run log directories (glob patterns allowed)")
+    parser.add_argument("--metrics-name", type=str, default="metrics.jsonl", help="Metrics file inside each run directory")
+    parser.add_argument("--output-dir", type=str, default="comparisons", help="Where the plot and summary.csv go")
+    parser.add_argument("--cache-dir", type=str, default=os.path.expanduser("~/.cache/compare_runs"), help="Parquet parse cache")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: one per run, up to the CPU count)")
+    parser.add_argument("--smoothing", type=float, default=0.6, help="EMA weight in [0, 1); 0 disables smoothing")
+    parser.add_argument("--max-points", type=int, default=2000, help="LTTB-downsample each curve to this many points (0 = all)")
+    parser.add_argument("--sort-by", type=str, default="rlhf_reward_best", help="Summary column to sort by")
+    return parser.parse_args()
+
+
+def main(args):
+    # overlapping patterns must not submit a run twice: its workers would delete each other's cache files
+    run_dirs, seen = [], set()
+    for pattern in args.run_dirs:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        for d in matches:
+            key = os.path.abspath(d)
+            if os.path.isdir(d) and key not in seen:
+                seen.add(key)
+                run_dirs.append(d)
+    if not run_dirs:
+        raise SystemExit("No run directories found")
+    workers = args.workers or min(len(run_dirs), os.cpu_count() or 1)
+    runs = load_runs(run_dirs, args.metrics_name, args.cache_dir, workers)
+    if not runs:
+        raise SystemExit("No metrics to compare")
+    labels = run_labels(list(runs))
+    runs = {labels[run_dir]: df for run_dir, df in runs.items()}
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    plot_runs(runs, args.smoothing, args.max_points, os.path.join(args.output_dir, "compare_runs.png"))
+    summary = summarize(runs, args.smoothing)
+    if args.sort_by in summary.columns:
+        higher = not any(args.sort_by.startswith(col) for _, col, up in PANELS if not up)
+        summary = summary.sort_values(args.sort_by, ascending=not higher)
+    summary_path = os.path.join(args.output_dir, "summary.csv")
+    summary.to_csv(summary_path, index=False)
+    with pd.option_context('display.max_columns', None, 'display.width', 200, 'display.float_format', '{:.4g}'.format):
+        print(summary.to_string(index=False))
+    print(f"Saved summary to {summary_path}")
+    return summary
+
+
+if __name__ == "__main__":
+    main(parse_args())
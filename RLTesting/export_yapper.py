@@ -0,0 +1,172 @@
+"""Export a trained yapper checkpoint to an optimized CPU artifact.
+
+Formats:
+  onnx        ONNX graph with past-key-value inputs/outputs (via optimum), optionally
+              with dynamic int8 weight quantization from onnxruntime (`--int8`)
+  torch-int8  eager PyTorch with GPT-2's Conv1D layers turned into Linear and
+              dynamically quantized to int8; needs nothing beyond torch
+
+The output directory holds the artifact, config, tokenizer and a
+`yapper_export.json` manifest, so `Yapper(<output-dir>)` (and everything built
+on it, e.g. yapper_server.py) loads it through the usual API on CPU.
+
+After exporting, greedy outputs of the artifact are compared against
+`Yapper.chat` on the source checkpoint (`--parity-prompts`, `--parity-tokens`).
+fp32 ONNX should match exactly; int8 artifacts report how many leading tokens
+agree instead.
+
+Usage:
+  python export_yapper.py --model-path yapbot-ppo --output-dir yapbot-onnx-int8 --format onnx --int8
+  python export_yapper.py --model-path yapbot-ppo --output-dir yapbot-int8 --format torch-int8
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+from transformers import AutoTokenizer, GenerationConfig
+
+from ppo_yapperv1 import EXPORT_MANIFEST, Yapper, load_causal_lm, quantize_int8_cpu
+
+PARITY_PROMPTS = [
+    "Hey, what's on your mind today?",
+    "What do you think about AI art?",
+    "Tell me something weird you believe.",
+]
+
+
+def _save_plain_checkpoint(model_path, out_dir):
+    """Re-save the causal LM without the value head so exporters see a vanilla checkpoint."""
+    model, info = load_causal_lm(model_path, torch.device("cpu"))
+    model.save_pretrained(out_dir)
+    AutoTokenizer.from_pretrained(model_path).save_pretrained(out_dir)
+    try:
+        GenerationConfig.from_pretrained(model_path).save_pretrained(out_dir)
+    except Exception:
+        pass
+    return model, info
+
+
+def export_onnx(model_path, output_dir, int8):
+    try:
+        from optimum.onnxruntime import ORTModelForCausalLM, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    except ImportError:
+        raise SystemExit("ONNX export needs optimum + onnxruntime: pip install 'optimum[onnxruntime]'")
+    with tempfile.TemporaryDirectory() as plain_dir:
+        _save_plain_checkpoint(model_path, plain_dir)
+        ort_model = ORTModelForCausalLM.from_pretrained(plain_dir, export=True, use_cache=True)
+        ort_model.save_pretrained(output_dir)
+        AutoTokenizer.from_pretrained(plain_dir).save_pretrained(output_dir)
+        for name in ("generation_config.json",):
+            if os.path.isfile(os.path.join(plain_dir, name)):
+                shutil.copy(os.path.join(plain_dir, name), output_dir)
+    file_name = "model.onnx"
+    if int8:
+        quantizer = ORTQuantizer.from_pretrained(output_dir, file_name=file_name)
+        qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=True)
+        quantizer.quantize(save_dir=output_dir, quantization_config=qconfig)
+        file_name = "model_quantized.onnx"
+    files = [name for name in os.listdir(output_dir) if name.startswith(file_name)]
+    return file_name, files
+
+
+def export_torch_int8(model_path, output_dir):
+    model, _ = _save_plain_checkpoint(model_path, output_dir)
+    # keep only config/tokenizer from the plain save; the weights are replaced by the int8 state dict
+    for name in os.listdir(output_dir):
+        if name.startswith(("model.safetensors", "pytorch_model")):
+            os.remove(os.path.join(output_dir, name))
+    file_name = "model_int8.pt"
+    torch.save(quantize_int8_cpu(model).state_dict(), os.path.join(output_dir, file_name))
+    return file_name, [file_name]
+
+
+def parity_check(model_path, output_dir, prompts, max_tokens):
+    """Greedy outputs of the exported artifact vs. `Yapper.chat` on the source checkpoint."""
+    reference = Yapper(model_path, torch.device("cpu"))
+    exported = Yapper(output_dir)
+    results = []
+    for prompt in prompts:
+        timings = {}
+        outputs = {}
+        for name, yapper in (("reference", reference), ("exported", exported)):
+            start = time.perf_counter()
+            outputs[name] = yapper.chat(prompt, max_length=max_tokens, min_length=max_tokens, do_sample=False)
+            timings[name] = time.perf_counter() - start
+        ref_ids = reference.tokenizer(outputs["reference"]).input_ids
+        exp_ids = exported.tokenizer(outputs["exported"]).input_ids
+        common = 0
+        for a, b in zip(ref_ids, exp_ids):
+            if a != b:
+                break
+            common += 1
+        results.append({
+            "prompt": prompt,
+            "exact_match": outputs["reference"] == outputs["exported"],
+            "common_prefix_tokens": common,
+            "total_tokens": len(ref_ids),
+            "reference_s": timings["reference"],
+            "exported_s": timings["exported"],
+        })
+    ref_time = sum(r["reference_s"] for r in results)
+    exp_time = sum(r["exported_s"] for r in results)
+    return {
+        "exact_matches": sum(r["exact_match"] for r in results),
+        "prompts": len(results),
+        "speedup": ref_time / exp_time if exp_time else 0.0,
+        "details": results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export a trained Yapper to an optimized CPU artifact")
+    parser.add_argument("--model-path", type=str, required=True, help="Checkpoint saved by the PPO scripts")
+    parser.add_argument("--output-dir", type=str, required=True, help="Where to write the exported artifact")
+    parser.add_argument("--format", choices=["onnx", "torch-int8"], default="onnx", help="Artifact type")
+    parser.add_argument("--int8", action="store_true", help="Quantize ONNX weights to int8 (torch-int8 always is)")
+    parser.add_argument("--parity-prompts", type=str, nargs="*", default=PARITY_PROMPTS, help="Prompts for the greedy parity check")
+    parser.add_argument("--parity-tokens", type=int, default=32, help="Greedy tokens generated per parity prompt")
+    parser.add_argument("--skip-parity", action="store_true", help="Export only, without the parity check")
+    return parser.parse_args()
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    start = time.perf_counter()
+    if args.format == "onnx":
+        file_name, files = export_onnx(args.model_path, args.output_dir, args.int8)
+    else:
+        file_name, files = export_torch_int8(args.model_path, args.output_dir)
+    manifest = {
+        "format": args.format,
+        "file": file_name,
+        "files": files,
+        "int8": args.format == "torch-int8" or args.int8,
+        "source": os.path.abspath(args.model_path),
+        "export_s": time.perf_counter() - start,
+        "torch_version": torch.__version__,
+    }
+    with open(os.path.join(args.output_dir, EXPORT_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Exported {args.model_path} -> {args.output_dir} ({args.format}, int8={manifest['int8']}) in {manifest['export_s']:.1f}s")
+
+    if args.skip_parity:
+        return
+    parity = parity_check(args.model_path, args.output_dir, args.parity_prompts, args.parity_tokens)
+    manifest["parity"] = parity
+    with open(os.path.join(args.output_dir, EXPORT_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    for r in parity["details"]:
+        status = "match" if r["exact_match"] else f"diverges after {r['common_prefix_tokens']}/{r['total_tokens']} tokens"
+        print(f"[parity] {status} | {r['reference_s']:.2f}s -> {r['exported_s']:.2f}s | {r['prompt']!r}")
+    print(f"[parity] {parity['exact_matches']}/{parity['prompts']} exact greedy matches, {parity['speedup']:.2f}x speedup")
+    if not manifest["int8"] and parity["exact_matches"] < parity["prompts"]:
+        print("[parity] Warning: fp32 export should match the reference exactly.")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,171 @@
+"""LoRA helpers for the GRPO run in test.py: footprint tracking and adapter merge/export.
+
+In LoRA mode test.py loads the frozen GPT-2 base in bf16 (when the GPU supports
+it) and hands `peft_config` to GRPOTrainer. Only the adapters train: PEFT keeps
+them in fp32, the optimizer holds state for them alone, and `save_model` and
+the periodic checkpoints write `adapter_model.safetensors` without the base.
+
+`FootprintCallback` records what the two modes cost: trainable parameters,
+optimizer state bytes, peak CUDA memory, step time and checkpoint size. It
+writes them to `<output_dir>/footprint.json`. `record_final_model` then adds the
+size of the final `save_model` output (adapter only vs full weights).
+
+Usage:
+  python grpo_lora.py merge outputs/gpt2-GRPO-gsm8k-rtx3080-lora outputs/gpt2-GRPO-gsm8k-rtx3080-merged
+  python grpo_lora.py compare outputs/gpt2-GRPO-gsm8k-rtx3080 outputs/gpt2-GRPO-gsm8k-rtx3080-lora
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, TrainerCallback
+
+FOOTPRINT_FILE = "footprint.json"
+
+
+def base_dtype():
+    """Precision for the frozen base in LoRA mode: bf16 where supported, else fp32."""
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float32
+
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def model_files_size(path):
+    """Bytes of the files saved directly in `path`: the final model, without checkpoint-N subdirectories."""
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file() and entry.name != FOOTPRINT_FILE)
+
+
+def optimizer_state_bytes(optimizer):
+    total = 0
+    for state in optimizer.state.values():
+        for value in state.values():
+            if torch.is_tensor(value):
+                total += value.numel() * value.element_size()
+    return total
+
+
+class FootprintCallback(TrainerCallback):
+    """Collects memory, step time and checkpoint size for one training run."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.step_times = []
+        self.checkpoint_bytes = []
+        self.optimizer_bytes = None
+        self.trainable_params = None
+        self.total_params = None
+        self._step_start = None
+
+    def on_train_begin(self, args, state, control, model=None, **kwargs):
+        self.total_params = sum(p.numel() for p in model.parameters())
+        self.trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self._step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, optimizer=None, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.step_times.append(time.perf_counter() - self._step_start)
+        if self.optimizer_bytes is None and optimizer is not None:
+            # Adam state exists after the first step
+            self.optimizer_bytes = optimizer_state_bytes(optimizer)
+
+    def on_save(self, args, state, control, **kwargs):
+        checkpoint = os.path.join(args.output_dir, f"checkpoint-{state.global_step}")
+        if os.path.isdir(checkpoint):
+            self.checkpoint_bytes.append(dir_size(checkpoint))
+
+    def summary(self):
+        # the first steps include CUDA warm-up and allocator growth
+        steady = self.step_times[2:] or self.step_times
+        return {
+            "mode": self.mode,
+            "total_params": self.total_params,
+            "trainable_params": self.trainable_params,
+            "optimizer_state_mb": None if self.optimizer_bytes is None else round(self.optimizer_bytes / 2**20, 1),
+            "peak_cuda_mb": round(torch.cuda.max_memory_allocated() / 2**20, 1) if torch.cuda.is_available() else None,
+            "steps": len(self.step_times),
+            "median_step_s": round(statistics.median(steady), 3) if steady else None,
+            "checkpoint_mb": round(max(self.checkpoint_bytes) / 2**20, 1) if self.checkpoint_bytes else None,
+        }
+
+    def on_train_end(self, args, state, control, **kwargs):
+        summary = self.summary()
+        with open(os.path.join(args.output_dir, FOOTPRINT_FILE), "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"[Footprint] {summary}")
+
+
+def record_final_model(output_dir):
+    """Add the size of the saved final model to footprint.json; call after `save_model`. Returns the size in MB."""
+    size_mb = round(model_files_size(output_dir) / 2**20, 1)
+    path = os.path.join(output_dir, FOOTPRINT_FILE)
+    footprint = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            footprint = json.load(f)
+    footprint["final_model_mb"] = size_mb
+    with open(path, "w") as f:
+        json.dump(footprint, f, indent=2)
+    return size_mb
+
+
+def merge_and_export(adapter_dir, output_dir, dtype=torch.float32):
+    """Fold a LoRA adapter into its base model and save a plain checkpoint (loadable without peft)."""
+    from peft import AutoPeftModelForCausalLM
+    start = time.perf_counter()
+    model = AutoPeftModelForCausalLM.from_pretrained(adapter_dir, torch_dtype=dtype)
+    merged = model.merge_and_unload()
+    merged.save_pretrained(output_dir, safe_serialization=True)
+    AutoTokenizer.from_pretrained(adapter_dir).save_pretrained(output_dir)
+    print(f"[LoRA] Merged {adapter_dir} ({dir_size(adapter_dir) / 2**20:.1f} MB adapter) -> {output_dir} "
+          f"({dir_size(output_dir) / 2**20:.1f} MB) in {time.perf_counter() - start:.1f}s")
+    return output_dir
+
+
+def compare_footprints(run_dirs):
+    rows = []
+    for run_dir in run_dirs:
+        with open(os.path.join(run_dir, FOOTPRINT_FILE)) as f:
+            rows.append((run_dir, json.load(f)))
+    keys = ["mode", "trainable_params", "optimizer_state_mb", "peak_cuda_mb", "median_step_s", "checkpoint_mb",
+            "final_model_mb"]
+    print(f"{'run':<50} " + " ".join(f"{k:>18}" for k in keys))
+    for run_dir, fp in rows:
+        print(f"{run_dir:<50} " + " ".join(f"{str(fp.get(k)):>18}" for k in keys))
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge GRPO LoRA adapters / compare training footprints")
+    sub = parser.add_subparsers(dest="command", required=True)
+    merge = sub.add_parser("merge", help="Merge an adapter checkpoint into its base model")
+    merge.add_argument("adapter_dir", type=str)
+    merge.add_argument("output_dir", type=str)
+    merge.add_argument("--dtype", choices=["float32", "bfloat16", "float16"], default="float32", help="Precision of the exported weights")
+    compare = sub.add_parser("compare", help="Print footprint.json of several runs side by side")
+    compare.add_argument("run_dirs", type=str, nargs="+")
+    return parser.parse_args()
+
+
+def main(args):
+    if args.command == "merge":
+        merge_and_export(args.adapter_dir, args.output_dir, getattr(torch, args.dtype))
+    else:
+        compare_footprints(args.run_dirs)
+
+
+if __name__ == "__main__":
+    main(parse_args())
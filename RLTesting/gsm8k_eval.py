@@ -0,0 +1,216 @@
+"""Offline GSM8K evaluation with batched greedy decoding.
+
+Reads the GSM8K test split from a local file, either the official `test.jsonl`
+(question / answer with the "#### <number>" suffix) or a .parquet / .arrow
+export of it. Prompts use the same system prompt and chat template as the
+GRPO training in test.py. Answers are extracted with `extract_xml_answer`.
+
+Examples are split into contiguous shards across `--workers` CPU processes
+(spawn). Each worker loads its own model copy and uses `--threads` intra-op
+threads. `--workers 0` runs in-process on `--device`. Within a shard, prompts
+are sorted by token length before batching so that padding stays small.
+
+Reported: exact-match accuracy, format compliance (the strict and soft regexes
+from the rewards), generated tokens/sec, and latency percentiles per batch and
+per example. `--output` writes one JSON line per example.
+
+Usage:
+  python gsm8k_eval.py --model-path outputs/gpt2-GRPO-gsm8k-rtx3080 --data-file gsm8k/test.jsonl --workers 4
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from gsm8k_rewards import ensure_chat_template, extract_hash_answer, gsm8k_prompt, parse_completion
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def load_gsm8k_file(path, limit=None):
+    """[{index, question, answer}] from a local GSM8K file; rows without a "####" answer are skipped."""
+    if path.endswith((".jsonl", ".json")):
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        from datasets import Dataset
+        ds = Dataset.from_file(path) if path.endswith(".arrow") else Dataset.from_parquet(path)
+        rows = ds.select_columns(["question", "answer"]).to_list()
+    examples = []
+    for row in rows:
+        if limit is not None and len(examples) >= limit:
+            break
+        answer = extract_hash_answer(row["answer"])
+        if answer is None:
+            continue
+        examples.append({"index": len(examples), "question": row["question"], "answer": answer})
+    return examples
+
+
+def load_eval_model(model_path, device):
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    ensure_chat_template(tokenizer)
+    model = AutoModelForCausalLM.from_pretrained(model_path, low_cpu_mem_usage=True).to(device)
+    model.eval()
+    return model, tokenizer
+
+
+def evaluate_examples(model, tokenizer, examples, batch_size=16, max_new_tokens=256):
+    """Greedy-decode `examples` in length-sorted batches; returns (per-example results, per-batch timings)."""
+    device = next(model.parameters()).device
+    context = getattr(model.config, "n_positions", None) or getattr(model.config, "max_position_embeddings", 1024)
+    max_prompt = context - max_new_tokens
+    prompt_ids = []
+    for ex in examples:
+        text = tokenizer.apply_chat_template(gsm8k_prompt(ex["question"]), tokenize=False, add_generation_prompt=True)
+        # keep the end of over-long prompts: the question sits after the system prompt
+        prompt_ids.append(tokenizer(text).input_ids[-max_prompt:])
+    order = sorted(range(len(examples)), key=lambda i: len(prompt_ids[i]))
+
+    results, batches = [], []
+    for start in range(0, len(order), batch_size):
+        rows = order[start:start + batch_size]
+        enc = tokenizer.pad({"input_ids": [prompt_ids[i] for i in rows]}, return_tensors="pt").to(device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        with torch.no_grad():
+            output = model.generate(**enc, max_new_tokens=max_new_tokens, do_sample=False,
+                                    pad_token_id=tokenizer.pad_token_id)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - t0
+        new_tokens = output[:, enc["input_ids"].shape[1]:]
+        texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        generated = 0
+        for row, i in enumerate(rows):
+            ids = new_tokens[row].tolist()
+            # count up to and including the first EOS; the rest is batch padding
+            n = ids.index(tokenizer.eos_token_id) + 1 if tokenizer.eos_token_id in ids else len(ids)
+            generated += n
+            parsed = parse_completion(texts[row])
+            ex = examples[i]
+            results.append({
+                "index": ex["index"],
+                "answer": ex["answer"],
+                "extracted": parsed.answer,
+                "correct": parsed.answer == ex["answer"],
+                "strict_format": parsed.strict_format,
+                "soft_format": parsed.soft_format,
+                "prompt_tokens": len(prompt_ids[i]),
+                "new_tokens": n,
+                "latency_s": elapsed,
+                "completion": texts[row],
+            })
+        batches.append({"size": len(rows), "latency_s": elapsed, "new_tokens": generated})
+    return results, batches
+
+
+# -- CPU worker processes -------------------------------------------------------
+
+_worker_model = None
+_worker_tokenizer = None
+
+
+def _worker_init(model_path, threads):
+    global _worker_model, _worker_tokenizer
+    torch.set_num_threads(threads)
+    _worker_model, _worker_tokenizer = load_eval_model(model_path, torch.device("cpu"))
+
+
+def _worker_run(job):
+    examples, batch_size, max_new_tokens = job
+    return evaluate_examples(_worker_model, _worker_tokenizer, examples, batch_size, max_new_tokens)
+
+
+def summarize(results, batches, wall_s):
+    n = len(results) or 1
+    new_tokens = sum(b["new_tokens"] for b in batches)
+    batch_latency = [b["latency_s"] for b in batches]
+    example_latency = [b["latency_s"] / b["size"] for b in batches for _ in range(b["size"])]
+    def ms(v):
+        return None if v is None else round(v * 1000, 1)
+    return {
+        "examples": len(results),
+        "accuracy": round(sum(r["correct"] for r in results) / n, 4),
+        "strict_format_rate": round(sum(r["strict_format"] for r in results) / n, 4),
+        "soft_format_rate": round(sum(r["soft_format"] for r in results) / n, 4),
+        "empty_answer_rate": round(sum(not r["extracted"] for r in results) / n, 4),
+        "generated_tokens": new_tokens,
+        "wall_s": round(wall_s, 2),
+        "tokens_per_s": round(new_tokens / wall_s, 1) if wall_s else None,
+        "examples_per_s": round(len(results) / wall_s, 2) if wall_s else None,
+        "batch_latency_ms": {f"p{q}": ms(_percentile(batch_latency, q)) for q in (50, 90, 99)},
+        "example_latency_ms": {f"p{q}": ms(_percentile(example_latency, q)) for q in (50, 90, 99)},
+    }
+
+
+def run_eval(model_path, examples, batch_size=16, max_new_tokens=256, workers=0, threads=None, device=None):
+    """Evaluate in-process (workers=0) or sharded over CPU worker processes; returns (summary, results)."""
+    if not examples:
+        return summarize([], [], 0.0), []
+    start = time.perf_counter()
+    if workers <= 0:
+        device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+        model, tokenizer = load_eval_model(model_path, device)
+        start = time.perf_counter()
+        results, batches = evaluate_examples(model, tokenizer, examples, batch_size, max_new_tokens)
+    else:
+        threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        shard = -(-len(examples) // workers)
+        jobs = [(examples[i:i + shard], batch_size, max_new_tokens) for i in range(0, len(examples), shard)]
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(jobs), mp_context=ctx,
+                                 initializer=_worker_init, initargs=(model_path, threads)) as pool:
+            results, batches = [], []
+            for part_results, part_batches in pool.map(_worker_run, jobs):
+                results.extend(part_results)
+                batches.extend(part_batches)
+    wall_s = time.perf_counter() - start
+    results.sort(key=lambda r: r["index"])
+    return summarize(results, batches, wall_s), results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline GSM8K accuracy / throughput evaluation")
+    parser.add_argument("--model-path", type=str, required=True, help="Checkpoint to evaluate (e.g. the test.py output dir)")
+    parser.add_argument("--data-file", type=str, required=True, help="Local GSM8K test split (.jsonl, .parquet or .arrow)")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate only the first N examples")
+    parser.add_argument("--batch-size", type=int, default=16, help="Prompts per greedy generate call")
+    parser.add_argument("--max-new-tokens", type=int, default=256, help="Generation budget per example")
+    parser.add_argument("--workers", type=int, default=0, help="CPU worker processes (0 = in-process on --device)")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads per worker (default: cores / workers)")
+    parser.add_argument("--device", type=str, default=None, help="Device for in-process eval (default: cuda if available)")
+    parser.add_argument("--output", type=str, default=None, help="Write per-example results as JSONL here")
+    return parser.parse_args()
+
+
+def main(args):
+    examples = load_gsm8k_file(args.data_file, args.limit)
+    print(f"Evaluating {args.model_path} on {len(examples)} GSM8K examples "
+          f"({'in-process' if args.workers <= 0 else f'{args.workers} CPU workers'}, batch {args.batch_size})")
+    summary, results = run_eval(args.model_path, examples, args.batch_size, args.max_new_tokens,
+                                args.workers, args.threads, args.device)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    main(parse_args())
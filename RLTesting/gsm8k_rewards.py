@@ -0,0 +1,257 @@
+"""GSM8K prompt format, answer extraction and GRPO reward functions for test.py and gsm8k_eval.py.
+
+The five `*_reward_func` functions are the reference implementations. Each one
+re-reads `completion[0]['content']` and re-runs its own extraction or regex.
+`FusedGSM8KRewards` parses every completion once into a `ParsedCompletion`
+(tag counts, extracted answer, format-match flags, trailing text) and computes
+all five rewards from those structs in a single pass. Its `reward_funcs` keep
+the original function names, so GRPOTrainer logs `rewards/<name>` exactly as
+before, and they return the same values bit for bit (`verify=True` re-runs
+the reference functions on every batch and warns on any difference).
+"""
+import contextlib
+import io
+import re
+from typing import NamedTuple
+
+SYSTEM_PROMPT = """
+Respond in the following format:
+
+<reasoning>
+...
+</reasoning>
+<answer>
+...
+</answer>
+"""
+
+XML_COT_FORMAT = """\
+<reasoning>
+{reasoning}
+</reasoning>
+<answer>
+{answer}
+</answer>
+"""
+
+# Minimal template for tokenizers without one (GPT-2): just concatenate the messages
+GPT2_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}System: {{ message['content'] }}\n"
+    "{% elif message['role'] == 'user' %}User: {{ message['content'] }}\n"
+    "{% elif message['role'] == 'assistant' %}Assistant: {{ message['content'] }}\n"
+    "{% endif %}"
+    "{% endfor %}"
+)
+
+def ensure_chat_template(tokenizer):
+    if not hasattr(tokenizer, "chat_template") or tokenizer.chat_template is None:
+        tokenizer.chat_template = GPT2_CHAT_TEMPLATE
+    return tokenizer
+
+def gsm8k_prompt(question: str) -> list[dict]:
+    # Note: Base GPT-2 might struggle with system prompts and complex formatting.
+    # Consider simplifying if results are poor.
+    return [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': question}
+    ]
+
+def extract_xml_answer(text: str) -> str:
+    # Make extraction more robust in case of missing tags or extra content
+    answer_parts = text.split("<answer>")
+    if len(answer_parts) > 1:
+        answer = answer_parts[-1].split("</answer>")[0]
+        return answer.strip()
+    return "" # Return empty string if tag not found
+
+def extract_hash_answer(text: str) -> str | None:
+    if "####" not in text:
+        return None
+    return text.split("####")[1].strip().replace(",", "").replace("$", "")
+
+# --- Reward Functions (Unchanged Logic, Added Robustness) ---
+
+def correctness_reward_func(prompts, completions, answer, **kwargs) -> list[float]:
+    responses = [completion[0]['content'] for completion in completions]
+    q = prompts[0][-1]['content'] if prompts and prompts[0] else "Unknown Question"
+    extracted_responses = [extract_xml_answer(r) for r in responses]
+    # Handle potential None answers from dataset preprocessing if filtering wasn't done
+    valid_answers = [a for a in answer if a is not None]
+    if not valid_answers: return [0.0] * len(extracted_responses) # Or handle as error
+
+    # Simple print, avoid overwhelming console if num_generations is high
+    if len(responses) > 0:
+         print('-'*20, f"\nQ: {q[:100]}...", f"\nA: {valid_answers[0]}", f"\nR: {responses[0][:150]}...", f"\nExtracted: {extracted_responses[0]}")
+
+    # Ensure comparison happens correctly, handle cases where extraction fails
+    rewards = []
+    for r_extr, a_true in zip(extracted_responses, valid_answers):
+        if r_extr == a_true:
+            rewards.append(2.0)
+        # Optional: Penalize empty extraction slightly less than wrong answer?
+        # elif r_extr == "":
+        #     rewards.append(-0.1) # Example penalty
+        else:
+            rewards.append(0.0) # Or a negative reward, e.g., -0.5
+    return rewards
+
+def int_reward_func(completions, **kwargs) -> list[float]:
+    responses = [completion[0]['content'] for completion in completions]
+    extracted_responses = [extract_xml_answer(r) for r in responses]
+    # Check if extracted string consists ONLY of digits (potentially with a sign)
+    return [0.5 if r and r.lstrip('-').isdigit() else 0.0 for r in extracted_responses]
+
+def strict_format_reward_func(completions, **kwargs) -> list[float]:
+    pattern = r"^<reasoning>\s*.*?\s*</reasoning>\s*<answer>\s*.*?\s*</answer>\s*$" # Allow more whitespace flexibility
+    responses = [completion[0]["content"] for completion in completions]
+    matches = [re.match(pattern, r, flags=re.DOTALL) for r in responses]
+    return [0.5 if match else 0.0 for match in matches]
+
+def soft_format_reward_func(completions, **kwargs) -> list[float]:
+    pattern = r"<reasoning>.*?</reasoning>\s*<answer>.*?</answer>"
+    responses = [completion[0]["content"] for completion in completions]
+    # Use re.search to find the pattern anywhere, not just at the start
+    matches = [re.search(pattern, r, flags=re.DOTALL) for r in responses]
+    return [0.5 if match else 0.0 for match in matches]
+
+def count_xml(text) -> float:
+    count = 0.0
+    reasoning_open = text.count("<reasoning>")
+    reasoning_close = text.count("</reasoning>")
+    answer_open = text.count("<answer>")
+    answer_close = text.count("</answer>")
+
+    if reasoning_open == 1: count += 0.125
+    if reasoning_close == 1: count += 0.125
+    if answer_open == 1: count += 0.125
+    if answer_close == 1: count += 0.125
+
+    # Penalize content outside the final answer tag slightly
+    if answer_close == 1:
+        trailing_content = text.split("</answer>")[-1].strip()
+        count -= len(trailing_content) * 0.001
+
+    return max(0.0, count) # Ensure reward is not negative
+
+def xmlcount_reward_func(completions, **kwargs) -> list[float]:
+    contents = [completion[0]["content"] for completion in completions]
+    return [count_xml(c) for c in contents]
+
+
+# --- Fused single-pass reward engine ---
+
+STRICT_FORMAT_RE = re.compile(r"^<reasoning>\s*.*?\s*</reasoning>\s*<answer>\s*.*?\s*</answer>\s*$", flags=re.DOTALL)
+SOFT_FORMAT_RE = re.compile(r"<reasoning>.*?</reasoning>\s*<answer>.*?</answer>", flags=re.DOTALL)
+
+
+class ParsedCompletion(NamedTuple):
+    text: str
+    reasoning_open: int
+    reasoning_close: int
+    answer_open: int
+    answer_close: int
+    answer: str          # extract_xml_answer(text)
+    strict_format: bool
+    soft_format: bool
+    trailing: str        # stripped text after the last </answer> ("" unless exactly one)
+
+
+def parse_completion(text: str) -> ParsedCompletion:
+    answer_close = text.count("</answer>")
+    return ParsedCompletion(
+        text=text,
+        reasoning_open=text.count("<reasoning>"),
+        reasoning_close=text.count("</reasoning>"),
+        answer_open=text.count("<answer>"),
+        answer_close=answer_close,
+        answer=extract_xml_answer(text),
+        strict_format=STRICT_FORMAT_RE.match(text) is not None,
+        soft_format=SOFT_FORMAT_RE.search(text) is not None,
+        trailing=text.split("</answer>")[-1].strip() if answer_close == 1 else "",
+    )
+
+
+def _xml_score(p: ParsedCompletion) -> float:
+    # same operation order as count_xml, so the float result is identical
+    count = 0.0
+    if p.reasoning_open == 1: count += 0.125
+    if p.reasoning_close == 1: count += 0.125
+    if p.answer_open == 1: count += 0.125
+    if p.answer_close == 1: count += 0.125
+    if p.answer_close == 1:
+        count -= len(p.trailing) * 0.001
+    return max(0.0, count)
+
+
+class FusedGSM8KRewards:
+    """All five GSM8K rewards from one parse per completion.
+
+    GRPOTrainer calls every reward function in turn with the same `completions`
+    list, so the parse (and the four answer-independent rewards) is memoized on
+    that list's identity and reused by the remaining calls.
+    """
+
+    def __init__(self, verify=False):
+        self.verify = verify
+        self._completions = None
+        self._parsed = None
+        self._scores = None
+        self.reward_funcs = [
+            self.xmlcount_reward_func,
+            self.soft_format_reward_func,
+            self.strict_format_reward_func,
+            self.int_reward_func,
+            self.correctness_reward_func,
+        ]
+
+    def _batch(self, completions):
+        if completions is not self._completions:
+            parsed = [parse_completion(completion[0]["content"]) for completion in completions]
+            xmlcount, soft, strict, ints = [], [], [], []
+            for p in parsed:
+                xmlcount.append(_xml_score(p))
+                soft.append(0.5 if p.soft_format else 0.0)
+                strict.append(0.5 if p.strict_format else 0.0)
+                ints.append(0.5 if p.answer and p.answer.lstrip('-').isdigit() else 0.0)
+            # keep a reference so the identity check can't match a recycled id
+            self._completions = completions
+            self._parsed = parsed
+            self._scores = {"xmlcount": xmlcount, "soft": soft, "strict": strict, "int": ints}
+        return self._parsed, self._scores
+
+    def _check(self, name, fused, reference_fn, *args, **kwargs):
+        if self.verify:
+            with contextlib.redirect_stdout(io.StringIO()):
+                reference = reference_fn(*args, **kwargs)
+            if reference != fused:
+                print(f"[GSM8K Rewards] Warning: fused {name} differs from the reference: {fused} vs {reference}")
+        return fused
+
+    def xmlcount_reward_func(self, completions, **kwargs) -> list[float]:
+        _, scores = self._batch(completions)
+        return self._check("xmlcount", list(scores["xmlcount"]), xmlcount_reward_func, completions)
+
+    def soft_format_reward_func(self, completions, **kwargs) -> list[float]:
+        _, scores = self._batch(completions)
+        return self._check("soft_format", list(scores["soft"]), soft_format_reward_func, completions)
+
+    def strict_format_reward_func(self, completions, **kwargs) -> list[float]:
+        _, scores = self._batch(completions)
+        return self._check("strict_format", list(scores["strict"]), strict_format_reward_func, completions)
+
+    def int_reward_func(self, completions, **kwargs) -> list[float]:
+        _, scores = self._batch(completions)
+        return self._check("int", list(scores["int"]), int_reward_func, completions)
+
+    def correctness_reward_func(self, prompts, completions, answer, **kwargs) -> list[float]:
+        parsed, _ = self._batch(completions)
+        q = prompts[0][-1]['content'] if prompts and prompts[0] else "Unknown Question"
+        valid_answers = [a for a in answer if a is not None]
+        if not valid_answers:
+            return self._check("correctness", [0.0] * len(parsed), correctness_reward_func, prompts, completions, answer)
+        if len(parsed) > 0:
+            print('-'*20, f"\nQ: {q[:100]}...", f"\nA: {valid_answers[0]}", f"\nR: {parsed[0].text[:150]}...", f"\nExtracted: {parsed[0].answer}")
+        # zip truncates to the shorter list, exactly like the reference
+        rewards = [2.0 if p.answer == a_true else 0.0 for p, a_true in zip(parsed, valid_answers)]
+        return self._check("correctness", rewards, correctness_reward_func, prompts, completions, answer)
@@ -1,82 +1,215 @@
 import json
 import argparse
 import os
+import time
 
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from record_sink import rotated_paths
 
-def load_metrics(log_path):
-    """Load JSONL metrics into a pandas DataFrame."""
-    records = []
-    with open(log_path, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
+
+class MetricsTail:
+    """Incremental metrics.jsonl reader: each `poll()` parses only the bytes added since the last one.
+
+    Rotated segments (metrics.00001.jsonl, ...) are read first, oldest first.
+    Offsets are keyed by file identity, so a file keeps its offset when the sink
+    renames it into a segment. A trailing line without its newline is left for
+    the next poll, because it may still be being written.
+    """
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.offsets = {}
+        self.records = []
+
+    def poll(self):
+        """Parse new lines; returns the number of new records."""
+        new = 0
+        for path in rotated_paths(self.log_path):
             try:
-                rec = json.loads(line)
-                records.append(rec)
-            except json.JSONDecodeError:
+                st = os.stat(path)
+            except FileNotFoundError:  # rotated between listing and stat
+                continue
+            key = (st.st_dev, st.st_ino)
+            offset = self.offsets.get(key, 0)
+            if st.st_size < offset:  # truncated / replaced: start over
+                offset = 0
+            if st.st_size == offset:
                 continue
-    return pd.DataFrame(records)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self.records.append(json.loads(line))
+                    new += 1
+                except json.JSONDecodeError:
+                    continue
+            self.offsets[key] = offset + end
+        return new
+
+    def frame(self):
+        return pd.DataFrame(self.records)
 
 
-def plot_metric(df, x, y, ax, label=None):
-    ax.plot(df[x], df[y], marker='o', label=label or y)
-    ax.set_xlabel(x)
-    ax.set_ylabel(y)
-    ax.grid(True)
+def load_metrics(log_path):
+    """Load JSONL metrics (including rotated segments) into a pandas DataFrame."""
+    tail = MetricsTail(log_path)
+    tail.poll()
+    return tail.frame()
+
+
+# ---------------------------------------------------------------------------
+# Downsampling
+# ---------------------------------------------------------------------------
+
+def lttb(x, y, n):
+    """Largest-Triangle-Three-Buckets: indices of `n` points that keep the visual shape of (x, y)."""
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    idx = np.zeros(n, dtype=np.int64)
+    idx[-1] = size - 1
+    # n - 2 buckets between the fixed first and last points
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    a = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (size - 1, size)
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def minmax(x, y, n):
+    """Keep the min and max of each of n / 2 equal-count buckets (preserves spikes exactly)."""
+    size = len(x)
+    if n >= size or n < 4:
+        return np.arange(size)
+    edges = np.linspace(0, size, n // 2 + 1).astype(np.int64)
+    keep = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if hi <= lo:
+            continue
+        seg = y[lo:hi]
+        keep.extend(sorted({lo + int(np.argmin(seg)), lo + int(np.argmax(seg))}))
+    return np.asarray(keep, dtype=np.int64)
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Plot PPO training metrics from JSONL logs.")
-    parser.add_argument("--log-file", type=str, default="logs_500_v2/metrics.jsonl", help="Path to metrics.jsonl file")
-    parser.add_argument("--output-dir", type=str, default="logs_500_v2/plots", help="Directory to save plots")
-    args = parser.parse_args()
+DOWNSAMPLERS = {'lttb': lttb, 'minmax': minmax}
 
-    os.makedirs(args.output_dir, exist_ok=True)
-    df = load_metrics(args.log_file)
 
+def prepare(df):
     # Ensure sorted by episode or epoch
-    df = df.sort_values(by=['episode', 'epoch'])
+    order = [c for c in ('episode', 'epoch') if c in df.columns]
+    if order:
+        df = df.sort_values(by=order)
 
     # Rename some columns to simpler names
-    df.rename(columns={
+    return df.rename(columns={
         'objective/rlhf_reward': 'rlhf_reward',
         'objective/kl': 'kl',
         'objective/entropy': 'entropy',
         'loss/policy_avg': 'policy_loss',
         'loss/value_avg': 'value_loss'
-    }, inplace=True)
-
-    # Map display names to DataFrame columns
-    plots = [
-        ('RLHF Reward', 'rlhf_reward'),
-        ('Yap Score', 'yap_score'),
-        ('Raw Reward', 'raw_reward'),
-        ('KL Divergence', 'kl'),
-        ('Entropy', 'entropy'),
-        ('Policy Loss', 'policy_loss'),
-        ('Value Loss', 'value_loss'),
-    ]
+    })
 
-    # Create subplots
-    n = len(plots)
-    fig, axes = plt.subplots(n, 1, figsize=(8, 3*n), sharex=True)
 
-    for ax, (label, col) in zip(axes, plots):
-        if col not in df.columns:
-            print(f"Warning: column '{col}' not found; skipping {label}")
+def plot_metric(df, x, y, ax, label=None, max_points=None, method='lttb'):
+    series = df[[x, y]].apply(pd.to_numeric, errors='coerce').dropna()
+    xs, ys = series[x].to_numpy(dtype=float), series[y].to_numpy(dtype=float)
+    if max_points and method in DOWNSAMPLERS and len(xs) > max_points:
+        idx = DOWNSAMPLERS[method](xs, ys, max_points)
+        xs, ys = xs[idx], ys[idx]
+    # markers only while individual points are still distinguishable
+    ax.plot(xs, ys, marker='o' if len(xs) <= 200 else None, label=label or y)
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+    ax.grid(True)
+
+
+# Map display names to DataFrame columns
+PLOTS = [
+    ('RLHF Reward', 'rlhf_reward'),
+    ('Yap Score', 'yap_score'),
+    ('Raw Reward', 'raw_reward'),
+    ('KL Divergence', 'kl'),
+    ('Entropy', 'entropy'),
+    ('Policy Loss', 'policy_loss'),
+    ('Value Loss', 'value_loss'),
+]
+
+
+def draw(fig, axes, df, args, warn=True):
+    df = prepare(df)
+    for ax, (label, col) in zip(axes, PLOTS):
+        ax.cla()
+        if col not in df.columns or 'episode' not in df.columns:
+            if warn:
+                print(f"Warning: column '{col}' not found; skipping {label}")
             continue
-        plot_metric(df, 'episode', col, ax, label=label)
+        plot_metric(df, 'episode', col, ax, label=label, max_points=args.max_points, method=args.downsample)
         ax.legend()
+    fig.tight_layout()
+
+
+def follow(tail, fig, axes, args, out_path):
+    """Redraw (and re-save) the figure whenever new lines arrive; Ctrl-C stops."""
+    interactive = plt.get_backend().lower() != 'agg'
+    if interactive:
+        plt.ion()
+        plt.show(block=False)
+    print(f"Following {args.log_file} every {args.interval}s (Ctrl-C to stop)")
+    try:
+        while True:
+            if tail.poll():
+                draw(fig, axes, tail.frame(), args, warn=False)
+                fig.savefig(out_path)
+                print(f"{len(tail.records)} records -> {out_path}")
+            if interactive:
+                plt.pause(args.interval)
+            else:
+                time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plot PPO training metrics from JSONL logs.")
+    parser.add_argument("--log-file", type=str, default="logs_500_v2/metrics.jsonl", help="Path to metrics.jsonl file")
+    parser.add_argument("--output-dir", type=str, default="logs_500_v2/plots", help="Directory to save plots")
+    parser.add_argument("--max-points", type=int, default=2000, help="Downsample each curve to about this many points")
+    parser.add_argument("--downsample", choices=["lttb", "minmax", "none"], default="lttb", help="Downsampling method")
+    parser.add_argument("--follow", action="store_true", help="Keep reading new lines and redraw as the run progresses")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between polls in --follow mode")
+    args = parser.parse_args()
 
-    plt.tight_layout()
+    os.makedirs(args.output_dir, exist_ok=True)
+    tail = MetricsTail(args.log_file)
+    tail.poll()
+
+    # Create subplots
+    n = len(PLOTS)
+    fig, axes = plt.subplots(n, 1, figsize=(8, 3*n), sharex=True)
     out_path = os.path.join(args.output_dir, "ppo_metrics.png")
-    fig.savefig(out_path)
-    print(f"Saved plots to {out_path}")
+
+    if tail.records:
+        draw(fig, axes, tail.frame(), args)
+        fig.savefig(out_path)
+        print(f"Saved plots to {out_path}")
+    elif not args.follow:
+        print(f"No metrics records in {args.log_file}")
+    if args.follow:
+        follow(tail, fig, axes, args, out_path)
 
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -4,6 +4,8 @@ subset. The script patches all mismatches between TRL’s current PPOTrainer
 and the value‑head wrapper so it runs end‑to‑end.
 """
 
+import os
+
 import torch
 import torch.nn as nn
 from datasets import load_dataset
@@ -101,11 +103,16 @@ for p in ref.parameters():
 # Dataset (tiny IMDB subset)
 # ---------------------------------------------------------------------------
 
-ds = load_dataset("imdb", split="train[:100]").map(
-    lambda x: tok(x["text"], truncation=True, max_length=128),
-    batched=True,
-    remove_columns=["text"],
-)
+if os.environ.get("IMDB_FILE"):
+    # local JSONL/Parquet export, tokenized once into a memory-mapped Arrow cache
+    from rl_datasets import text_dataset
+    ds = text_dataset(os.environ["IMDB_FILE"], tok, max_length=128, limit=100)
+else:
+    ds = load_dataset("imdb", split="train[:100]").map(
+        lambda x: tok(x["text"], truncation=True, max_length=128),
+        batched=True,
+        remove_columns=["text"],
+    )
 
 # ---------------------------------------------------------------------------
 # PPO configuration
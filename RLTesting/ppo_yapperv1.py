@@ -5,11 +5,19 @@ from transformers import GPT2Tokenizer, GPT2Model
 import torch
 import torch.nn as nn
 from datasets import Dataset
+from record_sink import MetricsSink, load_prompt_shards
+from reward_telemetry import RewardTelemetry
 from transformers import (
+    AutoConfig,
     AutoTokenizer,
     AutoModelForCausalLM,
     GenerationConfig,
     DataCollatorWithPadding,
+    DynamicCache,
+    LogitsProcessorList,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
 from trl import AutoModelForCausalLMWithValueHead, PPOConfig, PPOTrainer
 from trl.trainer.utils import SIMPLE_CHAT_TEMPLATE
@@ -19,8 +27,12 @@ import os
 import json
 from transformers.trainer_callback import TrainerCallback
 import math
+import multiprocessing
 import re
+import resource
+import time
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import spacy
 
 # ---------------------------------------------------------------------------
@@ -47,34 +59,44 @@ class ZeroBackbone(nn.Module):
 class RewardFromFunction(nn.Module):
     base_model_prefix = "pretrained_model"
 
-    def __init__(self, fn, tok):
+    def __init__(self, fn, tok, features_fn=None, telemetry=None):
         super().__init__()
         self.score_fn = fn
         self.tok = tok # Need tokenizer for decoding
+        # optional batched feature extraction; scores then come from fn(text, features=f)
+        self.features_fn = features_fn
+        # RewardTelemetry: aggregated per-batch stats instead of printing every text
+        self.telemetry = telemetry
         self.pretrained_model = ZeroBackbone()
         # store last decoded texts for debugging in score()
         self._last_texts = None
 
+    def _score_texts(self, texts, source, start):
+        features = self.features_fn(texts) if self.features_fn is not None else None
+        if features is not None:
+            scores = [float(self.score_fn(text, features=f)) for text, f in zip(texts, features)]
+        else:
+            scores = [float(self.score_fn(text)) for text in texts]
+        if self.telemetry is not None:
+            self.telemetry.record_batch(texts, scores, features, time.perf_counter() - start, source)
+        return scores
+
     def score(self, hidden_states):
+        start = time.perf_counter()
         # Decode token IDs from hidden_states to get actual sequences
         b, s, _ = hidden_states.shape
         # hidden_states stores input_ids via backbone; extract and decode
         input_ids = hidden_states.squeeze(-1).long()
         decoded_texts = self.tok.batch_decode(input_ids, skip_special_tokens=True)
-        # debug: print each decoded text snippet and word count
-        for txt in decoded_texts:
-            snippet = ' '.join(txt.split()[:20])
-            print(f"[ScoreDebug] text_snippet='{snippet}...', word_count={len(txt.split())}", flush=True)
         # Compute raw sequence scores
-        raw_scores = [float(self.score_fn(text)) for text in decoded_texts]
-        # debug: print raw sequence scores
-        print(f"[ScoreDebug] raw_scores={raw_scores}", flush=True)
+        raw_scores = self._score_texts(decoded_texts, "score", start)
         # Build per-position scores by repeating each sequence score s times
         scores_matrix = [[score] * s for score in raw_scores]
         scores = torch.tensor(scores_matrix, dtype=torch.bfloat16, device=hidden_states.device)
         return scores.unsqueeze(-1)
 
     def forward(self, input_ids=None, attention_mask=None, **kwargs):
+        start = time.perf_counter()
         # Decode input_ids to text, handling padding
         decoded_texts = self.tok.batch_decode(input_ids, skip_special_tokens=True)
         # store decoded texts for score() debugging
@@ -82,10 +104,7 @@ class RewardFromFunction(nn.Module):
         # ignore incoming attention_mask to avoid indexing issues
         attention_mask = None
         # Calculate scalar scores for each sequence
-        scores_list = [float(self.score_fn(text)) for text in decoded_texts]
-        # debug: print raw rewards for each decoded text
-        for txt, scr in zip(decoded_texts, scores_list):
-            print(f"[RewardDebug] score={scr:.4f} | text={txt}", flush=True)
+        scores_list = self._score_texts(decoded_texts, "forward", start)
         scores_tensor = torch.tensor(scores_list, dtype=torch.bfloat16, device=input_ids.device)
         # Build full reward tensor of shape (batch_size, seq_len, 1)
         batch_size, seq_len = input_ids.shape
@@ -116,6 +135,14 @@ class GPT2WithValueHead(AutoModelForCausalLMWithValueHead):
 # Yapper training prompts
 # ---------------------------------------------------------------------------
 
+YAP_PROMPTS = [
+    "Hey, what's on your mind today?",
+    "What do you think about AI art?",
+    "Tell me something weird you believe.",
+    "How would you start an argument about pineapple on pizza?",
+    "Say something totally unhinged but kinda true.",
+]
+
 # ---------------------------------------------------------------------------
 # PPO configuration
 # ---------------------------------------------------------------------------
@@ -123,13 +150,13 @@ class GPT2WithValueHead(AutoModelForCausalLMWithValueHead):
 # ---------------------------------------------------------------------------
 # Callback to save training logs to a JSONL file
 class SaveMetricsCallback(TrainerCallback):
-    """Callback to save PPOTrainer logs to `log_dir/metrics.jsonl`."""
-    def __init__(self, output_dir):
+    """Callback to save PPOTrainer logs to `log_dir/metrics.jsonl` (appends, so resumed runs keep their history)."""
+    def __init__(self, output_dir, parquet=False, max_mb=64):
         super().__init__()
         self.log_file = os.path.join(output_dir, "metrics.jsonl")
-        # Clear previous log
-        with open(self.log_file, "w") as f:
-            pass
+        # buffered, flushed from a background thread, rotated past `max_mb`
+        self.sink = MetricsSink(self.log_file, os.path.join(output_dir, "metrics.parquet") if parquet else None,
+                                max_bytes=max_mb * 2**20)
 
     def on_log(self, args, state, control, logs=None, **kwargs):
         if logs is None:
@@ -140,28 +167,221 @@ class SaveMetricsCallback(TrainerCallback):
             logs["raw_reward"] = logs["objective/non_score_reward"]
         if "objective/scores" in logs:
             logs["yap_score"] = logs["objective/scores"]
-        # Append logs as JSON line
-        with open(self.log_file, "a") as f:
-            f.write(json.dumps(logs) + "\n")
+        self.sink.log(logs)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self.sink.close()
 
 # ---------------------------------------------------------------------------
 # Trainer and training loop
 # ---------------------------------------------------------------------------
 
+# ---------------------------------------------------------------------------
+# Rolling KV cache helpers for long generation
+# ---------------------------------------------------------------------------
+
+def _cache_seq_len(past_key_values):
+    if past_key_values is None:
+        return 0
+    if hasattr(past_key_values, "get_seq_length"):
+        return past_key_values.get_seq_length()
+    return past_key_values[0][0].shape[2]
+
+
+def _crop_cache(past_key_values, max_length):
+    """Drop cached positions beyond `max_length` (rolls back rejected speculative tokens)."""
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(max_length)
+        return past_key_values
+    return tuple((k[:, :, :max_length], v[:, :, :max_length]) for k, v, *_ in past_key_values)
+
+
+def _forward_uncached(model, ids, past_key_values):
+    """Run `model` on the part of `ids` not yet in the cache; returns (logits, cache)."""
+    new_ids = ids[:, _cache_seq_len(past_key_values):]
+    out = model(input_ids=new_ids, past_key_values=past_key_values, use_cache=True)
+    return out.logits, out.past_key_values
+
+
+def _sampling_processors(gen_kwargs):
+    """Logits warpers matching the temperature/top-k/top-p that `generate` would apply."""
+    procs = LogitsProcessorList()
+    if gen_kwargs.get("temperature") is not None and gen_kwargs["temperature"] != 1.0:
+        procs.append(TemperatureLogitsWarper(gen_kwargs["temperature"]))
+    if gen_kwargs.get("top_k"):
+        procs.append(TopKLogitsWarper(gen_kwargs["top_k"]))
+    if gen_kwargs.get("top_p") is not None and gen_kwargs["top_p"] < 1.0:
+        procs.append(TopPLogitsWarper(gen_kwargs["top_p"]))
+    return procs
+
+
+# ---------------------------------------------------------------------------
+# Lean inference loader for trained checkpoints
+# ---------------------------------------------------------------------------
+
+_WRAPPER_PREFIX = "pretrained_model."
+# written by export_yapper.py next to an optimized CPU artifact
+EXPORT_MANIFEST = "yapper_export.json"
+EXPORT_LAYOUTS = ("onnx", "torch-int8")
+_WEIGHT_FILES = ("model.safetensors", "model.safetensors.index.json", "pytorch_model.bin", "pytorch_model.bin.index.json")
+
+
+def _rss_mb():
+    """Current resident set size in MB (falls back to peak RSS off Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _weight_files(model_path):
+    """Weight shards of a local checkpoint directory (empty for hub names)."""
+    for name in _WEIGHT_FILES:
+        path = os.path.join(model_path, name)
+        if not os.path.isfile(path):
+            continue
+        if name.endswith(".index.json"):
+            with open(path) as f:
+                shards = sorted(set(json.load(f)["weight_map"].values()))
+            return [os.path.join(model_path, shard) for shard in shards]
+        return [path]
+    return []
+
+
+def _iter_checkpoint_tensors(files, keys_only=False):
+    """Yield (name, tensor) from safetensors/bin shards; both are memory-mapped, not read into RAM."""
+    for path in files:
+        if path.endswith(".safetensors"):
+            from safetensors import safe_open
+            with safe_open(path, framework="pt", device="cpu") as f:
+                for key in f.keys():
+                    yield key, None if keys_only else f.get_tensor(key)
+        else:
+            state = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+            for key, tensor in state.items():
+                yield key, tensor
+
+
+def _conv1d_to_linear(module):
+    """Swap GPT-2's `Conv1D` layers for equivalent `nn.Linear` so dynamic quantization picks them up."""
+    from transformers.pytorch_utils import Conv1D
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            n_in, n_out = child.weight.shape
+            linear = nn.Linear(n_in, n_out)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+    return module
+
+
+def quantize_int8_cpu(model):
+    """Dynamic int8 quantization of every Linear (incl. GPT-2 Conv1D and the LM head) for CPU inference."""
+    model = _conv1d_to_linear(model.float().cpu().eval())
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def _load_exported(model_path, manifest):
+    if manifest["format"] == "onnx":
+        from optimum.onnxruntime import ORTModelForCausalLM
+        return ORTModelForCausalLM.from_pretrained(model_path, file_name=manifest["file"], use_cache=True)
+    # torch-int8: rebuild the quantized module tree, then fill it from the saved state dict
+    config = AutoConfig.from_pretrained(model_path)
+    model = quantize_int8_cpu(AutoModelForCausalLM.from_config(config))
+    # packed int8 params are not plain tensors; this is our own artifact, so a full unpickle is fine
+    model.load_state_dict(torch.load(os.path.join(model_path, manifest["file"]), map_location="cpu", weights_only=False))
+    return model
+
+
+def detect_checkpoint_layout(model_path):
+    """Classify a checkpoint by its weight names without loading any tensors.
+
+    "hub"        not a local directory; resolved by `from_pretrained`
+    "causal_lm"  plain causal LM weights
+    "value_head" causal LM weights plus TRL `v_head.*` entries
+    "prefixed"   the whole value-head wrapper state dict (`pretrained_model.*` keys)
+    "onnx" / "torch-int8"  CPU artifact written by export_yapper.py
+    """
+    manifest_path = os.path.join(model_path, EXPORT_MANIFEST)
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        return manifest["format"], [os.path.join(model_path, name) for name in manifest["files"]]
+    files = _weight_files(model_path) if os.path.isdir(model_path) else []
+    if not files:
+        return "hub", files
+    keys = [k for k, _ in _iter_checkpoint_tensors(files, keys_only=True)]
+    if any(k.startswith(_WRAPPER_PREFIX) for k in keys):
+        return "prefixed", files
+    if any(k.startswith("v_head.") for k in keys):
+        return "value_head", files
+    return "causal_lm", files
+
+
+def load_causal_lm(model_path, device=None, dtype=None):
+    """Load only the causal-LM weights of a (possibly TRL-wrapped) checkpoint for inference.
+
+    Uses low-CPU-memory (meta-device) init and memory-mapped weights; value-head
+    tensors are never materialised. Returns (model, info) where info holds the
+    detected layout, load time and resident/parameter sizes in MB.
+    """
+    start, rss_before = time.perf_counter(), _rss_mb()
+    layout, files = detect_checkpoint_layout(model_path)
+    kwargs = {"torch_dtype": dtype, "low_cpu_mem_usage": True}
+    if layout in EXPORT_LAYOUTS:
+        with open(os.path.join(model_path, EXPORT_MANIFEST)) as f:
+            model = _load_exported(model_path, json.load(f))
+    elif layout == "prefixed":
+        state_dict = {
+            k[len(_WRAPPER_PREFIX):]: t
+            for k, t in _iter_checkpoint_tensors(files)
+            if k.startswith(_WRAPPER_PREFIX)
+        }
+        config = AutoConfig.from_pretrained(model_path)
+        model = AutoModelForCausalLM.from_pretrained(None, config=config, state_dict=state_dict, **kwargs)
+    else:
+        # from_pretrained drops unexpected v_head.* keys on its own
+        model = AutoModelForCausalLM.from_pretrained(model_path, **kwargs)
+    if layout in EXPORT_LAYOUTS:
+        # exported artifacts are CPU-only; their weights live in the exported files
+        dtype_name = "int8" if "int8" in layout or any("quantized" in f for f in files) else layout
+        param_mb = sum(os.path.getsize(f) for f in files) / 2**20
+    else:
+        model.to(device or "cpu")
+        model.eval()
+        dtype_name = str(next(model.parameters()).dtype)
+        param_mb = sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+    info = {
+        "layout": layout,
+        "dtype": dtype_name,
+        "load_s": time.perf_counter() - start,
+        "param_mb": param_mb,
+        "rss_mb": _rss_mb(),
+        "rss_delta_mb": _rss_mb() - rss_before,
+    }
+    return model, info
+
+
 # ---------------------------------------------------------------------------
 # Yapper: Self-Chat Interface
 # ---------------------------------------------------------------------------
 
 class Yapper:
-    def __init__(self, model_path: str, device=None):
+    def __init__(self, model_path: str, device=None, draft_model_path: str = None, num_draft_tokens: int = 4, dtype=None):
         self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side="left")
-        # Attempt to load GPT2WithValueHead; fallback to AutoModelForCausalLM on failure
-        try:
-            self.model = GPT2WithValueHead.from_pretrained(model_path).to(self.device)
-        except Exception as e:
-            print(f"[Yapper Warning] GPT2WithValueHead load failed: {e}. Falling back to AutoModelForCausalLM.", flush=True)
-            self.model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True).to(self.device)
+        # timings/counters from loading and the most recent call of each generation mode
+        self.stats = {}
+        # inference only needs the LM head: skip the value head and TRL wrapper entirely
+        self.model, self.stats["load"] = load_causal_lm(model_path, self.device, dtype)
+        load = self.stats["load"]
+        if load["layout"] in EXPORT_LAYOUTS:
+            self.device = torch.device("cpu")
+        print(f"[Yapper] loaded {model_path} ({load['layout']}, {load['dtype']}) in {load['load_s']:.2f}s, "
+              f"params {load['param_mb']:.0f} MB, RSS {load['rss_mb']:.0f} MB", flush=True)
         # load generation config from the model path for inference
         try:
             self.gen_cfg = GenerationConfig.from_pretrained(model_path)
@@ -169,10 +389,24 @@ class Yapper:
             print(f"[Yapper Warning] GenerationConfig load failed: {e}. Using default GenerationConfig.", flush=True)
             self.gen_cfg = GenerationConfig()
         self.model.generation_config = self.gen_cfg
-        self.model.eval()
+        # batched generation pads on the left; base GPT-2 ships without a pad token
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # optional small model sharing the tokenizer, used for speculative decoding
+        self.draft = None
+        self.num_draft_tokens = num_draft_tokens
+        # worker pool for best-of-N reranking, created on first use
+        self._score_pool = None
+        self._score_pool_size = 0
+        if draft_model_path is not None:
+            self.draft, self.stats["draft_load"] = load_causal_lm(draft_model_path, self.device, dtype)
+            if self.draft.config.vocab_size > self.lm.config.vocab_size:
+                raise ValueError(
+                    f"Draft model vocab ({self.draft.config.vocab_size}) is larger than the target's "
+                    f"({self.lm.config.vocab_size}); the two must share a tokenizer."
+                )
 
-    def chat(self, prompt: str, max_length: int = None, min_length: int = None, do_sample: bool = None, temperature: float = None, top_p: float = None, top_k: int = None):
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+    def _gen_kwargs(self, max_length=None, min_length=None, do_sample=None, temperature=None, top_p=None, top_k=None):
         # build generation parameters respecting length constraints
         gen_kwargs = {"pad_token_id": self.tokenizer.eos_token_id}
         if max_length is not None:
@@ -194,12 +428,316 @@ class Yapper:
             gen_kwargs["top_k"] = top_k
         elif hasattr(self.model.generation_config, "top_k"):
             gen_kwargs["top_k"] = self.model.generation_config.top_k
+        return gen_kwargs
+
+    @property
+    def lm(self):
+        """The bare causal LM, unwrapped from the TRL value-head wrapper if present."""
+        return getattr(self.model, "pretrained_model", self.model)
+
+    @property
+    def context_length(self):
+        cfg = self.lm.config
+        return getattr(cfg, "n_positions", None) or getattr(cfg, "max_position_embeddings", None)
+
+    def chat(self, prompt: str, max_length: int = None, min_length: int = None, do_sample: bool = None, temperature: float = None, top_p: float = None, top_k: int = None):
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        n_ctx = self.context_length
+        if max_length is not None and n_ctx and inputs["input_ids"].shape[1] + max_length > n_ctx:
+            print(f"[Yapper] prompt + max_length exceeds the {n_ctx}-token context; using rolling-cache long generation.", flush=True)
+            return self.chat_long(prompt, max_length=max_length, min_length=min_length or 0, do_sample=do_sample,
+                                  temperature=temperature, top_p=top_p, top_k=top_k)
+        if self.draft is not None:
+            return self.chat_speculative(prompt, max_length=max_length or 100, min_length=min_length or 0,
+                                         do_sample=do_sample, temperature=temperature, top_p=top_p, top_k=top_k)
+        gen_kwargs = self._gen_kwargs(max_length, min_length, do_sample, temperature, top_p, top_k)
         outputs = self.model.generate(
             **inputs,
             **gen_kwargs,
         )
         return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
 
+    def chat_batch(self, prompts, streamer=None, **sampling):
+        """Generate for several prompts in one padded `generate` call.
+
+        Unlike `chat`, only the newly generated text is returned (one string per
+        prompt). `sampling` takes the same keyword arguments as `chat`; an
+        optional HF streamer receives the prompt ids first and then one token
+        per row at every decoding step.
+        """
+        inputs = self.tokenizer(list(prompts), return_tensors="pt", padding=True).to(self.device)
+        gen_kwargs = self._gen_kwargs(**sampling)
+        with torch.no_grad():
+            outputs = self.model.generate(**inputs, **gen_kwargs, streamer=streamer)
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def best_of(self, prompt: str, n: int = 8, k: int = 1, max_length: int = None, min_length: int = None,
+                temperature: float = None, top_p: float = None, top_k: int = None, workers: int = None):
+        """Sample `n` candidates in one batched `generate` call and return the `k` yappiest.
+
+        Candidates (the new text only) are scored with `yap_score` in a pool of
+        worker processes, each parsing its share with a single `_nlp.pipe` pass.
+        Workers have no reference LM, so the KL-weird term is off, as in `yap_score`
+        whenever `_lm` is unset. Returns dicts with text, score and the per-feature
+        breakdown, best first; throughput is kept in `self.stats["best_of"]`.
+        """
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        gen_kwargs = self._gen_kwargs(max_length, min_length, True, temperature, top_p, top_k)
+        start = time.perf_counter()
+        with torch.no_grad():
+            outputs = self.model.generate(**inputs, **gen_kwargs, num_return_sequences=n)
+        gen_s = time.perf_counter() - start
+        texts = self.tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+        # reuse the running pool unless a different size is asked for explicitly
+        workers = workers or self._score_pool_size or min(4, os.cpu_count() or 1, n)
+        if self._score_pool is not None and workers != self._score_pool_size:
+            self.close()
+        if self._score_pool is None:
+            # spawn: forking a process that already holds CUDA/OpenMP state is unsafe
+            self._score_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            self._score_pool_size = workers
+        chunk = math.ceil(len(texts) / self._score_pool_size)
+        start = time.perf_counter()
+        scored = [r for part in self._score_pool.map(_score_chunk, [texts[i:i + chunk] for i in range(0, len(texts), chunk)]) for r in part]
+        score_s = time.perf_counter() - start
+
+        ranked = sorted(range(len(texts)), key=lambda i: scored[i][0], reverse=True)[:k]
+        self.stats["best_of"] = {
+            "candidates": len(texts),
+            "generate_s": gen_s,
+            "score_s": score_s,
+            "candidates_per_sec": len(texts) / (gen_s + score_s) if gen_s + score_s > 0 else 0.0,
+            "score_workers": self._score_pool_size,
+        }
+        return [{"text": texts[i], "score": scored[i][0], "features": scored[i][1]} for i in ranked]
+
+    def close(self):
+        """Shut down the best-of-N scoring workers, if any were started."""
+        if self._score_pool is not None:
+            self._score_pool.shutdown()
+            self._score_pool = None
+            self._score_pool_size = 0
+
+    def chat_speculative(self, prompt: str, max_length: int = 100, min_length: int = 0, do_sample: bool = None,
+                         temperature: float = None, top_p: float = None, top_k: int = None,
+                         num_draft_tokens: int = None):
+        """Speculative decoding: the draft model proposes tokens, the target verifies them in one pass.
+
+        Each round the draft samples up to `num_draft_tokens` tokens; the target
+        scores all of them in a single forward. When sampling, draft token x is
+        kept with probability min(1, p(x) / q(x)) and the first rejection is
+        resampled from max(p - q, 0), so outputs follow the target's (warped)
+        distribution exactly. Greedy decoding keeps drafts that match the target
+        argmax. Rejected positions are cropped from both KV caches. Returns
+        prompt + generated text like `chat`.
+        """
+        if self.draft is None:
+            raise ValueError("chat_speculative needs a draft model (Yapper(..., draft_model_path=...))")
+        k = num_draft_tokens or self.num_draft_tokens
+        gen_kwargs = self._gen_kwargs(do_sample=do_sample, temperature=temperature, top_p=top_p, top_k=top_k)
+        sample = gen_kwargs["do_sample"]
+        warpers = _sampling_processors(gen_kwargs)
+        eos = self.tokenizer.eos_token_id
+        target, draft = self.lm, self.draft
+        target_vocab = target.get_output_embeddings().weight.shape[0]
+        ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.device)
+        prompt_len = ids.shape[1]
+
+        def next_token_dist(logits, n_new):
+            # draft and target must score the same vocabulary; the target may have extra (e.g. [PAD]) rows
+            logits = logits.float()
+            if logits.shape[-1] < target_vocab:
+                logits = torch.nn.functional.pad(logits, (0, target_vocab - logits.shape[-1]), value=-float("inf"))
+            if n_new < min_length and eos is not None:
+                logits[..., eos] = -float("inf")
+            return warpers(ids, logits).softmax(-1) if sample else logits
+
+        def pick(dist):
+            return torch.multinomial(dist, num_samples=1) if sample else dist.argmax(-1, keepdim=True)
+
+        t_cache, d_cache = DynamicCache(), DynamicCache()
+        proposed = accepted = rounds = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            while ids.shape[1] - prompt_len < max_length:
+                n_new = ids.shape[1] - prompt_len
+                # always leave room for the target's own correction/bonus token
+                k_round = max(0, min(k, max_length - n_new - 1))
+                draft_tokens, draft_dists = [], []
+                cur = ids
+                for i in range(k_round):
+                    d_logits, d_cache = _forward_uncached(draft, cur, d_cache)
+                    dist = next_token_dist(d_logits[:, -1], n_new + i)
+                    tok = pick(dist)
+                    draft_tokens.append(tok)
+                    draft_dists.append(dist)
+                    cur = torch.cat([cur, tok], dim=1)
+                    if tok.item() == eos:
+                        break
+                t_logits, t_cache = _forward_uncached(target, cur, t_cache)
+                # the last len(draft_tokens) + 1 positions predict each draft token plus one bonus token
+                t_logits = t_logits[:, -(len(draft_tokens) + 1):]
+
+                kept, extra = [], None
+                for i, tok in enumerate(draft_tokens):
+                    p = next_token_dist(t_logits[:, i], n_new + i)
+                    if sample:
+                        q = draft_dists[i]
+                        ratio = p[0, tok.item()] / q[0, tok.item()]
+                        if torch.rand((), device=p.device) < ratio.clamp(max=1.0):
+                            kept.append(tok)
+                            continue
+                        residual = (p - q).clamp(min=0.0)
+                        extra = pick(residual / residual.sum() if residual.sum() > 0 else p)
+                    else:
+                        if p.argmax(-1).item() == tok.item():
+                            kept.append(tok)
+                            continue
+                        extra = p.argmax(-1, keepdim=True)
+                    break
+                if extra is None and not (kept and kept[-1].item() == eos):
+                    extra = pick(next_token_dist(t_logits[:, len(draft_tokens)], n_new + len(draft_tokens)))
+
+                proposed += len(draft_tokens)
+                accepted += len(kept)
+                rounds += 1
+                ids = torch.cat([ids] + kept + ([extra] if extra is not None else []), dim=1)
+                # both caches must end right before the newest token
+                t_cache = _crop_cache(t_cache, ids.shape[1] - 1)
+                d_cache = _crop_cache(d_cache, min(_cache_seq_len(d_cache), ids.shape[1] - 1))
+                if ids[0, -1].item() == eos:
+                    break
+        elapsed = time.perf_counter() - start
+
+        generated = ids[0, prompt_len:prompt_len + max_length]
+        self.stats["speculative"] = {
+            "new_tokens": generated.shape[0],
+            "tokens_per_sec": generated.shape[0] / elapsed if elapsed > 0 else 0.0,
+            "acceptance_rate": accepted / proposed if proposed else 0.0,
+            "draft_tokens_proposed": proposed,
+            "draft_tokens_accepted": accepted,
+            "tokens_per_target_pass": generated.shape[0] / rounds if rounds else 0.0,
+            "num_draft_tokens": k,
+        }
+        return prompt + self.tokenizer.decode(generated, skip_special_tokens=True)
+
+    def benchmark_speculative(self, prompt: str, max_length: int = 128, runs: int = 3, **sampling):
+        """Compare plain `generate` sampling against speculative decoding on the same prompt.
+
+        Both paths are forced to emit exactly `max_length` tokens so tokens/sec is comparable.
+        """
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        gen_kwargs = self._gen_kwargs(max_length=max_length, min_length=max_length, **sampling)
+        plain_tokens = plain_time = spec_tokens = spec_time = 0.0
+        acceptance = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            out = self.model.generate(**inputs, **gen_kwargs)
+            plain_time += time.perf_counter() - start
+            plain_tokens += out.shape[1] - inputs["input_ids"].shape[1]
+
+            start = time.perf_counter()
+            self.chat_speculative(prompt, max_length=max_length, min_length=max_length, **sampling)
+            spec_time += time.perf_counter() - start
+            spec_tokens += self.stats["speculative"]["new_tokens"]
+            acceptance.append(self.stats["speculative"]["acceptance_rate"])
+        plain_tps = plain_tokens / plain_time if plain_time else 0.0
+        spec_tps = spec_tokens / spec_time if spec_time else 0.0
+        return {
+            "plain_tokens_per_sec": plain_tps,
+            "speculative_tokens_per_sec": spec_tps,
+            "speedup": spec_tps / plain_tps if plain_tps else 0.0,
+            "acceptance_rate": sum(acceptance) / len(acceptance),
+            "num_draft_tokens": self.num_draft_tokens,
+            "runs": runs,
+        }
+
+    def chat_long(self, prompt: str, max_length: int = 2000, min_length: int = 0, do_sample: bool = None,
+                  temperature: float = None, top_p: float = None, top_k: int = None,
+                  n_sink: int = 4, window: int = None, evict_chunk: int = 64):
+        """Generate past the model's context window with a bounded rolling KV cache.
+
+        The cache holds `n_sink` "attention sink" tokens from the start of the
+        sequence plus the most recent tokens, at most `n_sink + window` in total.
+        GPT-2 adds absolute position embeddings at the input, so cached keys carry
+        the positions they were computed at, and new tokens cannot simply be
+        re-based below them. Once the cache is full, the middle `evict_chunk`
+        tokens are dropped and the kept sink + recent tokens are re-encoded at
+        positions 0..n-1. Positions therefore stay monotonic and never exceed the
+        context size. The cost is one prefill of about `window` tokens per
+        `evict_chunk` generated tokens (counted in `reencoded_tokens`); a larger
+        `evict_chunk` amortises it further at the cost of a shorter effective
+        window. Returns prompt + generated text like `chat`.
+        """
+        n_ctx = self.context_length
+        window = window or n_ctx - n_sink
+        budget = n_sink + window
+        if budget > n_ctx:
+            raise ValueError(f"n_sink + window = {budget} exceeds the model context of {n_ctx}")
+        evict_chunk = max(1, min(evict_chunk, window - 1))
+        gen_kwargs = self._gen_kwargs(do_sample=do_sample, temperature=temperature, top_p=top_p, top_k=top_k)
+        warpers = _sampling_processors(gen_kwargs)
+        eos = self.tokenizer.eos_token_id
+        lm = self.lm
+
+        prompt_ids = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self.device)
+        # a prompt longer than the cache keeps its sink tokens plus its tail
+        keep = budget - evict_chunk
+        if prompt_ids.shape[1] > keep:
+            prompt_ids = torch.cat([prompt_ids[:, :n_sink], prompt_ids[:, -(keep - n_sink):]], dim=1)
+
+        cache = DynamicCache()
+        cached_ids = prompt_ids[:, :0]  # token ids currently held in the cache, in position order
+        next_input = prompt_ids
+        generated, step_times = [], []
+        evictions, reencoded, peak_cache = 0, 0, 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            while len(generated) < max_length:
+                step_start = time.perf_counter()
+                if cached_ids.shape[1] + next_input.shape[1] > budget:
+                    kept = torch.cat([cached_ids[:, :n_sink], cached_ids[:, -(window - evict_chunk):]], dim=1)
+                    next_input = torch.cat([kept, next_input], dim=1)
+                    cached_ids = cached_ids[:, :0]
+                    cache = DynamicCache()
+                    evictions += 1
+                    reencoded += kept.shape[1]
+                cache_len = cached_ids.shape[1]
+                positions = torch.arange(cache_len, cache_len + next_input.shape[1], device=self.device).unsqueeze(0)
+                out = lm(input_ids=next_input, past_key_values=cache, position_ids=positions, use_cache=True)
+                cache = out.past_key_values
+                cached_ids = torch.cat([cached_ids, next_input], dim=1)
+                peak_cache = max(peak_cache, cached_ids.shape[1])
+                logits = out.logits[:, -1, :].float()
+                if len(generated) < min_length and eos is not None:
+                    logits[:, eos] = -float("inf")
+                if gen_kwargs["do_sample"]:
+                    probs = warpers(next_input, logits).softmax(-1)
+                    token = torch.multinomial(probs, num_samples=1)
+                else:
+                    token = logits.argmax(-1, keepdim=True)
+                generated.append(token.item())
+                step_times.append(time.perf_counter() - step_start)
+                if token.item() == eos:
+                    break
+                next_input = token
+        elapsed = time.perf_counter() - start
+
+        # the first step also prefilled the prompt; keep it out of the per-token latency
+        decode_ms = sorted(t * 1000 for t in step_times[1:]) or [0.0]
+        self.stats["chat_long"] = {
+            "new_tokens": len(generated),
+            "tokens_per_sec": len(generated) / elapsed if elapsed > 0 else 0.0,
+            "evictions": evictions,
+            "reencoded_tokens": reencoded,
+            "peak_cache_len": peak_cache,
+            "ms_per_token_p50": decode_ms[len(decode_ms) // 2],
+            "ms_per_token_p99": decode_ms[min(len(decode_ms) - 1, int(len(decode_ms) * 0.99))],
+        }
+        return prompt + self.tokenizer.decode(generated, skip_special_tokens=True)
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Train Yapper PPO with GPT-2")
@@ -210,6 +748,10 @@ def parse_args():
     parser.add_argument("--output-dir", type=str, default="yapbot-ppo", help="Directory to save model and tokenizer")
     parser.add_argument("--device", type=str, default="cuda", help="Device for training (e.g. 'cuda', 'cuda:0' or 'cpu')")
     parser.add_argument("--log-dir", type=str, default=None, help="Directory to save training metrics JSONL")
+    parser.add_argument("--metrics-parquet", action="store_true", help="Also mirror metrics into log_dir/metrics.parquet")
+    parser.add_argument("--metrics-max-mb", type=int, default=64, help="Rotate metrics.jsonl once it exceeds this size")
+    parser.add_argument("--reward-sample-rate", type=float, default=0.02, help="Fraction of scored texts written to log_dir/reward_samples.jsonl")
+    parser.add_argument("--reward-report-every", type=int, default=50, help="Print a reward telemetry summary every N scored batches (0 = never)")
     parser.add_argument("--gen-max-new-tokens", type=int, default=100, help="Max new tokens during PPO generation")
     parser.add_argument("--gen-min-new-tokens", type=int, default=0, help="Min new tokens during PPO generation")
     parser.add_argument("--gen-temperature", type=float, default=1.0, help="Temperature for PPO generation")
@@ -217,6 +759,13 @@ def parse_args():
     parser.add_argument("--gen-top-k", type=int, default=50, help="Top-k sampling cutoff")
     parser.add_argument("--demo", action="store_true", help="Run a demo chat and exit")
     parser.add_argument("--prompt", type=str, default="Hello, how are you?", help="Prompt to use in demo mode")
+    parser.add_argument("--best-of", type=int, default=0, help="In demo mode, sample this many candidates and print the yappiest")
+    parser.add_argument("--best-of-k", type=int, default=3, help="How many of the best-of-N candidates to print")
+    parser.add_argument("--bf16", action="store_true", help="Cast inference weights to bfloat16 in demo mode")
+    parser.add_argument("--draft-model", type=str, default=None, help="Small model sharing the tokenizer (e.g. gpt2) for speculative decoding in demo mode")
+    parser.add_argument("--num-draft-tokens", type=int, default=4, help="Tokens the draft model proposes per verification step")
+    parser.add_argument("--prompt-shards", type=str, default=None, help="Train on prompt shards written by selfplay_pipeline.py instead of the built-in prompts")
+    parser.add_argument("--benchmark-speculative", action="store_true", help="In demo mode, compare speculative decoding against plain sampling")
     return parser.parse_args()
 
 # ---------------------------------------------------------------------------
@@ -224,27 +773,13 @@ def parse_args():
 def _sigmoid(x, slope=1.0, width=1.0):
     return width / (1 + math.exp(-slope * (x - 0.5)))
 
-def yap_score(text: str,
-              weights = {
-                  'length'      : 0.35,
-                  'questions'   : 0.15,
-                  'reflection'  : 0.10,
-                  'fillers'     : 0.10,
-                  'diversity'   : 0.10,
-                  'repetition'  : 0.10,
-                  'sentiment'   : 0.05,
-                  'kl_weird'    : 0.15,
-              },
-              kl_ref_logits: torch.Tensor | None = None
-):
+def yap_features(text: str, doc=None, kl_weird: bool = False, kl_ref_logits: torch.Tensor | None = None):
     """
-    Advanced reward for Yapper‑style rambling using multiple linguistic features and optional KL weirdness.
+    Per-feature Yapper scores, keyed like the `yap_score` weights. Pass a pre-parsed
+    spaCy `doc` to skip parsing (e.g. when batching with `_nlp.pipe`).
     """
-    # disable KL-weird if no reference LM loaded
-    if weights.get('kl_weird', 0) > 0 and _lm is None:
-        weights['kl_weird'] = 0.0
-
-    doc = _nlp(text)
+    if doc is None:
+        doc = _nlp(text)
     tokens = [t.text for t in doc if not t.is_space]
     T = len(tokens) or 1
 
@@ -282,7 +817,7 @@ def yap_score(text: str,
 
     # 8. Optional KL-weirdness from reference LM
     kl_weird_score = 0.0
-    if weights.get('kl_weird', 0) > 0:
+    if kl_weird:
         with torch.no_grad():
             ids = _lm_tok(text, return_tensors="pt").input_ids.to(_lm.device)
             logits = _lm(ids).logits[0, :-1]
@@ -292,19 +827,65 @@ def yap_score(text: str,
             kl_div = torch.nn.functional.kl_div(p, q, log_target=True, reduction='batchmean')
             kl_weird_score = _sigmoid(min(kl_div.item(),3)/3, slope=8)
 
+    return {
+        'length'    : length_score,
+        'questions' : question_score,
+        'reflection': reflect_score,
+        'fillers'   : fillers_score,
+        'diversity' : diversity_score,
+        'repetition': repetition_score,
+        'sentiment' : sentiment_score,
+        'kl_weird'  : kl_weird_score,
+    }
+
+def yap_features_batch(texts, batch_size: int = 64, kl_weird: bool = False):
+    """`yap_features` for many texts, parsing them with one `_nlp.pipe` pass (KL-weird term only if asked)."""
+    return [yap_features(text, doc=doc, kl_weird=kl_weird) for text, doc in zip(texts, _nlp.pipe(texts, batch_size=batch_size))]
+
+def yap_score(text: str,
+              weights = {
+                  'length'      : 0.35,
+                  'questions'   : 0.15,
+                  'reflection'  : 0.10,
+                  'fillers'     : 0.10,
+                  'diversity'   : 0.10,
+                  'repetition'  : 0.10,
+                  'sentiment'   : 0.05,
+                  'kl_weird'    : 0.15,
+              },
+              kl_ref_logits: torch.Tensor | None = None,
+              features: dict | None = None,
+):
+    """
+    Advanced reward for Yapper‑style rambling using multiple linguistic features and optional KL weirdness.
+    Pass precomputed `features` (from `yap_features`) to skip feature extraction.
+    """
+    # disable KL-weird if no reference LM loaded
+    if weights.get('kl_weird', 0) > 0 and _lm is None:
+        weights['kl_weird'] = 0.0
+
+    f = features if features is not None else yap_features(
+        text, kl_weird=weights.get('kl_weird', 0) > 0, kl_ref_logits=kl_ref_logits
+    )
+
     raw = (
-        weights['length']    * length_score +
-        weights['questions'] * question_score +
-        weights['reflection']* reflect_score +
-        weights['fillers']   * fillers_score +
-        weights['diversity'] * diversity_score +
-        weights['repetition']* repetition_score +
-        weights['sentiment'] * sentiment_score +
-        weights.get('kl_weird',0) * kl_weird_score
+        weights['length']    * f['length'] +
+        weights['questions'] * f['questions'] +
+        weights['reflection']* f['reflection'] +
+        weights['fillers']   * f['fillers'] +
+        weights['diversity'] * f['diversity'] +
+        weights['repetition']* f['repetition'] +
+        weights['sentiment'] * f['sentiment'] +
+        weights.get('kl_weird',0) * f['kl_weird']
     )
     norm = sum(weights.values()) or 1.0
     return max(0.0, min(raw / norm, 1.0))
 
+def _score_chunk(texts):
+    """Process-pool worker for best-of-N reranking: (yap_score, features) per text."""
+    feats = yap_features_batch(texts)
+    return [(yap_score(text, features=f), f) for text, f in zip(texts, feats)]
+
 # ---------------------------------------------------------------------------
 # setup spaCy for advanced scoring
 _nlp = spacy.load("en_core_web_sm", disable=["parser","ner"])
@@ -323,7 +904,8 @@ def main(args):
 
     # Quick demo mode: chat with the model and exit
     if args.demo:
-        yapper = Yapper(model_name, device)
+        yapper = Yapper(model_name, device, draft_model_path=args.draft_model, num_draft_tokens=args.num_draft_tokens,
+                        dtype=torch.bfloat16 if args.bf16 else None)
         print(yapper.chat(
             args.prompt,
             max_length=args.gen_max_new_tokens,
@@ -333,6 +915,22 @@ def main(args):
             top_p=args.gen_top_p,
             top_k=args.gen_top_k,
         ))
+        if args.best_of:
+            for rank, cand in enumerate(yapper.best_of(args.prompt, n=args.best_of, k=args.best_of_k,
+                                                       max_length=args.gen_max_new_tokens, temperature=args.gen_temperature,
+                                                       top_p=args.gen_top_p, top_k=args.gen_top_k), 1):
+                feats = ", ".join(f"{name}={val:.2f}" for name, val in cand["features"].items())
+                print(f"#{rank} score={cand['score']:.4f} [{feats}]\n{cand['text']}\n")
+            print(f"Best-of-N stats: {yapper.stats['best_of']}")
+            yapper.close()
+        if yapper.draft is not None:
+            # chat() takes the chat_long path when prompt + max_length overflows n_ctx
+            if "speculative" in yapper.stats:
+                print(f"Speculative decoding stats: {yapper.stats['speculative']}")
+            elif "chat_long" in yapper.stats:
+                print(f"Rolling-cache stats (draft model unused): {yapper.stats['chat_long']}")
+            if args.benchmark_speculative:
+                print(f"Speculative vs plain sampling: {yapper.benchmark_speculative(args.prompt, max_length=args.gen_max_new_tokens, do_sample=True, temperature=args.gen_temperature, top_p=args.gen_top_p, top_k=args.gen_top_k)}")
         return
 
     # 2. Tokenizer initialization
@@ -365,20 +963,29 @@ def main(args):
         m.generation_config = gen_cfg
 
     # 4. Dataset loading & tokenization
-    yap_prompts = [
-        "Hey, what's on your mind today?",
-        "What do you think about AI art?",
-        "Tell me something weird you believe.",
-        "How would you start an argument about pineapple on pizza?",
-        "Say something totally unhinged but kinda true.",
-    ]
-    ds = Dataset.from_dict({"prompt": yap_prompts * 20})
+    if args.prompt_shards:
+        # memory-mapped Arrow shards; PPOTrainer shuffles with a sized DataLoader, so this stays map-style
+        ds = load_prompt_shards(args.prompt_shards)
+        print(f"Loaded {len(ds)} prompts from {args.prompt_shards}")
+    else:
+        ds = Dataset.from_dict({"prompt": YAP_PROMPTS * 20})
     def tokenize_fn(examples):
         return tok(examples["prompt"], truncation=True)
     ds = ds.map(tokenize_fn, batched=True, remove_columns=["prompt"])
 
     # 5. Reward function & reward model init
-    reward_model = RewardFromFunction(yap_score, tok).to(device)
+    telemetry = RewardTelemetry(
+        os.path.join(args.log_dir, "reward_telemetry.jsonl") if args.log_dir else None,
+        os.path.join(args.log_dir, "reward_samples.jsonl") if args.log_dir else None,
+        sample_rate=args.reward_sample_rate,
+        report_every=args.reward_report_every,
+    )
+    # one spaCy pipe per batch; KL-weird is included once the reference LM is registered, as in yap_score
+    reward_model = RewardFromFunction(
+        yap_score, tok,
+        features_fn=lambda texts: yap_features_batch(texts, kl_weird=_lm is not None),
+        telemetry=telemetry,
+    ).to(device)
     for p in reward_model.parameters():
         p.requires_grad = False
     for p in ref.parameters():  # freeze reference model
@@ -412,7 +1019,7 @@ def main(args):
     callbacks = []
     if args.log_dir:
         os.makedirs(args.log_dir, exist_ok=True)
-        callbacks.append(SaveMetricsCallback(args.log_dir))
+        callbacks.append(SaveMetricsCallback(args.log_dir, args.metrics_parquet, args.metrics_max_mb))
     data_collator = DataCollatorWithPadding(tok)
     trainer = PPOTrainer(
         args=ppo_config,
@@ -431,6 +1038,8 @@ def main(args):
     print("===training yapper===")
     trainer.train()
     print("===done training===")
+    telemetry.close()
+    print(f"[Reward Telemetry] {telemetry.stats()}")
 
     # 8. Saving models & tokenizer
     os.makedirs(args.output_dir, exist_ok=True)
@@ -5,7 +5,6 @@ Optimised for a 10 GB RTX 3080: we keep just two GPT‑2 models in VRAM —
 """
 
 import argparse
-import json
 import math
 import os
 import re
@@ -15,6 +14,7 @@ import torch
 import torch.nn as nn
 import spacy
 from datasets import Dataset
+from record_sink import MetricsSink, load_prompt_shards
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
@@ -167,15 +167,19 @@ class Yapper:
 # ---------------------------------------------------------------------------
 
 class SaveMetricsCallback(TrainerCallback):
-    def __init__(self, path: str):
+    def __init__(self, path: str, parquet: bool = False, max_mb: int = 64):
         self.fname = os.path.join(path, "metrics.jsonl")
         os.makedirs(path, exist_ok=True)
-        open(self.fname, "w").close()
+        # appends (resumed runs keep their history), flushes in the background, rotates past max_mb
+        self.sink = MetricsSink(self.fname, os.path.join(path, "metrics.parquet") if parquet else None,
+                                max_bytes=max_mb * 2**20)
 
     def on_log(self, args, state, control, logs=None, **_):
         if logs:
-            with open(self.fname, "a") as f:
-                f.write(json.dumps(logs) + "\n")
+            self.sink.log(logs)
+
+    def on_train_end(self, args, state, control, **_):
+        self.sink.close()
 
 # ---------------------------------------------------------------------------
 # CLI ----------------------------------------------------------------------
@@ -188,8 +192,11 @@ def parse_args():
     p.add_argument("--steps", type=int, default=100)
     p.add_argument("--out", type=str, default="yapbot‑ppo")
     p.add_argument("--log", type=str)
+    p.add_argument("--metrics-parquet", action="store_true", help="also mirror metrics into <log>/metrics.parquet")
+    p.add_argument("--metrics-max-mb", type=int, default=64, help="rotate metrics.jsonl past this size")
     p.add_argument("--demo", action="store_true")
     p.add_argument("--prompt", type=str, default="Say something unhinged but true.")
+    p.add_argument("--prompt-shards", type=str, help="prompt shards from selfplay_pipeline.py")
     return p.parse_args()
 
 # ---------------------------------------------------------------------------
@@ -254,7 +261,8 @@ def main():
         "How would you start an argument about pineapple on pizza?",
         "Say something totally unhinged but kinda true.",
     ] * 20
-    ds = Dataset.from_dict({"prompt": prompts}).map(lambda e: tok(e["prompt"], truncation=True), batched=True, remove_columns=["prompt"])
+    ds = load_prompt_shards(args.prompt_shards) if args.prompt_shards else Dataset.from_dict({"prompt": prompts})
+    ds = ds.map(lambda e: tok(e["prompt"], truncation=True), batched=True, remove_columns=["prompt"])
 
     
     training_args = PPOConfig(
@@ -266,7 +274,7 @@ def main():
         missing_eos_penalty=1.0,
         num_ppo_epochs=args.steps,
     )
-    callbacks = [SaveMetricsCallback(args.log)] if args.log else []
+    callbacks = [SaveMetricsCallback(args.log, args.metrics_parquet, args.metrics_max_mb)] if args.log else []
     
     trainer = PPOTrainer(
         model=actor_critic,
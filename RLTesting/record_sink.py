@@ -0,0 +1,292 @@
+"""Buffered structured record writer shared by ya.py and the chat scripts.
+
+`RecordSink.write` only appends a dict to an in-memory buffer. A background
+thread flushes the buffer every `flush_interval` seconds, or sooner once
+`flush_every` records are waiting, so callers never block on file I/O. The
+format follows the file extension:
+
+  .jsonl    one JSON object per line
+  .parquet  one row group per flush (pyarrow)
+  .arrow    Arrow IPC stream, one record batch per flush (pyarrow); this is the
+            layout `datasets.Dataset.from_file` memory-maps without copying
+
+With `max_bytes` the file is rotated once it grows past that size: it moves to
+the next numbered segment (`metrics.00001.jsonl`, `metrics.00002.jsonl`, ...)
+and writing continues in a fresh `metrics.jsonl`. JSONL files are opened in
+append mode, so a resumed run continues its history. Parquet/Arrow files cannot
+be appended to, so an existing file is rotated into a segment instead of being
+overwritten. `rotated_paths` lists a file's segments oldest first.
+
+`TranscriptSink` fixes the dialogue schema (dialogue, turn, speaker, prompt,
+reply, reward, time). `MetricsSink` records Trainer log events, optionally
+mirrored to Parquet. `load_prompt_dataset` turns a transcript back into the
+`{"prompt": ...}` dataset the PPO scripts train on. `load_prompt_shards` does the
+same for the shard directories written by selfplay_pipeline.py.
+"""
+import atexit
+import glob
+import json
+import os
+import threading
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+FORMATS = {".jsonl": "jsonl", ".json": "jsonl", ".parquet": "parquet", ".arrow": "arrow"}
+# finished prompt shards; shards still being written carry a leading "." and are skipped
+SHARD_PATTERN = "shard-*.arrow"
+
+
+def segment_path(path, index):
+    root, ext = os.path.splitext(path)
+    return f"{root}.{index:05d}{ext}"
+
+
+def _segments(path):
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(glob.escape(root) + "." + "[0-9]" * 5 + ext))
+
+
+def rotated_paths(path):
+    """Rotated segments of `path`, oldest first, followed by `path` itself if it exists."""
+    return _segments(path) + ([path] if os.path.exists(path) else [])
+
+
+def format_for(path):
+    fmt = FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f"Unknown record file extension for {path!r}; use one of {sorted(FORMATS)}")
+    return fmt
+
+
+class RecordSink:
+    def __init__(self, path, schema=None, flush_every=256, flush_interval=2.0, max_bytes=None):
+        self.path = path
+        self.format = format_for(path)
+        if self.format != "jsonl" and pa is None:
+            raise ImportError(f"Writing {self.format} records needs pyarrow: pip install pyarrow")
+        self.schema = schema
+        # an inferred schema may gain columns later (new metric keys); a given one is fixed
+        self._infer_schema = schema is None
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.records_written = 0
+        self._buffer = []
+        self._buffer_lock = threading.Lock()
+        # serializes file writes between the flush thread and explicit flush()/close()
+        self._io_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._error = None
+        self._file = None
+        self._writer = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="record-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        if self._closed:
+            raise ValueError(f"RecordSink for {self.path} is closed")
+        with self._buffer_lock:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self.flush_every
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # the failed batch is dropped; close() re-raises the first failure
+                self._error = self._error or e
+                print(f"[Record Sink] Warning: flush to {self.path} failed: {e}")
+
+    def flush(self):
+        with self._buffer_lock:
+            batch, self._buffer = self._buffer, []
+        if not batch:
+            return
+        with self._io_lock:
+            self._write_batch(batch)
+            self.records_written += len(batch)
+
+    def _write_batch(self, batch):
+        if self.format == "jsonl":
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch))
+            self._file.flush()
+        else:
+            self._write_columnar(batch)
+        if self.max_bytes is not None and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+
+    def _write_columnar(self, batch):
+        if self._infer_schema:
+            schema = pa.Table.from_pylist(batch).schema
+            if self.schema is None:
+                self.schema = schema
+            elif any(f.name not in self.schema.names or
+                     (pa.types.is_null(self.schema.field(f.name).type) and not pa.types.is_null(f.type))
+                     for f in schema):
+                # new or newly typed columns: finish this file, continue with the wider schema
+                self.schema = pa.unify_schemas([self.schema, schema])
+                self._rotate()
+        table = pa.Table.from_pylist(batch, schema=self.schema)
+        if self._writer is None:
+            if os.path.exists(self.path):
+                self._rotate()
+            if self.format == "parquet":
+                self._writer = pq.ParquetWriter(self.path, self.schema)
+            else:
+                self._file = pa.OSFile(self.path, "wb")
+                self._writer = pa.ipc.new_stream(self._file, self.schema)
+        self._writer.write_table(table)
+
+    def _rotate(self):
+        """Close the current file and move it to the next numbered segment."""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            segments = _segments(self.path)
+            index = int(segments[-1].rsplit(".", 2)[-2]) + 1 if segments else 1
+            os.replace(self.path, segment_path(self.path, index))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        self.flush()
+        with self._io_lock:
+            if self._writer is not None:
+                self._writer.close()
+            if self._file is not None:
+                self._file.close()
+        atexit.unregister(self.close)
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TranscriptSink(RecordSink):
+    """RecordSink with the dialogue-turn schema used by ya.py and the chat scripts."""
+
+    def __init__(self, path, **kwargs):
+        schema = None
+        if pa is not None:
+            schema = pa.schema([
+                ("dialogue", pa.string()),
+                ("turn", pa.int64()),
+                ("speaker", pa.string()),
+                ("prompt", pa.string()),
+                ("reply", pa.string()),
+                ("reward", pa.float64()),
+                ("time", pa.string()),
+            ])
+        super().__init__(path, schema=schema, **kwargs)
+
+    def log_turn(self, turn, speaker, prompt, reply, reward=None, dialogue="0"):
+        self.write({
+            "dialogue": str(dialogue),
+            "turn": turn,
+            "speaker": speaker,
+            "prompt": prompt,
+            "reply": reply,
+            "reward": None if reward is None else float(reward),
+            "time": datetime.now().isoformat(timespec="seconds"),
+        })
+
+
+class MetricsSink(RecordSink):
+    """Trainer log events as JSONL, optionally mirrored to a Parquet file for columnar analysis.
+
+    The JSONL keeps every value as logged. The mirror stores numbers as float64,
+    so a metric that is logged as both int and float keeps a single column type.
+    """
+
+    def __init__(self, path, mirror_path=None, max_bytes=64 * 2**20, flush_every=64, flush_interval=5.0):
+        super().__init__(path, flush_every=flush_every, flush_interval=flush_interval, max_bytes=max_bytes)
+        self.mirror = None
+        if mirror_path is not None:
+            self.mirror = RecordSink(mirror_path, flush_every=flush_every, flush_interval=flush_interval, max_bytes=max_bytes)
+
+    def log(self, metrics):
+        self.write(dict(metrics))
+        if self.mirror is not None:
+            self.mirror.write({k: float(v) if isinstance(v, (int, float)) else v for k, v in metrics.items()})
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.mirror is not None:
+                self.mirror.close()
+
+
+def load_records(path):
+    """Load a sink file and its rotated segments as one `datasets.Dataset`; .arrow files are memory-mapped."""
+    from datasets import Dataset, concatenate_datasets
+    fmt = format_for(path)
+    paths = rotated_paths(path) or [path]
+    if fmt == "arrow":
+        return concatenate_datasets([Dataset.from_file(p) for p in paths])
+    if fmt == "parquet":
+        return Dataset.from_parquet(paths)
+    return Dataset.from_json(paths)
+
+
+def load_prompt_dataset(path, field="reply", min_reward=None, speaker=None):
+    """Transcript -> Dataset with a single "prompt" column, as the PPO scripts expect.
+
+    `field` picks which text becomes the prompt (a bot's reply makes a natural
+    opener for the next turn); `min_reward` and `speaker` filter turns first.
+    """
+    ds = load_records(path)
+    if speaker is not None:
+        ds = ds.filter(lambda r: r["speaker"] == speaker)
+    if min_reward is not None:
+        ds = ds.filter(lambda r: r["reward"] is not None and r["reward"] >= min_reward)
+    ds = ds.filter(lambda r: bool(r[field] and r[field].strip()))
+    ds = ds.select_columns([field])
+    return ds if field == "prompt" else ds.rename_column(field, "prompt")
+
+
+def load_prompt_shards(shard_dir, streaming=False):
+    """Prompt shards from selfplay_pipeline.py as one dataset with a "prompt" column.
+
+    By default the shards are memory-mapped and concatenated without copying into
+    a map-style Dataset (PPOTrainer shuffles with a sized DataLoader, so it needs
+    one). `streaming=True` gives an IterableDataset that opens shard by shard.
+    """
+    from datasets import Dataset, IterableDataset, concatenate_datasets
+    paths = sorted(glob.glob(os.path.join(shard_dir, SHARD_PATTERN)))
+    if not paths:
+        raise FileNotFoundError(f"No prompt shards ({SHARD_PATTERN}) in {shard_dir}")
+    if streaming:
+        def rows(paths):
+            for path in paths:
+                for prompt in Dataset.from_file(path)["prompt"]:
+                    yield {"prompt": prompt}
+        return IterableDataset.from_generator(rows, gen_kwargs={"paths": paths})
+    return concatenate_datasets([Dataset.from_file(path) for path in paths]).select_columns(["prompt"])
@@ -0,0 +1,125 @@
+"""Aggregated telemetry for the PPO reward stage.
+
+`RewardTelemetry.record_batch` is called once per scored batch. It does not
+print per sample. It builds one summary record per batch:
+
+  reward      mean / std / min / max of the total reward
+  features    mean and a fixed 10-bin histogram over [0, 1] for each yap feature
+  length      word-count mean / p50 / p90 and a histogram over LENGTH_EDGES
+  latency     decode + scoring time for the batch, and per text
+
+Summaries go to a RecordSink (buffered, background-flushed), so the reward
+path never waits on file I/O. A random `sample_rate` fraction of the scored
+texts, with their features, goes to a separate samples JSONL. `stats()` keeps
+running totals for the whole run, and `report_every` prints one line per N
+batches.
+"""
+import math
+import random
+import time
+
+from record_sink import RecordSink
+
+# word-count bucket edges for the text-length histogram (last bucket is open-ended)
+LENGTH_EDGES = [0, 5, 10, 20, 40, 80, 160]
+FEATURE_BINS = 10
+
+
+def _histogram(values, edges):
+    counts = [0] * len(edges)
+    for v in values:
+        i = len(edges) - 1
+        while i > 0 and v < edges[i]:
+            i -= 1
+        counts[i] += 1
+    return counts
+
+
+def _unit_histogram(values, bins=FEATURE_BINS):
+    counts = [0] * bins
+    for v in values:
+        counts[min(bins - 1, max(0, int(v * bins)))] += 1
+    return counts
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+
+class RewardTelemetry:
+    def __init__(self, path=None, sample_path=None, sample_rate=0.01, report_every=0, seed=0):
+        self.sink = RecordSink(path, flush_every=64, flush_interval=5.0) if path else None
+        self.samples = RecordSink(sample_path, flush_every=64, flush_interval=5.0) if sample_path and sample_rate > 0 else None
+        self.sample_rate = sample_rate
+        self.report_every = report_every
+        self.rng = random.Random(seed)
+        self.batches = 0
+        self.texts = 0
+        self.latency_s = 0.0
+        # Welford running mean / variance of the reward over the whole run
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.last = None
+
+    def record_batch(self, texts, scores, features=None, latency_s=None, source="forward"):
+        n = len(scores)
+        if n == 0:
+            return None
+        self.batches += 1
+        for s in scores:
+            self.texts += 1
+            delta = s - self._mean
+            self._mean += delta / self.texts
+            self._m2 += delta * (s - self._mean)
+        mean = sum(scores) / n
+        lengths = sorted(len(t.split()) for t in texts)
+        summary = {
+            "batch": self.batches,
+            "source": source,
+            "size": n,
+            "time": time.time(),
+            "reward_mean": mean,
+            "reward_std": math.sqrt(sum((s - mean) ** 2 for s in scores) / n),
+            "reward_min": min(scores),
+            "reward_max": max(scores),
+            "length_mean": sum(lengths) / n,
+            "length_p50": _percentile(lengths, 50),
+            "length_p90": _percentile(lengths, 90),
+            "length_hist": _histogram(lengths, LENGTH_EDGES),
+        }
+        if latency_s is not None:
+            self.latency_s += latency_s
+            summary["latency_ms"] = latency_s * 1000
+            summary["latency_per_text_ms"] = latency_s * 1000 / n
+        if features:
+            for name in features[0]:
+                values = [f[name] for f in features]
+                summary[f"feature/{name}_mean"] = sum(values) / n
+                summary[f"feature/{name}_hist"] = _unit_histogram(values)
+        if self.sink is not None:
+            self.sink.write(summary)
+        if self.samples is not None:
+            for i, (text, score) in enumerate(zip(texts, scores)):
+                if self.rng.random() < self.sample_rate:
+                    self.samples.write({"batch": self.batches, "source": source, "score": score, "text": text,
+                                        "features": features[i] if features else None})
+        if self.report_every and self.batches % self.report_every == 0:
+            s = self.stats()
+            print(f"[Reward Telemetry] {s['batches']} batches / {s['texts']} texts | reward {s['reward_mean']:.3f} "
+                  f"± {s['reward_std']:.3f} | last batch {mean:.3f} | {s['latency_per_text_ms']:.1f} ms/text")
+        self.last = summary
+        return summary
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "reward_mean": self._mean,
+            "reward_std": math.sqrt(self._m2 / self.texts) if self.texts else 0.0,
+            "latency_per_text_ms": self.latency_s * 1000 / self.texts if self.texts else 0.0,
+        }
+
+    def close(self):
+        for sink in (self.sink, self.samples):
+            if sink is not None:
+                sink.close()
@@ -0,0 +1,147 @@
+"""Local-file datasets for the RL scripts, cached as memory-mapped Arrow.
+
+Each recipe reads local JSONL / Parquet / Arrow files (no Hub access), runs its
+preprocessing once (answer extraction, chat formatting, tokenization into
+`input_ids`) and saves the result with `save_to_disk` under
+
+  $RL_DATASET_CACHE/<recipe>-<fingerprint>/     (default ~/.cache/rl_datasets)
+
+The fingerprint covers the source files (path, size, mtime), the recipe
+parameters and the tokenizer (name, vocab, special tokens, chat template). Any
+change to these triggers a rebuild, and anything else reuses the cache. Later
+runs only `load_from_disk`, which memory-maps the Arrow files, so startup costs
+no preprocessing and little RAM.
+
+`streaming=True` skips the cache and returns an `IterableDataset` that reads
+and preprocesses the files lazily, for corpora larger than the disk budget.
+Note that PPOTrainer needs the map-style form, because it shuffles with a sized
+DataLoader.
+"""
+import hashlib
+import json
+import os
+import shutil
+
+from datasets import load_dataset, load_from_disk
+
+from gsm8k_rewards import ensure_chat_template, extract_hash_answer, gsm8k_prompt
+
+CACHE_ROOT = os.path.expanduser(os.environ.get("RL_DATASET_CACHE", "~/.cache/rl_datasets"))
+# bump when a recipe's output changes for the same inputs
+RECIPE_VERSION = 1
+
+_BUILDERS = {".jsonl": "json", ".json": "json", ".parquet": "parquet", ".arrow": "arrow"}
+
+
+def _as_list(files):
+    return [files] if isinstance(files, str) else list(files)
+
+
+def _builder_for(files):
+    builders = {_BUILDERS.get(os.path.splitext(f)[1].lower()) for f in files}
+    if len(builders) != 1 or None in builders:
+        raise ValueError(f"Expected local .jsonl/.json/.parquet/.arrow files of one kind, got {files}")
+    return builders.pop()
+
+
+def load_raw(files, streaming=False):
+    """Local files -> Dataset (or IterableDataset with `streaming=True`)."""
+    files = _as_list(files)
+    return load_dataset(_builder_for(files), data_files=files, split="train", streaming=streaming)
+
+
+def tokenizer_fingerprint(tokenizer):
+    parts = [type(tokenizer).__name__, tokenizer.name_or_path, len(tokenizer),
+             tokenizer.padding_side, tokenizer.truncation_side,
+             sorted(tokenizer.special_tokens_map.items(), key=str), getattr(tokenizer, "chat_template", None)]
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        parts.append(hashlib.sha256(backend.to_str().encode()).hexdigest())
+    return parts
+
+
+def fingerprint(recipe, files, params, tokenizer=None):
+    """Hash of everything a cached dataset depends on."""
+    sources = []
+    for path in _as_list(files):
+        st = os.stat(path)
+        sources.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+    key = {
+        "recipe": recipe,
+        "version": RECIPE_VERSION,
+        "sources": sources,
+        "params": params,
+        "tokenizer": tokenizer_fingerprint(tokenizer) if tokenizer is not None else None,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def cached_dataset(recipe, files, params, build, tokenizer=None, rebuild=False):
+    """`load_from_disk` the cached build for this fingerprint, creating it with `build()` if needed."""
+    path = os.path.join(CACHE_ROOT, f"{recipe}-{fingerprint(recipe, files, params, tokenizer)}")
+    if os.path.isdir(path) and not rebuild:
+        print(f"[Datasets] {recipe}: memory-mapping cached build {path}")
+        return load_from_disk(path)
+    print(f"[Datasets] {recipe}: building from {_as_list(files)}")
+    ds = build()
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    ds.save_to_disk(tmp)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    print(f"[Datasets] {recipe}: cached {len(ds)} rows -> {path}")
+    # reload so the returned dataset is backed by the cache files, not the build's temp files
+    return load_from_disk(path)
+
+
+# ---------------------------------------------------------------------------
+# Recipes
+# ---------------------------------------------------------------------------
+
+def gsm8k_dataset(files, tokenizer=None, max_prompt_length=None, limit=None, streaming=False,
+                  num_proc=None, rebuild=False):
+    """GSM8K question/answer files -> prompt (chat messages), answer and, with a tokenizer, input_ids.
+
+    `input_ids` is the chat-formatted prompt with the generation prompt appended,
+    left-truncated to `max_prompt_length`, as GRPOTrainer would truncate it.
+    """
+    if tokenizer is not None:
+        ensure_chat_template(tokenizer)
+
+    def preprocess(batch):
+        out = {"prompt": [gsm8k_prompt(q) for q in batch["question"]],
+               "answer": [extract_hash_answer(a) for a in batch["answer"]]}
+        if tokenizer is not None:
+            texts = [tokenizer.apply_chat_template(p, tokenize=False, add_generation_prompt=True) for p in out["prompt"]]
+            ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+            out["input_ids"] = [x[-max_prompt_length:] if max_prompt_length else x for x in ids]
+        return out
+
+    def build(raw):
+        if limit is not None:
+            raw = raw.take(limit) if streaming else raw.select(range(min(limit, len(raw))))
+        map_kwargs = {} if streaming else {"num_proc": num_proc}
+        ds = raw.map(preprocess, batched=True, remove_columns=["question"], **map_kwargs)
+        return ds.filter(lambda x: x["answer"] is not None)
+
+    if streaming:
+        return build(load_raw(files, streaming=True))
+    params = {"max_prompt_length": max_prompt_length, "limit": limit}
+    return cached_dataset("gsm8k", files, params, lambda: build(load_raw(files)), tokenizer, rebuild)
+
+
+def text_dataset(files, tokenizer, max_length=128, text_field="text", limit=None, streaming=False,
+                 num_proc=None, rebuild=False):
+    """Plain text files (e.g. an IMDB export) -> input_ids / attention_mask, as ppo_minimal.py trains on."""
+
+    def build(raw):
+        if limit is not None:
+            raw = raw.take(limit) if streaming else raw.select(range(min(limit, len(raw))))
+        map_kwargs = {} if streaming else {"num_proc": num_proc}
+        return raw.map(lambda x: tokenizer(x[text_field], truncation=True, max_length=max_length),
+                       batched=True, remove_columns=[text_field], **map_kwargs)
+
+    if streaming:
+        return build(load_raw(files, streaming=True))
+    params = {"max_length": max_length, "text_field": text_field, "limit": limit}
+    return cached_dataset(f"text-{text_field}", files, params, lambda: build(load_raw(files)), tokenizer, rebuild)
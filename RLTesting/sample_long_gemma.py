@@ -7,9 +7,11 @@ if __name__ == '__main__':
 
     # Choose a prompt and generation constraints
     prompt = "Hey, what's on your mind today?"
-    response = y.chat(prompt, max_length=8000, min_length=600)
+    # gpt2-medium only has 1024 positions, so stream past it with a rolling KV cache
+    response = y.chat_long(prompt, max_length=8000, min_length=600)
 
     # Output the result and word count
     print("Prompt:", prompt)
     print("Generated response:\n", response)
-    print("Word count:", len(response.split())) 
\ No newline at end of file
+    print("Word count:", len(response.split()))
+    print("Long-generation stats:", y.stats["chat_long"]) 
\ No newline at end of file
@@ -0,0 +1,336 @@
+"""Streaming self-play -> reward -> filter -> PPO prompt shards.
+
+Four stages, each on its own thread, connected by bounded queues of record
+batches (so a slow stage applies back-pressure instead of buffering everything):
+
+  generate  ya.py duets advanced in lockstep batches (one padded generate call
+            per speaker round), yielding one batch of turns per round
+  score     `yap_score` (spaCy features, batched with `_nlp.pipe`, optionally on
+            a spawn process pool) and ya.py's `score_response`
+  filter    drop empty/short replies, exact duplicates (normalized text,
+            within the last `--dedup-window` unique replies) and turns under
+            `--min-yap-score` / `--min-reward`
+  write     Arrow shards of `--shard-size` rows; a shard is written as
+            `.shard-NNNNN.arrow` and renamed to `shard-NNNNN.arrow` once complete
+
+Every stage counts items in/out and its busy time; a progress line is printed
+every `--report-every` seconds and `manifest.json` records the final numbers.
+
+The PPO scripts read the shards with `--prompt-shards <output-dir>` (see
+`record_sink.load_prompt_shards`).
+
+Usage:
+  python selfplay_pipeline.py --dialogues 5000 --batch-size 64 --output-dir selfplay-prompts
+  python ppo_yapperv1.py --prompt-shards selfplay-prompts
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import torch
+
+import ya
+from ppo_yapperv1 import _score_chunk
+from record_sink import RecordSink
+
+# end-of-stream marker passed down the queues
+_DONE = object()
+
+SHARD_SCHEMA = pa.schema([
+    ("prompt", pa.string()),
+    ("source_prompt", pa.string()),
+    ("speaker", pa.string()),
+    ("dialogue", pa.int64()),
+    ("turn", pa.int64()),
+    ("reward", pa.float64()),
+    ("yap_score", pa.float64()),
+])
+
+
+class Stage(threading.Thread):
+    """One pipeline stage: a source generator (no inbox) or a batch -> batch function."""
+
+    def __init__(self, name, fn, inbox=None, outbox=None, close=None):
+        super().__init__(name=f"stage-{name}", daemon=True)
+        self.stage_name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.close_fn = close
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_s = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+
+    def _emit(self, batch):
+        if not batch:
+            return
+        self.items_out += len(batch)
+        if self.outbox is not None:
+            self.outbox.put(batch)
+
+    def run(self):
+        self.started_at = time.perf_counter()
+        got_done = self.inbox is None
+        try:
+            if self.inbox is None:
+                source = self.fn()
+                while True:
+                    start = time.perf_counter()
+                    batch = next(source, None)
+                    self.busy_s += time.perf_counter() - start
+                    if batch is None:
+                        break
+                    self._emit(batch)
+            else:
+                while (batch := self.inbox.get()) is not _DONE:
+                    self.items_in += len(batch)
+                    start = time.perf_counter()
+                    out = self.fn(batch)
+                    self.busy_s += time.perf_counter() - start
+                    self._emit(out)
+                got_done = True
+            if self.close_fn is not None:
+                self.close_fn()
+        except Exception as e:
+            self.error = e
+            print(f"[Pipeline] Stage '{self.stage_name}' failed: {e}")
+            traceback.print_exc()
+            # keep draining so upstream stages are not blocked on a full queue
+            while not got_done and self.inbox.get() is not _DONE:
+                pass
+        finally:
+            self.finished_at = time.perf_counter()
+            if self.outbox is not None:
+                self.outbox.put(_DONE)
+
+    def stats(self):
+        end = self.finished_at or time.perf_counter()
+        wall = end - self.started_at if self.started_at else 0.0
+        return {
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "busy_s": round(self.busy_s, 2),
+            "wall_s": round(wall, 2),
+            # throughput while actually working vs. over the stage's lifetime
+            "busy_items_per_s": round(self.items_out / self.busy_s, 1) if self.busy_s else None,
+            "wall_items_per_s": round(self.items_out / wall, 1) if wall else None,
+            "error": None if self.error is None else str(self.error),
+        }
+
+
+# ---------------------------------------------------------------------------
+# Stage functions
+# ---------------------------------------------------------------------------
+
+def generate_turns(model, tokenizer, device, args):
+    """Source: batches of duet turns, one batch per lockstep speaker round."""
+    def source():
+        done = 0
+        while done < args.dialogues:
+            size = min(args.batch_size, args.dialogues - done)
+            yield from ya.iter_farm_turns(model, tokenizer, device, done, size, args.turns, args.max_new_tokens)
+            done += size
+    return source
+
+
+class Scorer:
+    def __init__(self, workers=0):
+        self.pool = None
+        self.workers = workers
+        if workers:
+            # spaCy parsing is CPU-bound Python; spawn so workers don't inherit CUDA state
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def __call__(self, batch):
+        texts = [r["reply"] for r in batch]
+        if self.pool is None:
+            scored = _score_chunk(texts)
+        else:
+            chunk = max(1, -(-len(texts) // self.workers))
+            parts = self.pool.map(_score_chunk, [texts[i:i + chunk] for i in range(0, len(texts), chunk)])
+            scored = [r for part in parts for r in part]
+        for record, (score, _) in zip(batch, scored):
+            record["yap_score"] = float(score)
+            record["reward"] = float(ya.score_response(record["reply"]))
+        return batch
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class Filter:
+    def __init__(self, min_yap_score=None, min_reward=None, min_chars=1, dedup_window=1_000_000):
+        self.min_yap_score = min_yap_score
+        self.min_reward = min_reward
+        self.min_chars = min_chars
+        # 64-bit digests of normalized replies in a rotating pair of sets: duplicates are caught
+        # across at least the last `dedup_window` unique replies, and memory stays bounded at
+        # 2 * dedup_window entries however long the run (0 = remember every reply, unbounded)
+        self.dedup_window = dedup_window
+        self.seen = set()
+        self.previous = set()
+        self.dropped = {"short": 0, "duplicate": 0, "threshold": 0}
+
+    def __call__(self, batch):
+        kept = []
+        for record in batch:
+            text = " ".join(record["reply"].split())
+            if len(text) < self.min_chars:
+                self.dropped["short"] += 1
+                continue
+            key = int.from_bytes(hashlib.blake2b(text.lower().encode(), digest_size=8).digest(), "little")
+            if key in self.seen or key in self.previous:
+                self.dropped["duplicate"] += 1
+                continue
+            if (self.min_yap_score is not None and record["yap_score"] < self.min_yap_score) or \
+               (self.min_reward is not None and record["reward"] < self.min_reward):
+                self.dropped["threshold"] += 1
+                continue
+            self.seen.add(key)
+            if self.dedup_window and len(self.seen) >= self.dedup_window:
+                self.previous, self.seen = self.seen, set()
+            kept.append(record)
+        return kept
+
+
+class ShardWriter:
+    def __init__(self, output_dir, shard_size):
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.shards = []
+        self.rows = 0
+        self._sink = None
+        self._rows_in_shard = 0
+
+    def _shard_paths(self):
+        name = f"shard-{len(self.shards):05d}.arrow"
+        return os.path.join(self.output_dir, "." + name), os.path.join(self.output_dir, name)
+
+    def _finish_shard(self):
+        self._sink.close()
+        tmp_path, final_path = self._shard_paths()
+        os.replace(tmp_path, final_path)
+        self.shards.append({"file": os.path.basename(final_path), "rows": self._rows_in_shard})
+        self._sink = None
+        self._rows_in_shard = 0
+
+    def __call__(self, batch):
+        for record in batch:
+            if self._sink is None:
+                self._sink = RecordSink(self._shard_paths()[0], schema=SHARD_SCHEMA, flush_every=1024)
+            self._sink.write({
+                "prompt": record["reply"],
+                "source_prompt": record["prompt"],
+                "speaker": record["speaker"],
+                "dialogue": record["dialogue"],
+                "turn": record["turn"],
+                "reward": record["reward"],
+                "yap_score": record["yap_score"],
+            })
+            self._rows_in_shard += 1
+            self.rows += 1
+            if self._rows_in_shard >= self.shard_size:
+                self._finish_shard()
+        return batch
+
+    def close(self):
+        if self._sink is not None:
+            self._finish_shard()
+
+
+# ---------------------------------------------------------------------------
+# Driver
+# ---------------------------------------------------------------------------
+
+def _progress_line(stages, filt, writer):
+    parts = []
+    for stage in stages:
+        s = stage.stats()
+        rate = s["busy_items_per_s"]
+        parts.append(f"{stage.stage_name} {s['items_out']}" + (f" ({rate}/s busy)" if rate else ""))
+    return " | ".join(parts) + f" | dropped {filt.dropped} | {len(writer.shards)} shards"
+
+
+def run_pipeline(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    model, tokenizer, device = ya.load_model(args.model_name)
+
+    scorer = Scorer(args.score_workers)
+    filt = Filter(args.min_yap_score, args.min_reward, args.min_chars, args.dedup_window)
+    writer = ShardWriter(args.output_dir, args.shard_size)
+    queues = [queue.Queue(maxsize=args.queue_size) for _ in range(3)]
+    stages = [
+        Stage("generate", generate_turns(model, tokenizer, device, args), outbox=queues[0]),
+        Stage("score", scorer, inbox=queues[0], outbox=queues[1], close=scorer.close),
+        Stage("filter", filt, inbox=queues[1], outbox=queues[2]),
+        Stage("write", writer, inbox=queues[2], close=writer.close),
+    ]
+    start = time.perf_counter()
+    for stage in stages:
+        stage.start()
+    while stages[-1].is_alive():
+        stages[-1].join(args.report_every)
+        if stages[-1].is_alive():
+            print(f"[Pipeline] {_progress_line(stages, filt, writer)}", flush=True)
+    elapsed = time.perf_counter() - start
+
+    manifest = {
+        "shards": writer.shards,
+        "rows": writer.rows,
+        "dialogues": args.dialogues,
+        "turns_per_dialogue": args.turns,
+        "elapsed_s": round(elapsed, 1),
+        "dialogues_per_hour": round(args.dialogues / elapsed * 3600) if elapsed else None,
+        "filters": {"min_yap_score": args.min_yap_score, "min_reward": args.min_reward, "min_chars": args.min_chars,
+                    "dedup_window": args.dedup_window},
+        "dropped": filt.dropped,
+        "stages": {stage.stage_name: stage.stats() for stage in stages},
+    }
+    with open(os.path.join(args.output_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"[Pipeline] Done in {elapsed:.1f}s: {writer.rows} prompts in {len(writer.shards)} shards -> {args.output_dir}")
+    for name, s in manifest["stages"].items():
+        print(f"[Pipeline]   {name:<8} in={s['items_in']:<7} out={s['items_out']:<7} busy={s['busy_s']:>7.1f}s "
+              f"busy_rate={s['busy_items_per_s']}/s wall_rate={s['wall_items_per_s']}/s"
+              + (f" ERROR: {s['error']}" if s["error"] else ""))
+    print(f"[Pipeline]   dropped: {filt.dropped}")
+    return manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Self-play duets -> yap reward -> filtered PPO prompt shards")
+    parser.add_argument("--model-name", type=str, default=ya.MODEL_NAME, help="Duet model")
+    parser.add_argument("--dialogues", type=int, default=1000, help="Number of duets to generate")
+    parser.add_argument("--batch-size", type=int, default=64, help="Duets advanced together per generate call")
+    parser.add_argument("--turns", type=int, default=ya.MAX_TURNS, help="Turns per duet")
+    parser.add_argument("--max-new-tokens", type=int, default=50, help="Tokens generated per reply")
+    parser.add_argument("--output-dir", type=str, default="selfplay-prompts", help="Where shards and manifest.json go")
+    parser.add_argument("--shard-size", type=int, default=5000, help="Rows per Arrow shard")
+    parser.add_argument("--min-yap-score", type=float, default=None, help="Drop turns whose yap_score is below this")
+    parser.add_argument("--min-reward", type=float, default=None, help="Drop turns whose score_response is below this")
+    parser.add_argument("--min-chars", type=int, default=10, help="Drop replies shorter than this (after whitespace collapse)")
+    parser.add_argument("--dedup-window", type=int, default=1_000_000, help="Unique replies remembered for duplicate filtering (0 = all)")
+    parser.add_argument("--score-workers", type=int, default=0, help="Process-pool workers for yap_score (0 = score on the stage thread)")
+    parser.add_argument("--queue-size", type=int, default=8, help="Batches buffered between stages")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress lines")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    run_pipeline(parse_args())
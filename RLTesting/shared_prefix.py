@@ -0,0 +1,179 @@
+"""Shared-prefix generation for GRPO groups.
+
+GRPOTrainer repeats every prompt `num_generations` times and hands the whole
+batch to `model.generate`, so each copy of SYSTEM_PROMPT + question is
+encoded again. `enable_shared_prefix_generation(model)` wraps `model.generate`:
+
+  1. identical (input_ids, attention_mask) rows are collapsed with
+     `torch.unique(dim=0)`
+  2. the unique prompts, minus their last token, are prefilled once into a
+     DynamicCache
+  3. the cache is forked to every row of the group with `batch_select_indices`
+  4. the original `generate` runs on the full batch with that cache, so it
+     only forwards the last prompt token before sampling starts
+
+Prompt compute drops from B rows to B / num_generations rows. Sampling is
+unchanged because every row still draws its own tokens. Rollouts run in eval
+mode: with gradient checkpointing GPT-2 turns the KV cache off in train mode,
+and dropout should not perturb sampling anyway.
+
+Run this file directly to measure the speedup as the group size grows:
+  python shared_prefix.py --group-sizes 1 2 4 8 16 --prompts 4
+"""
+import argparse
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+
+from gsm8k_rewards import ensure_chat_template, gsm8k_prompt
+
+
+def _position_ids(attention_mask):
+    # same positions GenerationMixin.prepare_inputs_for_generation derives for left-padded rows
+    position_ids = attention_mask.long().cumsum(-1) - 1
+    position_ids.masked_fill_(attention_mask == 0, 1)
+    return position_ids
+
+
+class SharedPrefixGenerate:
+    """Drop-in replacement for a bound `model.generate` that prefills each distinct prompt once."""
+
+    def __init__(self, model, generate):
+        self.model = model
+        self.generate = generate
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.prefilled_tokens = 0
+
+    def prefill(self, input_ids, attention_mask):
+        """DynamicCache over `input_ids[:, :-1]` for the distinct rows, forked to every row."""
+        rows = torch.cat([input_ids, attention_mask.to(input_ids.dtype)], dim=1)
+        unique, inverse = torch.unique(rows, dim=0, return_inverse=True)
+        length = input_ids.shape[1]
+        prefix_ids = unique[:, :length - 1]
+        prefix_mask = unique[:, length:2 * length - 1]
+        with torch.no_grad():
+            out = self.model(input_ids=prefix_ids, attention_mask=prefix_mask,
+                             position_ids=_position_ids(prefix_mask),
+                             past_key_values=DynamicCache(), use_cache=True)
+        cache = out.past_key_values
+        if not isinstance(cache, DynamicCache):
+            cache = DynamicCache.from_legacy_cache(cache)
+        cache.batch_select_indices(inverse)
+        self.prompt_tokens += int(attention_mask[:, :-1].sum())
+        self.prefilled_tokens += int(prefix_mask.sum())
+        return cache
+
+    def __call__(self, input_ids=None, attention_mask=None, **kwargs):
+        self.calls += 1
+        if (input_ids is None or input_ids.shape[1] < 2 or kwargs.get("past_key_values") is not None
+                or input_ids.shape[0] == 1):
+            return self.generate(input_ids=input_ids, attention_mask=attention_mask, **kwargs)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        was_training = self.model.training
+        self.model.eval()
+        try:
+            cache = self.prefill(input_ids, attention_mask)
+            return self.generate(input_ids=input_ids, attention_mask=attention_mask, past_key_values=cache, **kwargs)
+        finally:
+            self.model.train(was_training)
+
+    def stats(self):
+        saved = self.prompt_tokens - self.prefilled_tokens
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "prefilled_tokens": self.prefilled_tokens,
+            "saved_fraction": round(saved / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+        }
+
+
+def enable_shared_prefix_generation(model):
+    """Patch `model.generate` in place; returns the wrapper (for `.stats()`)."""
+    wrapper = SharedPrefixGenerate(model, model.generate)
+    model.generate = wrapper
+    return wrapper
+
+
+# ---------------------------------------------------------------------------
+# Benchmark
+# ---------------------------------------------------------------------------
+
+SAMPLE_QUESTIONS = [
+    "Natalia sold clips to 48 of her friends in April, and then she sold half as many clips in May. "
+    "How many clips did Natalia sell altogether in April and May?",
+    "Weng earns $12 an hour for babysitting. Yesterday, she just did 50 minutes of babysitting. How much did she earn?",
+    "Betty is saving money for a new wallet which costs $100. Betty has only half of the money she needs. "
+    "Her parents decided to give her $15 for that purpose, and her grandparents twice as much as her parents. "
+    "How much more money does Betty need to buy the wallet?",
+    "James writes a 3-page letter to 2 different friends twice a week. How many pages does he write a year?",
+]
+
+
+def _timed(fn, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return out, time.perf_counter() - start
+
+
+def benchmark(model_name, group_sizes, prompts, max_new_tokens, repeats, device):
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    ensure_chat_template(tokenizer)
+    model = AutoModelForCausalLM.from_pretrained(model_name).to(device)
+    model.eval()
+    texts = [tokenizer.apply_chat_template(gsm8k_prompt(q), tokenize=False, add_generation_prompt=True)
+             for q in (SAMPLE_QUESTIONS * prompts)[:prompts]]
+    shared = SharedPrefixGenerate(model, model.generate)
+    greedy = dict(max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+
+    print(f"[Shared Prefix] {model_name} on {device}: {prompts} prompts, {max_new_tokens} new tokens, best of {repeats}")
+    print(f"{'group':>6} {'rows':>6} {'baseline_s':>11} {'shared_s':>9} {'speedup':>8} {'prefill_saved':>14} {'same_tokens':>12}")
+    results = []
+    for group in group_sizes:
+        # GRPO layout: each prompt repeated `group` times in consecutive rows
+        enc = tokenizer([t for t in texts for _ in range(group)], return_tensors="pt", padding=True).to(device)
+        base_s = shared_s = float("inf")
+        for _ in range(repeats):
+            with torch.no_grad():
+                base_out, t = _timed(lambda: model.generate(**enc, **greedy), device)
+            base_s = min(base_s, t)
+            before = shared.prompt_tokens, shared.prefilled_tokens
+            with torch.no_grad():
+                shared_out, t = _timed(lambda: shared(**enc, **greedy), device)
+            shared_s = min(shared_s, t)
+        prompt_tokens = shared.prompt_tokens - before[0]
+        saved = 1 - (shared.prefilled_tokens - before[1]) / prompt_tokens
+        same = (base_out == shared_out).all(dim=1).float().mean().item()
+        results.append({"group": group, "rows": enc["input_ids"].shape[0], "baseline_s": base_s,
+                        "shared_s": shared_s, "prefill_saved": saved, "same_tokens": same})
+        print(f"{group:>6} {enc['input_ids'].shape[0]:>6} {base_s:>11.3f} {shared_s:>9.3f} "
+              f"{base_s / shared_s:>7.2f}x {saved:>13.1%} {same:>11.0%}")
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark shared-prefix generation against plain generate")
+    parser.add_argument("--model-name", type=str, default="gpt2", help="Model to benchmark")
+    parser.add_argument("--group-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="num_generations values to test")
+    parser.add_argument("--prompts", type=int, default=4, help="Distinct GSM8K prompts per batch")
+    parser.add_argument("--max-new-tokens", type=int, default=32, help="Tokens generated per row (short, to isolate prompt cost)")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per group size (best is reported)")
+    parser.add_argument("--device", type=str, default=None, help="Device (default: cuda if available)")
+    return parser.parse_args()
+
+
+def main(args):
+    device = torch.device(args.device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    return benchmark(args.model_name, args.group_sizes, args.prompts, args.max_new_tokens, args.repeats, device)
+
+
+if __name__ == "__main__":
+    main(parse_args())
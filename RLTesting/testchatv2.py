@@ -7,6 +7,8 @@ import random
 import re
 import os
 
+from chat_history import ChatHistory
+
 # --- Quantization Config ---
 try:
     quantization_config = BitsAndBytesConfig(
@@ -24,7 +26,7 @@ except Exception as e:
 
 # --- Configuration ---
 MODEL_NAME = "microsoft/phi-3-mini-128k-instruct"
-MAX_HISTORY_TURNS = 5
+HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_TOKEN_BUDGET", 4096)) # Prompt tokens kept from history (system prompt always kept)
 PROACTIVE_DELAY_SECONDS = 15
 PROACTIVE_MESSAGES = [
     "Is there anything else I can help you with?",
@@ -34,6 +36,7 @@ PROACTIVE_MESSAGES = [
     "Just checking if you needed anything else.",
 ]
 SYSTEM_PROMPT = "You are Phi, a helpful and friendly AI assistant. Answer the user concisely and directly. Avoid rambling." # Added avoid rambling instruction
+DEBUG_VERIFY_PROMPTS = os.environ.get("CHAT_DEBUG") == "1" # Re-render full prompts to check the token cache
 
 
 # --- Load Model and Tokenizer ---
@@ -97,14 +100,15 @@ def get_input():
 # --- Main Chat Function ---
 def chat():
     global user_input_buffer, input_available, program_running
-    conversation_history = [{"role": "system", "content": SYSTEM_PROMPT}]
+    # Caches template token ids per message so each turn only tokenizes the new message
+    history = ChatHistory(tokenizer, SYSTEM_PROMPT, verify=DEBUG_VERIFY_PROMPTS)
     last_interaction_time = time.time()
     # ai_was_last_speaker = False # We don't strictly need this flag with the new logic
 
     input_thread = threading.Thread(target=get_input, daemon=True)
     input_thread.start()
 
-    print(f"\nChatbot initialized with {MODEL_NAME}. Type your first message (or 'quit' to exit).")
+    print(f"\nChatbot initialized with {MODEL_NAME} (history budget: {HISTORY_TOKEN_BUDGET} tokens). Type your first message (or 'quit' to exit).")
 
     while program_running:
         current_time = time.time()
@@ -126,27 +130,17 @@ def chat():
                 break
 
             print(f"\nYou: {user_input}")
-            conversation_history.append({"role": "user", "content": user_input})
+            history.append("user", user_input)
 
             # --- Generate AI Response Following User Input ---
             try:
-                prompt_dict_list = [conversation_history[0]] + conversation_history[-(MAX_HISTORY_TURNS*2):]
-                if len(prompt_dict_list) > 1 and prompt_dict_list[1]['role'] == 'system':
-                     prompt_dict_list.pop(0)
-
-                templated_output = tokenizer.apply_chat_template(
-                    prompt_dict_list, add_generation_prompt=True, return_tensors="pt"
-                )
-
-                if isinstance(templated_output, dict):
-                    input_ids = templated_output['input_ids']
-                    attention_mask = templated_output.get('attention_mask', torch.ones_like(input_ids))
-                elif isinstance(templated_output, torch.Tensor):
-                    input_ids = templated_output
-                    attention_mask = torch.ones_like(input_ids)
-                else:
-                    print("Error: Unexpected output type from apply_chat_template")
-                    continue
+                # Prompt = cached system prompt + newest turns within the token budget + generation prompt
+                window = history.window_by_tokens(HISTORY_TOKEN_BUDGET)
+                prompt_ids = history.prompt_ids(window)
+                if DEBUG_VERIFY_PROMPTS:
+                    print(f"[History] prompt {len(prompt_ids)}/{HISTORY_TOKEN_BUDGET} tokens, {len(window) - 1}/{len(history.messages) - 1} messages kept")
+                input_ids = torch.tensor([prompt_ids])
+                attention_mask = torch.ones_like(input_ids)
 
                 try:
                     input_device = next(model.parameters()).device
@@ -179,13 +173,13 @@ def chat():
                 if not generated_text: generated_text = "..."
 
                 print(f"AI: {generated_text}")
-                conversation_history.append({"role": "assistant", "content": generated_text})
+                history.append("assistant", generated_text)
                 last_interaction_time = current_time # Reset timer AFTER AI speaks too
 
             except Exception as e:
                 print(f"\nError during generation: {e}")
                 traceback.print_exc()
-                conversation_history.append({"role": "assistant", "content": "[Error generating response]"})
+                history.append("assistant", "[Error generating response]")
                 last_interaction_time = current_time # Reset timer even on error
 
 
@@ -193,12 +187,13 @@ def chat():
         # Only check if NO user input was processed this cycle AND enough time has passed
         elif not processed_input_this_cycle and (current_time - last_interaction_time > PROACTIVE_DELAY_SECONDS):
              # Check if history exists and last speaker was AI to avoid infinite loop if model fails first response
-             if conversation_history and conversation_history[-1]['role'] == 'assistant':
+             if history.messages[-1]['role'] == 'assistant':
                 proactive_message = random.choice(PROACTIVE_MESSAGES)
                 print(f"AI (proactive): {proactive_message}")
-                conversation_history.append({"role": "assistant", "content": proactive_message})
+                history.append("assistant", proactive_message)
                 last_interaction_time = current_time # Reset timer after proactive message
 
+    print(f"Prompt lengths (budget {HISTORY_TOKEN_BUDGET} tokens): {history.prompt_stats()}")
     print("Exiting program.")
     program_running = False
 
@@ -1,30 +1,17 @@
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
-import time
-import threading
+import asyncio
 import sys
-import random
 import re
 import os
 
-# --- Quantization Config ---
-try:
-    quantization_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_compute_dtype=torch.float16,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_use_double_quant=True,
-    )
-except ImportError:
-    print("Error: bitsandbytes library not found. Please install it: pip install bitsandbytes accelerate")
-    sys.exit(1)
-except Exception as e:
-    print(f"Error creating BitsAndBytesConfig: {e}")
-    sys.exit(1)
+from chat_engine import AsyncChatEngine
+from chat_model import describe_load, load_chat_model
+from record_sink import TranscriptSink
+from chat_history import ChatHistory, PrefixKVCache
 
 # --- Configuration ---
 MODEL_NAME = "microsoft/phi-3-mini-128k-instruct"
-MAX_HISTORY_TURNS = 5
+HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_TOKEN_BUDGET", 4096)) # Prompt tokens kept from history (system prompt always kept)
 PROACTIVE_DELAY_SECONDS = 15
 PROACTIVE_MESSAGES = [
     "Is there anything else I can help you with?",
@@ -34,21 +21,16 @@ PROACTIVE_MESSAGES = [
     "Just checking if you needed anything else.",
 ]
 SYSTEM_PROMPT = "You are Phi, a helpful and friendly AI assistant. Answer the user concisely and directly. Avoid rambling." # Added avoid rambling instruction
+DEBUG_VERIFY_PROMPTS = os.environ.get("CHAT_DEBUG") == "1" # Re-render full prompts to check the token cache
+CHAT_TRANSCRIPT = os.environ.get("CHAT_TRANSCRIPT") # e.g. logs/chat.jsonl or .parquet / .arrow; unset = no transcript
 
 
 # --- Load Model and Tokenizer ---
-print(f"Loading model ({MODEL_NAME}) and tokenizer with 4-bit quantization...")
+# 4-bit bitsandbytes on CUDA, int8 dynamic quantization on CPU; quantized weights are cached on disk after the first run
+print(f"Loading model ({MODEL_NAME}) and tokenizer...")
 try:
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=False) # Keep trust_remote_code=False
-
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        quantization_config=quantization_config,
-        torch_dtype=torch.float16,
-        device_map="auto",
-        trust_remote_code=False, # Keep this False
-        # attn_implementation="eager", # Can try adding this back if needed
-    )
+    model, tokenizer, load_info = load_chat_model(MODEL_NAME, trust_remote_code=False) # Keep trust_remote_code=False
+    print(describe_load(load_info))
 
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
@@ -60,12 +42,11 @@ try:
     else:
         print("Using existing chat template from tokenizer.")
 
-    model.eval()
-    print(f"Model loaded successfully with 4-bit quantization using device_map.")
+    print(f"Model loaded successfully ({load_info['backend']}).")
 
 except ImportError as e:
      print(f"ImportError: {e}. Libraries missing/outdated.")
-     print("Please run: pip install --upgrade torch transformers accelerate bitsandbytes")
+     print("Please run: pip install --upgrade torch transformers accelerate (plus bitsandbytes for CUDA)")
      sys.exit(1)
 except Exception as e:
     print(f"Error loading model: {e}")
@@ -74,143 +55,61 @@ except Exception as e:
     sys.exit(1)
 
 
-# --- Global variables ---
-user_input_buffer = ""
-input_available = threading.Event()
-program_running = True
-
-# --- Input function ---
-def get_input():
-    global user_input_buffer, input_available, program_running
-    while program_running:
-        try:
-            user_input_buffer = input()
-            if not program_running: break
-            input_available.set()
-        except EOFError:
-            print("Input stream closed.")
-            program_running = False
-            input_available.set()
-            break
-        # time.sleep(0.1) # Usually not needed
+# --- Reply cleanup ---
+def clean_reply(text):
+    text = re.sub(r'<\|.*?\|>', '', text.strip())
+    return text.replace("<|end|>", "").strip()
 
 # --- Main Chat Function ---
 def chat():
-    global user_input_buffer, input_available, program_running
-    conversation_history = [{"role": "system", "content": SYSTEM_PROMPT}]
-    last_interaction_time = time.time()
-    # ai_was_last_speaker = False # We don't strictly need this flag with the new logic
-
-    input_thread = threading.Thread(target=get_input, daemon=True)
-    input_thread.start()
-
-    print(f"\nChatbot initialized with {MODEL_NAME}. Type your first message (or 'quit' to exit).")
-
-    while program_running:
-        current_time = time.time()
-        user_input = None
-        processed_input_this_cycle = False # Flag to track if user input was handled
-
-        # --- Check for and Process User Input FIRST ---
-        if input_available.wait(timeout=0.1): # Check if input is ready
-            if not program_running and user_input_buffer == "": break
-            user_input = user_input_buffer
-            user_input_buffer = ""
-            input_available.clear()
-            last_interaction_time = current_time # Reset timer on any user input
-            processed_input_this_cycle = True # Mark that we processed input
-
-            if user_input.lower() == 'quit':
-                print("Goodbye!")
-                program_running = False
-                break
-
-            print(f"\nYou: {user_input}")
-            conversation_history.append({"role": "user", "content": user_input})
-
-            # --- Generate AI Response Following User Input ---
-            try:
-                prompt_dict_list = [conversation_history[0]] + conversation_history[-(MAX_HISTORY_TURNS*2):]
-                if len(prompt_dict_list) > 1 and prompt_dict_list[1]['role'] == 'system':
-                     prompt_dict_list.pop(0)
-
-                templated_output = tokenizer.apply_chat_template(
-                    prompt_dict_list, add_generation_prompt=True, return_tensors="pt"
-                )
-
-                if isinstance(templated_output, dict):
-                    input_ids = templated_output['input_ids']
-                    attention_mask = templated_output.get('attention_mask', torch.ones_like(input_ids))
-                elif isinstance(templated_output, torch.Tensor):
-                    input_ids = templated_output
-                    attention_mask = torch.ones_like(input_ids)
-                else:
-                    print("Error: Unexpected output type from apply_chat_template")
-                    continue
-
-                try:
-                    input_device = next(model.parameters()).device
-                except StopIteration:
-                    input_device = torch.device("cpu") # Fallback
-
-                input_ids = input_ids.to(input_device)
-                attention_mask = attention_mask.to(input_device)
-
-                with torch.no_grad():
-                    output_sequences = model.generate(
-                        input_ids=input_ids,
-                        attention_mask=attention_mask,
-                        max_new_tokens=200,  # Slightly increased, adjust as needed
-                        pad_token_id=tokenizer.pad_token_id,
-                        eos_token_id=tokenizer.eos_token_id,
-                        # --- Adjusted Generation Parameters ---
-                        do_sample=True,
-                        temperature=0.6,     # Lowered temperature
-                        top_p=0.85,          # Slightly stricter top_p
-                        repetition_penalty=1.2 # Increased penalty
-                    )
-
-                response_ids = output_sequences[0][input_ids.shape[-1]:]
-                generated_text = tokenizer.decode(response_ids, skip_special_tokens=True)
-                generated_text = generated_text.strip()
-                generated_text = re.sub(r'<\|.*?\|>', '', generated_text)
-                generated_text = generated_text.replace("<|end|>", "").strip()
-
-                if not generated_text: generated_text = "..."
-
-                print(f"AI: {generated_text}")
-                conversation_history.append({"role": "assistant", "content": generated_text})
-                last_interaction_time = current_time # Reset timer AFTER AI speaks too
-
-            except Exception as e:
-                print(f"\nError during generation: {e}")
-                traceback.print_exc()
-                conversation_history.append({"role": "assistant", "content": "[Error generating response]"})
-                last_interaction_time = current_time # Reset timer even on error
-
-
-        # --- Handle Proactive AI Turn ---
-        # Only check if NO user input was processed this cycle AND enough time has passed
-        elif not processed_input_this_cycle and (current_time - last_interaction_time > PROACTIVE_DELAY_SECONDS):
-             # Check if history exists and last speaker was AI to avoid infinite loop if model fails first response
-             if conversation_history and conversation_history[-1]['role'] == 'assistant':
-                proactive_message = random.choice(PROACTIVE_MESSAGES)
-                print(f"AI (proactive): {proactive_message}")
-                conversation_history.append({"role": "assistant", "content": proactive_message})
-                last_interaction_time = current_time # Reset timer after proactive message
+    # Caches template token ids per message so each turn only tokenizes the new message
+    history = ChatHistory(tokenizer, SYSTEM_PROMPT, verify=DEBUG_VERIFY_PROMPTS)
+    # Keeps past_key_values between turns so only the new tokens are prefilled
+    kv_cache = PrefixKVCache(max_length=getattr(model.config, "original_max_position_embeddings", None))
+    # Structured per-turn records, written in batches by a background thread
+    transcript = TranscriptSink(CHAT_TRANSCRIPT) if CHAT_TRANSCRIPT else None
+    # stdin, generation and the proactive timer run as separate asyncio tasks; typing mid-reply cancels it
+    engine = AsyncChatEngine(
+        model,
+        tokenizer,
+        history,
+        token_budget=HISTORY_TOKEN_BUDGET,
+        generation_kwargs=dict(
+            max_new_tokens=200,  # Slightly increased, adjust as needed
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            # --- Adjusted Generation Parameters ---
+            do_sample=True,
+            temperature=0.6,     # Lowered temperature
+            top_p=0.85,          # Slightly stricter top_p
+            repetition_penalty=1.2 # Increased penalty
+        ),
+        proactive_messages=PROACTIVE_MESSAGES,
+        proactive_delay=PROACTIVE_DELAY_SECONDS,
+        kv_cache=kv_cache,
+        clean_reply=clean_reply,
+        empty_reply="...",
+        debug=DEBUG_VERIFY_PROMPTS,
+        transcript=transcript,
+    )
+
+    print(f"\nChatbot initialized with {MODEL_NAME} (history budget: {HISTORY_TOKEN_BUDGET} tokens). Type your first message (or 'quit' to exit).")
+    asyncio.run(engine.run())
 
+    print(f"Prompt lengths (budget {HISTORY_TOKEN_BUDGET} tokens): {history.prompt_stats()}")
+    if transcript is not None:
+        transcript.close()
+        print(f"Transcript: {transcript.records_written} turns written to {CHAT_TRANSCRIPT}")
     print("Exiting program.")
-    program_running = False
 
 
 # --- Run the chat ---
 if __name__ == "__main__":
     try:
-        import accelerate
-        import bitsandbytes
+        import accelerate # bitsandbytes is only needed on CUDA; load_chat_model falls back without it
     except ImportError as e:
         print(f"Missing required library: {e}")
-        print("Please install required libraries: pip install --upgrade torch transformers accelerate bitsandbytes")
+        print("Please install required libraries: pip install --upgrade torch transformers accelerate")
         sys.exit(1)
 
     chat()
\ No newline at end of file
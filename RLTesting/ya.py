@@ -1,3 +1,4 @@
+import argparse
 import torch
 from transformers import GPT2LMHeadModel, GPT2Tokenizer
 from datetime import datetime
@@ -5,6 +6,8 @@ import os
 import time
 from termcolor import colored
 
+from record_sink import TranscriptSink
+
 # -----------------------------
 # Config
 # -----------------------------
@@ -13,32 +16,33 @@ MAX_TURNS = 10
 MAX_HISTORY = 3
 AGENT_A_TAG = "[sarcastic bot]"
 AGENT_B_TAG = "[paranoid bot]"
+AGENT_A_SEED = f"{AGENT_A_TAG} So what’s your deal?"
+AGENT_B_SEED = f"{AGENT_B_TAG} Why are you even asking me that?"
 
-# Logging setup
-timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, f"yapbot_duet_{timestamp}.txt")
 
 # -----------------------------
 # Load model/tokenizer
 # -----------------------------
-tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
-model = GPT2LMHeadModel.from_pretrained(MODEL_NAME)
-model.eval()
+def load_model(model_name=MODEL_NAME):
+    tokenizer = GPT2Tokenizer.from_pretrained(model_name)
+    # batched generation: left padding so every row's last token sits at the end
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    model = GPT2LMHeadModel.from_pretrained(model_name)
+    model.eval()
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model.to(device)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+    return model, tokenizer, device
 
 # -----------------------------
 # Core functions
 # -----------------------------
-def log_turn(turn, speaker, prompt, reply, reward):
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(f"--- Turn {turn} | {speaker} | {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n")
-        f.write(f"Prompt: {prompt}\n")
-        f.write(f"Reply: {reply}\n")
-        f.write(f"Reward: {reward:.2f}\n\n")
+def transcript_path(kind, log_format):
+    os.makedirs(log_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return os.path.join(log_dir, f"yapbot_{kind}_{timestamp}.{log_format}")
 
 def score_response(response):
     length_score = min(len(response.split()), 30) / 30
@@ -46,44 +50,120 @@ def score_response(response):
     repetition_penalty = -0.3 if response.lower().count("i’m") > 2 else 0
     return length_score + question_bonus + repetition_penalty
 
-def generate_reply(prompt, max_length=50):
+def generate_reply(model, tokenizer, device, prompt, max_length=50):
     input_ids = tokenizer.encode(prompt, return_tensors="pt").to(device)
-    output = model.generate(input_ids, max_length=len(input_ids[0]) + max_length, do_sample=True, top_k=50)
+    output = model.generate(input_ids, max_length=len(input_ids[0]) + max_length, do_sample=True, top_k=50,
+                            pad_token_id=tokenizer.eos_token_id)
     decoded = tokenizer.decode(output[0], skip_special_tokens=True)
     return decoded[len(prompt):].strip()
 
+def generate_replies(model, tokenizer, device, prompts, max_length=50):
+    """One padded `generate` call for a whole batch of prompts; returns the new text per prompt."""
+    enc = tokenizer(prompts, return_tensors="pt", padding=True).to(device)
+    with torch.no_grad():
+        output = model.generate(**enc, max_new_tokens=max_length, do_sample=True, top_k=50,
+                                pad_token_id=tokenizer.eos_token_id)
+    new_tokens = output[:, enc["input_ids"].shape[1]:]
+    return [text.strip() for text in tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+def duet_prompt(tag, other_history):
+    return f"{tag} {' '.join(other_history[-MAX_HISTORY:])}"
+
 # -----------------------------
-# Initial seed
+# Single duet (interactive view)
 # -----------------------------
-agent_a_history = [f"{AGENT_A_TAG} So what’s your deal?"]
-agent_b_history = [f"{AGENT_B_TAG} Why are you even asking me that?"]
+def run_duet(model, tokenizer, device, turns, sink):
+    agent_a_history = [AGENT_A_SEED]
+    agent_b_history = [AGENT_B_SEED]
+
+    for turn in range(1, turns + 1):
+        # Agent A speaks
+        full_prompt_a = duet_prompt(AGENT_A_TAG, agent_b_history)
+        reply_a = generate_reply(model, tokenizer, device, full_prompt_a)
+        reward_a = score_response(reply_a)
+
+        print(colored(f"\nA [{AGENT_A_TAG}]: {reply_a}", "cyan"))
+        print(colored(f"[Reward A]: {reward_a:.2f}", "yellow"))
+        sink.log_turn(turn, "Agent A", full_prompt_a, reply_a, reward_a)
+        agent_a_history.append(reply_a)
+
+        time.sleep(0.5)
+
+        # Agent B speaks
+        full_prompt_b = duet_prompt(AGENT_B_TAG, agent_a_history)
+        reply_b = generate_reply(model, tokenizer, device, full_prompt_b)
+        reward_b = score_response(reply_b)
+
+        print(colored(f"\nB [{AGENT_B_TAG}]: {reply_b}", "magenta"))
+        print(colored(f"[Reward B]: {reward_b:.2f}", "yellow"))
+        sink.log_turn(turn, "Agent B", full_prompt_b, reply_b, reward_b)
+        agent_b_history.append(reply_b)
+
+        time.sleep(0.5)
 
 # -----------------------------
-# Main loop
+# Duet farm (headless, batched)
 # -----------------------------
-for turn in range(1, MAX_TURNS + 1):
-    # Agent A speaks
-    prompt_a = " ".join(agent_b_history[-MAX_HISTORY:])
-    full_prompt_a = f"{AGENT_A_TAG} {prompt_a}"
-    reply_a = generate_reply(full_prompt_a)
-    reward_a = score_response(reply_a)
-
-    print(colored(f"\nA [{AGENT_A_TAG}]: {reply_a}", "cyan"))
-    print(colored(f"[Reward A]: {reward_a:.2f}", "yellow"))
-    log_turn(turn, "Agent A", full_prompt_a, reply_a, reward_a)
-    agent_a_history.append(reply_a)
-
-    time.sleep(0.5)
-
-    # Agent B speaks
-    prompt_b = " ".join(agent_a_history[-MAX_HISTORY:])
-    full_prompt_b = f"{AGENT_B_TAG} {prompt_b}"
-    reply_b = generate_reply(full_prompt_b)
-    reward_b = score_response(reply_b)
-
-    print(colored(f"\nB [{AGENT_B_TAG}]: {reply_b}", "magenta"))
-    print(colored(f"[Reward B]: {reward_b:.2f}", "yellow"))
-    log_turn(turn, "Agent B", full_prompt_b, reply_b, reward_b)
-    agent_b_history.append(reply_b)
-
-    time.sleep(0.5)
+def iter_farm_turns(model, tokenizer, device, first_id, size, turns, max_length):
+    """Advance `size` independent duets in lockstep, yielding one list of turn records per speaker round."""
+    a_histories = [[AGENT_A_SEED] for _ in range(size)]
+    b_histories = [[AGENT_B_SEED] for _ in range(size)]
+    for turn in range(1, turns + 1):
+        for speaker, tag, own, other in (("Agent A", AGENT_A_TAG, a_histories, b_histories),
+                                         ("Agent B", AGENT_B_TAG, b_histories, a_histories)):
+            prompts = [duet_prompt(tag, history) for history in other]
+            replies = generate_replies(model, tokenizer, device, prompts, max_length)
+            records = []
+            for i, (prompt, reply) in enumerate(zip(prompts, replies)):
+                own[i].append(reply)
+                records.append({"dialogue": first_id + i, "turn": turn, "speaker": speaker, "prompt": prompt, "reply": reply})
+            yield records
+
+def run_farm_batch(model, tokenizer, device, first_id, size, turns, max_length, sink):
+    """Advance `size` duets in lockstep, logging every turn to `sink`; returns the turn count."""
+    logged = 0
+    for records in iter_farm_turns(model, tokenizer, device, first_id, size, turns, max_length):
+        for r in records:
+            sink.log_turn(r["turn"], r["speaker"], r["prompt"], r["reply"], score_response(r["reply"]), dialogue=r["dialogue"])
+        logged += len(records)
+    return logged
+
+def run_farm(model, tokenizer, device, args, sink):
+    start = time.perf_counter()
+    done = 0
+    turns_written = 0
+    while done < args.farm:
+        size = min(args.batch_size, args.farm - done)
+        turns_written += run_farm_batch(model, tokenizer, device, done, size, args.turns, args.max_new_tokens, sink)
+        done += size
+        elapsed = time.perf_counter() - start
+        print(f"[Duet Farm] {done}/{args.farm} dialogues | {turns_written} turns | "
+              f"{done / elapsed * 3600:.0f} dialogues/hour")
+    elapsed = time.perf_counter() - start
+    print(f"[Duet Farm] Wrote {done} dialogues ({turns_written} turns) to {sink.path} in {elapsed:.1f}s "
+          f"= {done / elapsed * 3600:.0f} dialogues/hour")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sarcastic vs paranoid GPT-2 duet")
+    parser.add_argument("--farm", type=int, default=0, help="Run N duets headless in lockstep batches instead of one interactive duet")
+    parser.add_argument("--batch-size", type=int, default=64, help="Duets advanced together per generate call (farm mode)")
+    parser.add_argument("--turns", type=int, default=MAX_TURNS, help="Turns per duet")
+    parser.add_argument("--max-new-tokens", type=int, default=50, help="Tokens generated per reply")
+    parser.add_argument("--log-format", choices=["jsonl", "parquet", "arrow"], default="jsonl", help="Transcript format (arrow loads back memory-mapped)")
+    parser.add_argument("--output", type=str, default=None, help="Transcript path; the extension picks the format (default: logs/yapbot_<mode>_<time>.<log-format>)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    return parser.parse_args()
+
+def main(args):
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    model, tokenizer, device = load_model()
+    # turns are buffered and written in batches by the sink's background thread
+    with TranscriptSink(args.output or transcript_path("farm" if args.farm else "duet", args.log_format)) as sink:
+        if args.farm:
+            run_farm(model, tokenizer, device, args, sink)
+        else:
+            run_duet(model, tokenizer, device, args.turns, sink)
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,345 @@
+"""Local inference server that shares one trained Yapper between many callers.
+
+Incoming requests land on an asyncio queue. A single batcher task drains it into
+batches of at most `--max-batch-size` requests, waiting no longer than
+`--max-wait-ms` for stragglers, and runs each batch as one padded `generate`
+call on a worker thread. Requests in a batch with different sampling params are
+split into one `generate` call per distinct parameter set.
+
+Endpoints (plain HTTP/1.1, one request per connection):
+  POST /generate  {"prompt": "...", "max_length": 80, "temperature": 0.9, "stream": true}
+  GET  /stats     queue depth, batch sizes, queue-wait and latency percentiles
+  GET  /health
+
+Usage:
+  python yapper_server.py --model-path yapbot-ppo --port 8008
+  curl -s localhost:8008/generate -d '{"prompt": "Hey, what is on your mind?"}'
+  curl -sN localhost:8008/generate -d '{"prompt": "Hi!", "stream": true}'
+  curl -s localhost:8008/stats
+
+`--unix-socket /tmp/yapper.sock` serves the same protocol on a Unix socket
+(`curl --unix-socket /tmp/yapper.sock http://localhost/stats`).
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+from ppo_yapperv1 import Yapper
+
+# sampling params a request may override; anything else in the body is ignored
+SAMPLING_KEYS = ("max_length", "min_length", "do_sample", "temperature", "top_p", "top_k")
+DEFAULT_MAX_LENGTH = 100
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+class GenerationRequest:
+    def __init__(self, prompt, sampling, stream, loop):
+        self.prompt = prompt
+        self.sampling = sampling
+        self.stream = stream
+        self.enqueued_at = time.perf_counter()
+        self.started_at = None
+        self.batch_size = None
+        self.future = loop.create_future()
+        # streamed text deltas; `None` marks the end of the response
+        self.chunks = asyncio.Queue() if stream else None
+
+    @property
+    def group_key(self):
+        return tuple(self.sampling.get(k) for k in SAMPLING_KEYS)
+
+
+class BatchStreamer(BaseStreamer):
+    """Fan a batched `generate` stream out to one asyncio queue per request.
+
+    HF calls `put` with the padded prompt ids first and then with one new token
+    per row at every step. Rows are decoded incrementally and only the text that
+    appeared since the previous step is forwarded; rows stop streaming once they
+    emit EOS (generate keeps padding them until the whole batch finishes).
+    """
+
+    def __init__(self, tokenizer, requests, loop):
+        self.tokenizer = tokenizer
+        self.requests = requests
+        self.loop = loop
+        self.tokens = [[] for _ in requests]
+        self.sent = [0] * len(requests)
+        self.finished = [False] * len(requests)
+        self.prompt_seen = False
+
+    def _emit(self, req, item):
+        # non-streaming requests can share a batch with streaming ones
+        if req.chunks is not None:
+            self.loop.call_soon_threadsafe(req.chunks.put_nowait, item)
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, token in enumerate(value.view(-1).tolist()):
+            if self.finished[row]:
+                continue
+            if token == self.tokenizer.eos_token_id:
+                self.finished[row] = True
+                continue
+            self.tokens[row].append(token)
+            text = self.tokenizer.decode(self.tokens[row], skip_special_tokens=True)
+            # hold back incomplete multi-byte characters until the next token
+            if text.endswith("�"):
+                continue
+            delta = text[self.sent[row]:]
+            if delta:
+                self.sent[row] = len(text)
+                self._emit(self.requests[row], delta)
+
+    def end(self):
+        for req in self.requests:
+            self._emit(req, None)
+
+
+class YapperServer:
+    def __init__(self, yapper, max_batch_size=8, max_wait_ms=20.0, history=1000):
+        self.yapper = yapper
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = asyncio.Queue()
+        # a single worker thread: the model is shared, batches run one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="yapper-gen")
+        self.started_at = time.time()
+        self.total_requests = 0
+        self.total_batches = 0
+        self.total_generate_calls = 0
+        self.in_flight = 0
+        self.batch_sizes = deque(maxlen=history)
+        self.queue_waits = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+
+    # -- batching ---------------------------------------------------------------
+
+    async def _collect_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _run_group(self, group, loop):
+        sampling = dict(group[0].sampling)
+        streamer = BatchStreamer(self.yapper.tokenizer, group, loop) if any(r.stream for r in group) else None
+        return self.yapper.chat_batch([r.prompt for r in group], streamer=streamer, **sampling)
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            self.total_batches += 1
+            self.batch_sizes.append(len(batch))
+            groups = {}
+            for req in batch:
+                groups.setdefault(req.group_key, []).append(req)
+            for group in groups.values():
+                now = time.perf_counter()
+                for req in group:
+                    req.started_at = now
+                    req.batch_size = len(group)
+                    self.queue_waits.append(now - req.enqueued_at)
+                self.in_flight += len(group)
+                self.total_generate_calls += 1
+                try:
+                    texts = await loop.run_in_executor(self.executor, self._run_group, group, loop)
+                except Exception as e:
+                    for req in group:
+                        if not req.future.done():
+                            req.future.set_exception(e)
+                        if req.chunks is not None:
+                            req.chunks.put_nowait(None)
+                else:
+                    for req, text in zip(group, texts):
+                        if not req.future.done():
+                            req.future.set_result(text)
+                finally:
+                    self.in_flight -= len(group)
+
+    async def submit(self, prompt, sampling, stream=False):
+        req = GenerationRequest(prompt, sampling, stream, asyncio.get_running_loop())
+        self.total_requests += 1
+        await self.queue.put(req)
+        return req
+
+    def stats(self):
+        def ms(v):
+            return None if v is None else round(v * 1000, 2)
+        sizes = list(self.batch_sizes)
+        return {
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "queue_depth": self.queue.qsize(),
+            "in_flight": self.in_flight,
+            "total_requests": self.total_requests,
+            "total_batches": self.total_batches,
+            "total_generate_calls": self.total_generate_calls,
+            "mean_batch_size": round(sum(sizes) / len(sizes), 2) if sizes else None,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "queue_wait_ms": {f"p{q}": ms(_percentile(list(self.queue_waits), q)) for q in (50, 90, 99)},
+            "latency_ms": {f"p{q}": ms(_percentile(list(self.latencies), q)) for q in (50, 90, 99)},
+        }
+
+    # -- HTTP -------------------------------------------------------------------
+
+    @staticmethod
+    async def _read_request(reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        if not request_line:
+            return None, None, b""
+        method, path, _ = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        body = await reader.readexactly(length) if length else b""
+        return method, path, body
+
+    @staticmethod
+    async def _send_json(writer, status, payload):
+        body = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+    @staticmethod
+    async def _send_chunk(writer, payload):
+        data = (json.dumps(payload) + "\n").encode()
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        await writer.drain()
+
+    async def _generate(self, body, writer):
+        try:
+            data = json.loads(body or b"{}")
+            prompt = data["prompt"]
+        except (ValueError, KeyError):
+            await self._send_json(writer, "400 Bad Request", {"error": "expected JSON body with a 'prompt' field"})
+            return
+        sampling = {k: data[k] for k in SAMPLING_KEYS if data.get(k) is not None}
+        sampling.setdefault("max_length", DEFAULT_MAX_LENGTH)
+        stream = bool(data.get("stream", False))
+        req = await self.submit(prompt, sampling, stream=stream)
+
+        if not stream:
+            try:
+                text = await req.future
+            except Exception as e:
+                await self._send_json(writer, "500 Internal Server Error", {"error": str(e)})
+                return
+            latency = time.perf_counter() - req.enqueued_at
+            self.latencies.append(latency)
+            await self._send_json(writer, "200 OK", {
+                "text": text,
+                "latency_ms": round(latency * 1000, 2),
+                "queue_wait_ms": round((req.started_at - req.enqueued_at) * 1000, 2),
+                "batch_size": req.batch_size,
+            })
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+        while True:
+            delta = await req.chunks.get()
+            if delta is None:
+                break
+            await self._send_chunk(writer, {"delta": delta})
+        try:
+            text = await req.future
+            latency = time.perf_counter() - req.enqueued_at
+            self.latencies.append(latency)
+            final = {"done": True, "text": text, "latency_ms": round(latency * 1000, 2), "batch_size": req.batch_size}
+        except Exception as e:
+            final = {"done": True, "error": str(e)}
+        await self._send_chunk(writer, final)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, body = await self._read_request(reader)
+            if method is None:
+                return
+            if method == "POST" and path == "/generate":
+                await self._generate(body, writer)
+            elif method == "GET" and path == "/stats":
+                await self._send_json(writer, "200 OK", self.stats())
+            elif method == "GET" and path == "/health":
+                await self._send_json(writer, "200 OK", {"ok": True})
+            else:
+                await self._send_json(writer, "404 Not Found", {"error": f"no route for {method} {path}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    device = torch.device(args.device) if args.device else None
+    print(f"Loading Yapper from {args.model_path} ...", flush=True)
+    yapper = Yapper(args.model_path, device, dtype=torch.bfloat16 if args.bf16 else None)
+    server = YapperServer(yapper, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    batcher = asyncio.create_task(server.batcher())
+    if args.unix_socket:
+        srv = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+        where = f"unix:{args.unix_socket}"
+    else:
+        srv = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+        where = f"http://{args.host}:{args.port}"
+    print(f"Yapper server listening on {where} (max_batch_size={args.max_batch_size}, max_wait_ms={args.max_wait_ms})", flush=True)
+    try:
+        async with srv:
+            await srv.serve_forever()
+    finally:
+        batcher.cancel()
+        server.executor.shutdown(wait=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve a trained Yapper over local HTTP with dynamic batching")
+    parser.add_argument("--model-path", type=str, default="yapbot-ppo", help="Trained Yapper checkpoint or hub model name")
+    parser.add_argument("--device", type=str, default=None, help="Device override (default: cuda if available)")
+    parser.add_argument("--bf16", action="store_true", help="Cast model weights to bfloat16")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Interface to bind")
+    parser.add_argument("--port", type=int, default=8008, help="TCP port to bind")
+    parser.add_argument("--unix-socket", type=str, default=None, help="Serve on this Unix socket path instead of TCP")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum requests per generate batch")
+    parser.add_argument("--max-wait-ms", type=float, default=20.0, help="Longest a batch waits for more requests")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        print("Server stopped.")